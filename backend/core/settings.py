@@ -165,3 +165,11 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# Shared cache (compiled workflow approval chains, OAuth state, ...)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+    },
+}
@@ -53,7 +53,10 @@ class RoleSerializer(serializers.ModelSerializer):
         extra_kwargs = {"institution": {"required": False}}
 
     def get_permissions_details(self, obj):
-        permissions = Permission.objects.filter(roles__role=obj)
+        if hasattr(obj, "prefetched_permissions"):
+            permissions = [rp.permission for rp in obj.prefetched_permissions]
+        else:
+            permissions = Permission.objects.filter(roles__role=obj)
         return PermissionSerializer(permissions, many=True).data
 
     def create(self, validated_data):
@@ -80,6 +83,33 @@ class RoleSerializer(serializers.ModelSerializer):
         return instance
 
 
+def user_serializer_prefetches(prefix=""):
+    """
+    Lookups that let `CustomUserSerializer` (roles, their permissions and
+    branches) serialize users reached through `prefix` without extra queries.
+    """
+    from django.db.models import Prefetch
+    from institution.models import UserBranch
+
+    return [
+        Prefetch(
+            f"{prefix}user_roles",
+            queryset=UserRole.objects.select_related("role").prefetch_related(
+                Prefetch(
+                    "role__permissions",
+                    queryset=RolePermission.objects.select_related("permission__category"),
+                    to_attr="prefetched_permissions",
+                )
+            ),
+        ),
+        Prefetch(
+            f"{prefix}attached_branches",
+            queryset=UserBranch.objects.select_related("branch__institution"),
+            to_attr="prefetched_user_branches",
+        ),
+    ]
+
+
 class CustomUserSerializer(serializers.ModelSerializer):
     roles = serializers.SerializerMethodField()
     roles_ids = serializers.ListField(
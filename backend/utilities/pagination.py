@@ -1,7 +1,93 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPageNumberPagination(PageNumberPagination):
     page_size_query_param = "page_size"
     max_page_size = 100
     page_size = 20 
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a strict (value, pk) descending ordering.
+
+    Unlike offset pagination, each page is a bounded index range scan that
+    starts right after the last row of the previous page, so the cost of a
+    page does not depend on how many rows come before it.
+    """
+
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = "page_size"
+    cursor_query_param = "cursor"
+    ordering_field = "updated_at"
+    pk_field = "id"
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, instance):
+        value = getattr(instance, self.ordering_field)
+        pk = getattr(instance, self.pk_field)
+        raw = f"{value.isoformat()}|{pk}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, queryset, encoded):
+        try:
+            value, pk = base64.urlsafe_b64decode(encoded.encode()).decode().rsplit("|", 1)
+            field = queryset.model._meta.get_field(self.ordering_field)
+            return field.to_python(value), int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            value, pk = self.decode_cursor(queryset, encoded)
+            queryset = queryset.filter(
+                Q(**{f"{self.ordering_field}__lt": value})
+                | Q(**{self.ordering_field: value, f"{self.pk_field}__lt": pk})
+            )
+
+        rows = list(
+            queryset.order_by(f"-{self.ordering_field}", f"-{self.pk_field}")[: page_size + 1]
+        )
+        self.has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        self.next_cursor = self.encode_cursor(rows[-1]) if self.has_next else None
+        return rows
+
+    def get_next_link(self):
+        if not self.next_cursor:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
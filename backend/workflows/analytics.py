@@ -0,0 +1,167 @@
+"""
+Approval turnaround analytics.
+
+Every completed or rejected task records its approval time (pending ->
+decision) in the notification outbox, in the transaction that made the
+decision. The outbox dispatcher later adds it to hourly and daily
+`ApprovalTurnaroundRollup` rows, so concurrent approvals on a step do not
+queue on the same rollup rows. Delivery is at least once: a dispatcher that
+dies mid-batch can count a decision twice. Each rollup row counts the decisions of
+one step in one bucket that fell into one bin of a fixed log-scale
+histogram, so reports only read a few rows per bucket and step. Averages
+are exact, and percentiles are interpolated within the histogram bin.
+
+Daily buckets start at local midnight (settings.TIME_ZONE).
+"""
+from bisect import bisect_right
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction as db_transaction
+from django.db.models import F, Max, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from workflows.models import ApprovalTurnaroundRollup
+
+# upper edges (seconds) of the histogram bins; the last bin is open-ended
+BIN_EDGES = (
+    60, 5 * 60, 15 * 60, 30 * 60,
+    3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600,
+    86400, 2 * 86400, 3 * 86400, 7 * 86400, 14 * 86400, 30 * 86400,
+)
+GRANULARITIES = ("hour", "day")
+GROUP_BY_FIELDS = {
+    "step": "step_id",
+    "action": "action_id",
+    "institution": "institution_id",
+}
+
+
+def bin_for(seconds):
+    return bisect_right(BIN_EDGES, seconds)
+
+
+def bucket_start(moment, granularity):
+    moment = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def record_turnaround(task):
+    """Queue a decided task's approval time for its rollup rows."""
+    from workflows.outbox import enqueue
+
+    if not task.started_at or not task.finished_at:
+        # activated before start times were recorded
+        return
+    enqueue(
+        "turnaround",
+        step_id=task.step_id,
+        institution_id=task.step.Institution_id,
+        action_id=task.step.action_id,
+        finished_at=task.finished_at.isoformat(),
+        seconds=max((task.finished_at - task.started_at).total_seconds(), 0),
+    )
+
+
+def apply_turnaround(step_id, institution_id, action_id, finished_at, seconds):
+    """Add one approval time, decided at `finished_at`, to its rollup rows."""
+    key = {
+        "step_id": step_id,
+        "bin": bin_for(seconds),
+    }
+    for granularity in GRANULARITIES:
+        _increment(
+            {**key, "granularity": granularity, "bucket_start": bucket_start(finished_at, granularity)},
+            seconds,
+            institution_id=institution_id,
+            action_id=action_id,
+        )
+
+
+def _increment(key, seconds, **defaults):
+    rollups = ApprovalTurnaroundRollup.objects.filter(**key)
+    increment = {
+        "count": F("count") + 1,
+        "total_seconds": F("total_seconds") + seconds,
+        "max_seconds": Greatest(F("max_seconds"), seconds),
+    }
+    if rollups.update(**increment):
+        return
+    try:
+        with db_transaction.atomic():
+            ApprovalTurnaroundRollup.objects.create(
+                **key, **defaults, count=1, total_seconds=seconds, max_seconds=seconds
+            )
+    except IntegrityError:
+        # created concurrently since our UPDATE
+        rollups.update(**increment)
+
+
+def estimate_percentile(bin_counts, quantile, max_seconds):
+    """
+    Estimate a percentile from `{bin: count}` by linear interpolation inside
+    the bin it falls in. The open-ended last bin is capped at `max_seconds`.
+    """
+    total = sum(bin_counts.values())
+    if not total:
+        return None
+    rank = quantile * total
+    seen = 0
+    for index in sorted(bin_counts):
+        count = bin_counts[index]
+        if seen + count >= rank:
+            low = BIN_EDGES[index - 1] if index else 0
+            high = BIN_EDGES[index] if index < len(BIN_EDGES) else max_seconds
+            high = min(high, max_seconds)
+            low = min(low, high)
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return max_seconds
+
+
+def turnaround_report(institution_id, granularity="day", since=None, until=None, group_by="step", action_id=None):
+    """
+    Count, average, p95 and max approval time over the rollups of one
+    institution, grouped by step, action or institution.
+    """
+    field = GROUP_BY_FIELDS[group_by]
+    rollups = ApprovalTurnaroundRollup.objects.filter(
+        institution_id=institution_id, granularity=granularity
+    )
+    if since:
+        rollups = rollups.filter(bucket_start__gte=bucket_start(since, granularity))
+    if until:
+        rollups = rollups.filter(bucket_start__lt=until)
+    if action_id:
+        rollups = rollups.filter(action_id=action_id)
+
+    groups = {}
+    for key, bin_index, count, total_seconds, max_seconds in (
+        rollups.values_list(field, "bin")
+        .annotate(Sum("count"), Sum("total_seconds"), Max("max_seconds"))
+        .order_by()
+    ):
+        group = groups.setdefault(key, {"bins": {}, "count": 0, "total": 0.0, "max": 0.0})
+        group["bins"][bin_index] = count
+        group["count"] += count
+        group["total"] += total_seconds
+        group["max"] = max(group["max"], max_seconds)
+
+    return [
+        {
+            group_by: key,
+            "count": group["count"],
+            "avg_seconds": group["total"] / group["count"],
+            "p95_seconds": estimate_percentile(group["bins"], 0.95, group["max"]),
+            "max_seconds": group["max"],
+        }
+        for key, group in sorted(groups.items())
+        if group["count"]
+    ]
+
+
+def default_report_window(granularity):
+    """Default `since` for reports: two days of hours or thirty days."""
+    return timezone.now() - (timedelta(days=2) if granularity == "hour" else timedelta(days=30))
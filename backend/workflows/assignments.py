@@ -0,0 +1,282 @@
+"""
+Maintenance of the denormalised `ApprovalTaskAssignment` index.
+
+Every helper here is set-based and idempotent, so callers can simply invoke
+the one matching the change they made (step approvers edited, user roles
+edited, tasks created, task status changed). Rebuilds record the tasks that
+appeared in or left a user's list as websocket deltas (see `workflows.deltas`).
+"""
+from functools import partial
+from itertools import islice
+
+from django.db import transaction as db_transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from users.models import Profile, Role, UserRole
+from workflows.chain import get_definition_chain
+from workflows.deltas import (
+    ADDED,
+    REMOVED,
+    changes_for,
+    enqueue_task_deltas,
+    merge_changes,
+)
+from workflows.models import (
+    ApprovalTask,
+    ApprovalTaskAssignment,
+    InstitutionApprovalStep,
+    InstitutionApprovalStepApprovorRole,
+    InstitutionApprovalStepApprovorUser,
+    WorkflowDefinition,
+)
+
+ASSIGNMENT_BATCH_SIZE = 2000
+
+
+def step_user_ids(step_ids):
+    """Map each step id to the set of user ids allowed to approve it."""
+    step_ids = list(step_ids)
+    users = {step_id: set() for step_id in step_ids}
+
+    role_steps = {}
+    for step_id, role_id in InstitutionApprovalStepApprovorRole.objects.filter(
+        step_id__in=step_ids
+    ).values_list("step_id", "approver_role_id"):
+        role_steps.setdefault(role_id, set()).add(step_id)
+
+    for role_id, user_id in UserRole.objects.filter(role_id__in=role_steps).values_list(
+        "role_id", "user_id"
+    ):
+        for step_id in role_steps[role_id]:
+            users[step_id].add(user_id)
+
+    for step_id, user_id in InstitutionApprovalStepApprovorUser.objects.filter(
+        step_id__in=step_ids
+    ).values_list("step_id", "approver_user__user_id"):
+        users[step_id].add(user_id)
+
+    return users
+
+
+def _bulk_assign(rows):
+    rows = iter(rows)
+    while True:
+        batch = [
+            ApprovalTaskAssignment(
+                task_id=task_id,
+                user_id=user_id,
+                status=task_status,
+                institution_id=institution_id,
+                task_updated_at=updated_at,
+            )
+            for task_id, user_id, task_status, institution_id, updated_at in islice(
+                rows, ASSIGNMENT_BATCH_SIZE
+            )
+        ]
+        if not batch:
+            return
+        ApprovalTaskAssignment.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def assign_tasks(tasks, users_by_step=None):
+    """
+    Create the assignments of freshly created tasks (an `ApprovalTask`
+    queryset). Returns the ids of the tasks.
+    """
+    tasks = list(
+        tasks.values_list("id", "step_id", "status", "step__Institution_id", "updated_at")
+    )
+    if users_by_step is None:
+        users_by_step = step_user_ids({task[1] for task in tasks})
+    _bulk_assign(
+        (task_id, user_id, task_status, institution_id, updated_at)
+        for task_id, step_id, task_status, institution_id, updated_at in tasks
+        for user_id in users_by_step.get(step_id, ())
+    )
+    return [task[0] for task in tasks]
+
+
+def rebuild_step_assignments(step_ids):
+    """
+    Re-sync the assignments of the tasks on `step_ids` after approvers
+    changed, and record the resulting task list deltas in the outbox. Tasks
+    started from a frozen `WorkflowDefinition` keep the approvers they were
+    started with, so only older tasks, which follow the live steps, change.
+    """
+    changes = {}
+    for step_id, user_ids in step_user_ids(step_ids).items():
+        step_tasks = ApprovalTask.objects.filter(step_id=step_id, definition__isnull=True)
+        step_assignments = ApprovalTaskAssignment.objects.filter(
+            task__in=step_tasks, escalated=False
+        )
+        previous_user_ids = set(
+            step_assignments.values_list("user_id", flat=True).distinct()
+        )
+        step_assignments.exclude(user_id__in=user_ids).delete()
+
+        task_ids = []
+        if user_ids:
+            institution_id = (
+                InstitutionApprovalStep.objects.filter(pk=step_id)
+                .values_list("Institution_id", flat=True)
+                .first()
+            )
+            tasks = step_tasks.values_list("id", "status", "updated_at")
+            _bulk_assign(
+                (task_id, user_id, task_status, institution_id, updated_at)
+                for task_id, task_status, updated_at in _collect_ids(
+                    tasks.iterator(chunk_size=ASSIGNMENT_BATCH_SIZE), task_ids
+                )
+                for user_id in user_ids
+            )
+        elif previous_user_ids:
+            task_ids = step_tasks.values_list("id", flat=True)
+
+        merge_changes(changes, changes_for(previous_user_ids - user_ids, task_ids, REMOVED))
+        merge_changes(changes, changes_for(user_ids - previous_user_ids, task_ids, ADDED))
+    enqueue_task_deltas(changes)
+
+
+def schedule_step_rebuild(step_id):
+    """
+    Run `rebuild_step_assignments` for `step_id` once the current transaction
+    commits (at once outside a transaction). Editing a step replaces its
+    role and approver rows one by one; this rebuilds the step only once.
+    """
+    connection = db_transaction.get_connection()
+    if any(
+        getattr(func, "rebuild_step_id", None) == step_id
+        for _, func, _ in connection.run_on_commit
+    ):
+        return
+    rebuild = partial(_rebuild_step, step_id)
+    rebuild.rebuild_step_id = step_id
+    db_transaction.on_commit(rebuild)
+
+
+def _rebuild_step(step_id):
+    with db_transaction.atomic():
+        rebuild_step_assignments([step_id])
+
+
+def open_user_task_filter(user_id):
+    """
+    A `Q` on `ApprovalTask` matching the open tasks `user_id` may approve
+    through their roles or as a named approver. Tasks started from a frozen
+    `WorkflowDefinition` are matched against its snapshot of the steps,
+    older tasks against the live step tables. Only definitions that still
+    have open tasks are read, so the cost does not grow with their history.
+    """
+    from workflows.transitions import OPEN_STATUSES
+
+    role_ids = set(UserRole.objects.filter(user_id=user_id).values_list("role_id", flat=True))
+    live_step_ids = InstitutionApprovalStep.objects.filter(
+        Q(roles__approver_role_id__in=role_ids) | Q(approver__approver_user__user_id=user_id)
+    ).values_list("id", flat=True)
+    tasks = Q(definition__isnull=True, step_id__in=set(live_step_ids))
+
+    # snapshots only name roles and profiles of their own Institution
+    institution_ids = set(
+        Role.objects.filter(id__in=role_ids).values_list("institution_id", flat=True)
+    ) | set(Profile.objects.filter(user_id=user_id).values_list("institution_id", flat=True))
+    definition_ids = WorkflowDefinition.objects.filter(
+        Exists(ApprovalTask.objects.filter(definition_id=OuterRef("pk"), status__in=OPEN_STATUSES)),
+        Institution_id__in=institution_ids - {None},
+    ).values_list("id", flat=True)
+    for definition_id in definition_ids:
+        step_ids = [
+            level.step_id
+            for level in get_definition_chain(definition_id).levels
+            if level.allows(user_id, role_ids)
+        ]
+        if step_ids:
+            tasks |= Q(definition_id=definition_id, step_id__in=step_ids)
+    return tasks & Q(status__in=OPEN_STATUSES)
+
+
+def rebuild_user_assignments(user_id):
+    """
+    Re-sync the assignments of one user's open tasks after their roles
+    changed, and record the resulting task list deltas in the outbox.
+    Closed tasks keep the assignments they were decided with.
+    """
+    from workflows.transitions import OPEN_STATUSES
+
+    user_tasks = ApprovalTask.objects.filter(open_user_task_filter(user_id))
+
+    stale = ApprovalTaskAssignment.objects.filter(
+        user_id=user_id, escalated=False, status__in=OPEN_STATUSES
+    ).exclude(task__in=user_tasks)
+    removed_ids = list(stale.values_list("task_id", flat=True))
+    stale.delete()
+
+    assigned_ids = set(
+        ApprovalTaskAssignment.objects.filter(
+            user_id=user_id, status__in=OPEN_STATUSES
+        ).values_list("task_id", flat=True)
+    )
+    tasks = user_tasks.values_list("id", "status", "step__Institution_id", "updated_at")
+    added_ids = []
+    _bulk_assign(
+        (task_id, user_id, task_status, institution_id, updated_at)
+        for task_id, task_status, institution_id, updated_at in _collect_ids(
+            tasks.iterator(chunk_size=ASSIGNMENT_BATCH_SIZE), added_ids, exclude=assigned_ids
+        )
+    )
+
+    changes = changes_for([user_id], removed_ids, REMOVED)
+    merge_changes(changes, changes_for([user_id], added_ids, ADDED))
+    enqueue_task_deltas(changes)
+
+
+def _collect_ids(rows, into, exclude=()):
+    """Yield `rows` whose first column is not in `exclude`, appending that id to `into`."""
+    for row in rows:
+        if row[0] in exclude:
+            continue
+        into.append(row[0])
+        yield row
+
+
+def escalate_assignments(task, user_ids):
+    """Assign an overdue task to `user_ids` on top of its step's approvers."""
+    user_ids = set(user_ids) - {None}
+    ApprovalTaskAssignment.objects.bulk_create(
+        [
+            ApprovalTaskAssignment(
+                task_id=task.id,
+                user_id=user_id,
+                status=task.status,
+                institution_id=task.step.Institution_id,
+                task_updated_at=task.updated_at,
+                escalated=True,
+            )
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+    enqueue_task_deltas(changes_for(user_ids, [task.id], ADDED))
+
+
+def sync_task_status(task_ids, status, updated_at=None):
+    """Mirror a task status change onto its assignments."""
+    return ApprovalTaskAssignment.objects.filter(task_id__in=task_ids).update(
+        status=status, task_updated_at=updated_at or timezone.now()
+    )
+
+
+def task_recipient_user_ids(task_ids):
+    """User ids assigned to any of `task_ids`."""
+    return set(
+        ApprovalTaskAssignment.objects.filter(task_id__in=task_ids).values_list(
+            "user_id", flat=True
+        )
+    )
+
+
+def user_tasks_queryset(user_id, queryset=None):
+    """Every task assigned to the user, without joining the approver tables."""
+    if queryset is None:
+        queryset = ApprovalTask.objects.all()
+    return queryset.filter(assignments__user_id=user_id)
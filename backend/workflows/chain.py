@@ -0,0 +1,486 @@
+"""
+Compiled approval chains.
+
+An approval chain is the immutable, ordered view of every
+`InstitutionApprovalStep` configured for one (Institution, WorkflowAction)
+pair, together with the role and approver ids allowed to act on each level.
+
+Chains are compiled once and kept in a process-local LRU that is backed by
+the shared Django cache. Both layers are keyed by a version number that is
+bumped whenever a step, a step role or a step approver is saved, deleted or
+reordered, so a warm lookup never touches the database. While the shared
+cache is unreachable every lookup is a miss: chains are compiled from the
+database and approvals carry on, only slower.
+
+Workflows are not evaluated against the live chain but against the
+`WorkflowDefinition` they were started with: a frozen JSON snapshot of the
+chain, stored once per distinct chain and referenced by every task. Since a
+definition never changes, its chain is cached by definition id for good and
+a cold lookup reads a single row.
+"""
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass, replace
+from datetime import timedelta
+from threading import Lock
+from typing import Iterable, Optional
+
+from cachetools import LRUCache
+from django.core.cache import cache
+from django.db import transaction
+
+CHAIN_LRU_SIZE = 512
+CHAIN_CACHE_TIMEOUT = 60 * 60 * 24
+# inserts of a new definition version before an IntegrityError is raised
+FREEZE_ATTEMPTS = 3
+
+_local_chains = LRUCache(maxsize=CHAIN_LRU_SIZE)
+_local_lock = Lock()
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_get(key):
+    # backends raise their own connection errors
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.warning(f"Chain cache unavailable, reading {key} from the database: {e}")
+        return None
+
+
+def _cache_set(key, value):
+    try:
+        cache.set(key, value, timeout=CHAIN_CACHE_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Chain cache unavailable, not storing {key}: {e}")
+
+
+@dataclass(frozen=True)
+class ApprovalLevel:
+    step_id: int
+    step_name: str
+    level: int
+    role_ids: frozenset
+    approver_profile_ids: frozenset
+    approver_user_ids: frozenset
+    sla: Optional[timedelta] = None
+    escalation_action: str = "notify"
+    escalation_role_id: Optional[int] = None
+    quorum: str = "all"
+    quorum_count: Optional[int] = None
+
+    def required_approvals(self, stage_size: int) -> int:
+        """Approvals this step asks of a stage of `stage_size` parallel steps."""
+        if self.quorum == "any":
+            return 1
+        if self.quorum == "n_of_m" and self.quorum_count:
+            return min(self.quorum_count, stage_size)
+        return stage_size
+
+    def allows(self, user_id: int, role_ids: Iterable[int], escalated: bool = False) -> bool:
+        """Whether a user holding `role_ids` may act on this level."""
+        if user_id in self.approver_user_ids:
+            return True
+        role_ids = set(role_ids)
+        if (
+            escalated
+            and self.escalation_action == "reassign"
+            and self.escalation_role_id in role_ids
+        ):
+            return True
+        return not self.role_ids.isdisjoint(role_ids)
+
+    def due_at(self, started_at):
+        """SLA deadline of a task that became pending at `started_at`."""
+        return started_at + self.sla if self.sla else None
+
+
+@dataclass(frozen=True)
+class ApprovalChain:
+    institution_id: int
+    action_id: int
+    owner_id: Optional[int]
+    version: int
+    levels: tuple
+
+    @property
+    def last_level(self) -> Optional[ApprovalLevel]:
+        return self.levels[-1] if self.levels else None
+
+    @property
+    def stages(self) -> tuple:
+        """The steps grouped by level: each stage runs in parallel, stages in order."""
+        stages = []
+        for level in self.levels:
+            if stages and stages[-1][0].level == level.level:
+                stages[-1].append(level)
+            else:
+                stages.append([level])
+        return tuple(tuple(stage) for stage in stages)
+
+    @property
+    def first_stage(self) -> tuple:
+        return self.stages[0] if self.levels else ()
+
+    def level_for_step(self, step_id: int) -> Optional[ApprovalLevel]:
+        for level in self.levels:
+            if level.step_id == step_id:
+                return level
+        return None
+
+    def stage_for_step(self, step_id: int) -> tuple:
+        """The steps approving in parallel with `step_id`, itself included."""
+        level = self.level_for_step(step_id)
+        if level is None:
+            return ()
+        return tuple(other for other in self.levels if other.level == level.level)
+
+    def next_stage(self, step_id: int) -> tuple:
+        """The stage that follows the one of `step_id`, empty after the last."""
+        level = self.level_for_step(step_id)
+        for stage in self.stages:
+            if level is not None and stage[0].level > level.level:
+                return stage
+        return ()
+
+    @staticmethod
+    def required_approvals(stage) -> int:
+        """
+        Approvals that complete `stage`: every step ("all"), one ("any") or
+        N ("n_of_m"). When its steps disagree the strictest rule applies.
+        """
+        return max(level.required_approvals(len(stage)) for level in stage)
+
+    def can_approve(
+        self, step_id: int, user_id: int, role_ids: Iterable[int], escalated: bool = False
+    ) -> bool:
+        """
+        Whether the user may approve or reject the task on `step_id`; pass
+        `escalated` for tasks that were reassigned after breaching their SLA.
+        """
+        if self.owner_id is not None and user_id == self.owner_id:
+            return True
+        level = self.level_for_step(step_id)
+        return level is not None and level.allows(user_id, role_ids, escalated)
+
+    def relevel(self, new_levels) -> "ApprovalChain":
+        """
+        This chain with its steps moved to the levels in `new_levels`
+        (`{step_id: level}`), ordered as `compile_approval_chain` orders them.
+        Everything else, approvers included, is kept. The copy has no
+        version, so `freeze_chain` does not map it to a live chain version.
+        """
+        levels = [
+            replace(level, level=new_levels.get(level.step_id, level.level))
+            for level in self.levels
+        ]
+        levels.sort(key=lambda level: (level.level, level.step_id))
+        return replace(self, version=0, levels=tuple(levels))
+
+
+def _version_key(institution_id, action_id):
+    return f"workflows:chain-version:{institution_id}:{action_id}"
+
+
+# bump when ApprovalChain/ApprovalLevel gain fields, so chains pickled by an
+# older release are not read back
+CHAIN_FORMAT = 3
+
+
+def _chain_key(institution_id, action_id, version):
+    return f"workflows:chain:{CHAIN_FORMAT}:{institution_id}:{action_id}:{version}"
+
+
+def _current_version(institution_id, action_id) -> Optional[int]:
+    """The chain's version, or None while the shared cache is unreachable."""
+    key = _version_key(institution_id, action_id)
+    try:
+        version = cache.get(key)
+        if version is None:
+            # Seed from the clock so an evicted version never collides with a
+            # chain still held in some process-local LRU.
+            cache.add(key, time.time_ns(), timeout=None)
+            version = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Chain cache unavailable, compiling from the database: {e}")
+        return None
+    return version
+
+
+def compile_approval_chain(institution_id, action_id, version=0) -> ApprovalChain:
+    """Build an `ApprovalChain` from the step, role and approver tables."""
+    from institution.models import Institution
+    from workflows.models import (
+        InstitutionApprovalStep,
+        InstitutionApprovalStepApprovorRole,
+        InstitutionApprovalStepApprovorUser,
+    )
+
+    steps = list(
+        InstitutionApprovalStep.objects.filter(
+            Institution_id=institution_id, action_id=action_id
+        )
+        .order_by("level", "id")
+        .values_list(
+            "id",
+            "step_name",
+            "level",
+            "sla",
+            "escalation_action",
+            "escalation_role_id",
+            "quorum",
+            "quorum_count",
+        )
+    )
+    step_ids = [step[0] for step in steps]
+
+    roles = {}
+    for step_id, role_id in InstitutionApprovalStepApprovorRole.objects.filter(
+        step_id__in=step_ids
+    ).values_list("step_id", "approver_role_id"):
+        roles.setdefault(step_id, set()).add(role_id)
+
+    profiles, users = {}, {}
+    for step_id, profile_id, user_id in InstitutionApprovalStepApprovorUser.objects.filter(
+        step_id__in=step_ids
+    ).values_list("step_id", "approver_user_id", "approver_user__user_id"):
+        profiles.setdefault(step_id, set()).add(profile_id)
+        users.setdefault(step_id, set()).add(user_id)
+
+    owner_id = (
+        Institution.objects.filter(pk=institution_id)
+        .values_list("institution_owner_id", flat=True)
+        .first()
+    )
+
+    levels = tuple(
+        ApprovalLevel(
+            step_id=step_id,
+            step_name=step_name,
+            level=level,
+            role_ids=frozenset(roles.get(step_id, ())),
+            approver_profile_ids=frozenset(profiles.get(step_id, ())),
+            approver_user_ids=frozenset(users.get(step_id, ())),
+            sla=sla,
+            escalation_action=escalation_action,
+            escalation_role_id=escalation_role_id,
+            quorum=quorum,
+            quorum_count=quorum_count,
+        )
+        for (
+            step_id,
+            step_name,
+            level,
+            sla,
+            escalation_action,
+            escalation_role_id,
+            quorum,
+            quorum_count,
+        ) in steps
+    )
+    return ApprovalChain(
+        institution_id=institution_id,
+        action_id=action_id,
+        owner_id=owner_id,
+        version=version,
+        levels=levels,
+    )
+
+
+def get_approval_chain(institution_id, action_id) -> ApprovalChain:
+    """Return the current compiled chain, compiling it on a cache miss."""
+    version = _current_version(institution_id, action_id)
+    if version is None:
+        # without the version the local LRU may be stale too
+        return compile_approval_chain(institution_id, action_id)
+    local_key = (institution_id, action_id, version)
+
+    with _local_lock:
+        chain = _local_chains.get(local_key)
+    if chain is not None:
+        return chain
+
+    shared_key = _chain_key(institution_id, action_id, version)
+    chain = _cache_get(shared_key)
+    if chain is None:
+        chain = compile_approval_chain(institution_id, action_id, version)
+        _cache_set(shared_key, chain)
+
+    with _local_lock:
+        _local_chains[local_key] = chain
+    return chain
+
+
+def get_chain_for_step(step) -> ApprovalChain:
+    return get_approval_chain(step.Institution_id, step.action_id)
+
+
+# order of the level attributes in a definition's "levels" arrays
+DEFINITION_LEVEL_FIELDS = (
+    "step_id",
+    "step_name",
+    "level",
+    "role_ids",
+    "approver_profile_ids",
+    "approver_user_ids",
+    "sla",
+    "escalation_action",
+    "escalation_role_id",
+    "quorum",
+    "quorum_count",
+)
+
+
+def chain_to_definition(chain) -> dict:
+    """Compact, canonical JSON form of `chain` (SLAs in seconds, ids sorted)."""
+    return {
+        "owner": chain.owner_id,
+        "levels": [
+            [
+                level.step_id,
+                level.step_name,
+                level.level,
+                sorted(level.role_ids),
+                sorted(level.approver_profile_ids),
+                sorted(level.approver_user_ids),
+                level.sla.total_seconds() if level.sla else None,
+                level.escalation_action,
+                level.escalation_role_id,
+                level.quorum,
+                level.quorum_count,
+            ]
+            for level in chain.levels
+        ],
+    }
+
+
+def chain_from_definition(institution_id, action_id, version, definition) -> ApprovalChain:
+    levels = []
+    for row in definition["levels"]:
+        # fields added later are missing from older definitions and take
+        # their defaults
+        level = dict(zip(DEFINITION_LEVEL_FIELDS, row))
+        for field in ("role_ids", "approver_profile_ids", "approver_user_ids"):
+            level[field] = frozenset(level[field])
+        if level["sla"] is not None:
+            level["sla"] = timedelta(seconds=level["sla"])
+        levels.append(ApprovalLevel(**level))
+    return ApprovalChain(
+        institution_id=institution_id,
+        action_id=action_id,
+        owner_id=definition["owner"],
+        version=version,
+        levels=tuple(levels),
+    )
+
+
+def _definition_key(definition_id):
+    return f"workflows:definition:{CHAIN_FORMAT}:{definition_id}"
+
+
+def _definition_id_key(institution_id, action_id, version):
+    return f"workflows:definition-id:{institution_id}:{action_id}:{version}"
+
+
+def freeze_chain(chain) -> int:
+    """
+    Id of the `WorkflowDefinition` holding `chain`, recording a new version
+    when the chain differs from every stored one. Chains from
+    `get_approval_chain` are mapped to their definition in the shared cache,
+    so starting workflows on an unchanged chain costs no query.
+    """
+    from django.db import IntegrityError
+    from django.db.models import Max
+
+    from workflows.models import WorkflowDefinition
+
+    id_key = _definition_id_key(chain.institution_id, chain.action_id, chain.version)
+    if chain.version:
+        definition_id = _cache_get(id_key)
+        if definition_id is not None:
+            return definition_id
+
+    definition = chain_to_definition(chain)
+    digest = hashlib.sha256(
+        json.dumps(definition, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+    definitions = WorkflowDefinition.objects.filter(
+        Institution_id=chain.institution_id, action_id=chain.action_id
+    )
+    definition_id = definitions.filter(digest=digest).values_list("id", flat=True).first()
+    attempts = 0
+    while definition_id is None:
+        attempts += 1
+        latest = definitions.aggregate(Max("version"))["version__max"] or 0
+        try:
+            with transaction.atomic():
+                definition_id = WorkflowDefinition.objects.create(
+                    Institution_id=chain.institution_id,
+                    action_id=chain.action_id,
+                    version=latest + 1,
+                    digest=digest,
+                    definition=definition,
+                ).id
+        except IntegrityError:
+            # another process stored this chain, or took the version number;
+            # anything else (say the Institution is gone) fails every time
+            if attempts >= FREEZE_ATTEMPTS:
+                raise
+            definition_id = definitions.filter(digest=digest).values_list("id", flat=True).first()
+
+    if chain.version:
+        # only once the row is sure to exist
+        transaction.on_commit(lambda: _cache_set(id_key, definition_id))
+    return definition_id
+
+
+def get_definition_chain(definition_id) -> ApprovalChain:
+    """The chain frozen in a `WorkflowDefinition`."""
+    from workflows.models import WorkflowDefinition
+
+    local_key = ("definition", definition_id)
+    with _local_lock:
+        chain = _local_chains.get(local_key)
+    if chain is not None:
+        return chain
+
+    shared_key = _definition_key(definition_id)
+    chain = _cache_get(shared_key)
+    if chain is None:
+        institution_id, action_id, version, definition = WorkflowDefinition.objects.values_list(
+            "Institution_id", "action_id", "version", "definition"
+        ).get(pk=definition_id)
+        chain = chain_from_definition(institution_id, action_id, version, definition)
+        _cache_set(shared_key, chain)
+
+    with _local_lock:
+        _local_chains[local_key] = chain
+    return chain
+
+
+def get_chain_for_task(task) -> ApprovalChain:
+    """The chain `task` is evaluated against: its definition, or the live steps for older tasks."""
+    if task.definition_id:
+        return get_definition_chain(task.definition_id)
+    return get_chain_for_step(task.step)
+
+
+def bump_chain_version(institution_id, action_id):
+    """Invalidate the chain for (institution, action) once the current transaction commits."""
+
+    def _bump():
+        key = _version_key(institution_id, action_id)
+        try:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.add(key, time.time_ns(), timeout=None)
+        except Exception as e:
+            # the change is committed; other processes keep the old chain
+            # until its version is bumped again or expires from the cache
+            logger.error(f"Could not invalidate chain {institution_id}/{action_id}: {e}")
+
+    transaction.on_commit(_bump)
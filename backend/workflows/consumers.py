@@ -1,81 +1,188 @@
+import asyncio
 import json
+import logging
+
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from django.db.models import Q
-from .models import ApprovalTask
-from .serializers import ApprovalTaskSerializer
+
+from . import presence
+from .deltas import build_task_snapshot
+from .framing import (
+    BINARY_SUBPROTOCOL,
+    binary_frames_available,
+    decode_frame,
+    dictionary_frame,
+    encode_frame,
+)
+from .notifications import user_group
+
+logger = logging.getLogger(__name__)
+
+# Frames of these types are held for up to BATCH_WINDOW_SECONDS and sent
+# together; every other type, and events published with "urgent": True, go
+# out at once.
+BATCHED_FRAME_TYPES = frozenset({"notification", "tasks_delta"})
+BATCH_WINDOW_SECONDS = 0.05
+BATCH_MAX_SIZE = 50
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
-    pass
-    # def __init__(self, *args, **kwargs):
-    #     super().__init__(*args, **kwargs)
-    #     self.notification_group = None
-    #     self.user = None
-
-    # async def connect(self):
-    #     self.user = self.scope["user"]
-
-    #     if isinstance(self.user, AnonymousUser) or not self.user.is_authenticated:
-    #         await self.close()
-    #         return
-
-    #     self.notification_group = f"user_{self.user.id}_notifications"
-
-    #     await self.channel_layer.group_add(self.notification_group, self.channel_name)
-
-    #     await self.accept()
-
-    #     tasks = await self.get_user_tasks()
-    #     await self.send(text_data=json.dumps({"type": "initial_tasks", "tasks": tasks}))
-
-    # async def disconnect(self, close_code):
-    #     if self.notification_group:
-    #         try:
-    #             await self.channel_layer.group_discard(
-    #                 self.notification_group, self.channel_name
-    #             )
-    #         except Exception as e:
-    #             print(f"Error in disconnect(): {e}")
-
-    #     else:
-    #         print("No notification group set, Skipping....")
-
-    # async def receive(self, text_data):
-    #     data = json.loads(text_data)
-    #     message_type = data.get("type", "")
-
-    #     if message_type == "fetch_tasks":
-    #         tasks = await self.get_user_tasks()
-    #         await self.send(
-    #             text_data=json.dumps({"type": "tasks_data", "tasks": tasks})
-    #         )
-
-    # async def notification_message(self, event):
-    #     await self.send(
-    #         text_data=json.dumps(
-    #             {
-    #                 "type": "notification",
-    #                 "message": event["message"],
-    #                 "task": event.get("task", None),
-    #             }
-    #         )
-    #     )
-
-    # async def tasks_update(self, event):
-    #     await self.send(
-    #         text_data=json.dumps({"type": "tasks_update", "tasks": event["tasks"]})
-    #     )
-
-    # @database_sync_to_async
-    # def get_user_tasks(self):
-    #     user = self.user
-    #     user_roles = user.user_roles.values_list("role_id", flat=True)
-
-    #     tasks = ApprovalTask.objects.filter(
-    #         Q(step__roles__approver_role__id__in=user_roles)
-    #         | Q(step__approver__approver_user__user__id=user.id)
-    #     ).distinct()
-
-    #     serializer = ApprovalTaskSerializer(tasks, many=True)
-    #     return serializer.data
+    """
+    Per-user notification socket.
+
+    On connect the user joins their notification group, is registered in
+    `workflows.presence` and receives a `tasks_snapshot`; afterwards
+    `notification` and `tasks_delta` frames arrive as they are published.
+    The client sends `{"type": "resync"}` to get a new snapshot when it
+    detects a gap in `seq`.
+
+    Frames that arrive close together are coalesced into one
+    `{"type": "batch", "frames": [...]}` frame, in the order they were
+    published, so approving a batch of work does not flood the client.
+
+    Clients offering the `workflows.framing.BINARY_SUBPROTOCOL` subprotocol
+    get the same frames as compact MessagePack binary messages.
+    """
+
+    batched_frame_types = BATCHED_FRAME_TYPES
+    batch_window = BATCH_WINDOW_SECONDS
+    batch_max_size = BATCH_MAX_SIZE
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.notification_group = None
+        self.user = None
+        self.heartbeat_task = None
+        self.pending_frames = []
+        self.flush_task = None
+        self.binary_frames = False
+
+    async def connect(self):
+        self.user = self.scope.get("user")
+
+        if self.user is None or isinstance(self.user, AnonymousUser) or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.notification_group = user_group(self.user.id)
+
+        await self.channel_layer.group_add(self.notification_group, self.channel_name)
+
+        self.binary_frames = binary_frames_available() and BINARY_SUBPROTOCOL in self.scope.get(
+            "subprotocols", ()
+        )
+        if self.binary_frames:
+            await self.accept(subprotocol=BINARY_SUBPROTOCOL)
+            await self.send(bytes_data=dictionary_frame())
+        else:
+            await self.accept()
+
+        # Register before taking the snapshot: anything published from now on
+        # reaches this socket, anything earlier is in the snapshot.
+        await sync_to_async(presence.user_connected)(self.user.id)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+
+        await self.send_snapshot()
+
+    async def disconnect(self, close_code):
+        if self.notification_group is None:
+            return
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        if self.flush_task:
+            # the client resyncs on reconnect
+            self.flush_task.cancel()
+        try:
+            await sync_to_async(presence.user_disconnected)(self.user.id)
+            await self.channel_layer.group_discard(self.notification_group, self.channel_name)
+        except Exception as e:
+            logger.warning(f"Error leaving {self.notification_group}: {e}")
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(presence.PRESENCE_HEARTBEAT_SECONDS)
+            try:
+                await sync_to_async(presence.heartbeat)(self.user.id)
+            except Exception as e:
+                logger.warning(f"Presence heartbeat for user {self.user.id} failed: {e}")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if bytes_data is not None and self.binary_frames:
+                data = decode_frame(bytes_data)
+            else:
+                data = json.loads(text_data or "{}")
+        except (ValueError, IndexError):
+            return
+        message_type = data.get("type", "") if isinstance(data, dict) else ""
+
+        # the client missed a tasks_delta (seq gap) or was told to resync
+        if message_type in ("resync", "fetch_tasks"):
+            await self.send_snapshot()
+
+    async def send_snapshot(self):
+        snapshot = await self.get_task_snapshot()
+        # deltas still buffered are older than the snapshot
+        await self.flush_frames()
+        await self.send_frame(snapshot)
+
+    async def send_frame(self, frame):
+        if self.binary_frames:
+            await self.send(bytes_data=encode_frame(frame))
+        else:
+            await self.send(text_data=json.dumps(frame, default=str))
+
+    async def queue_frame(self, frame, urgent=False):
+        """Send `frame` with the next batch, or straight away if it is urgent."""
+        if urgent or frame["type"] not in self.batched_frame_types or self.batch_window <= 0:
+            await self.flush_frames()
+            await self.send_frame(frame)
+            return
+
+        self.pending_frames.append(frame)
+        if len(self.pending_frames) >= self.batch_max_size:
+            await self.flush_frames()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_after(self.batch_window))
+
+    async def flush_after(self, delay):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self.flush_frames()
+
+    async def flush_frames(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        frames, self.pending_frames = self.pending_frames, []
+        if len(frames) == 1:
+            await self.send_frame(frames[0])
+        elif frames:
+            await self.send_frame({"type": "batch", "frames": frames})
+
+    async def notification_message(self, event):
+        await self.queue_frame(
+            {
+                "type": "notification",
+                "message": event["message"],
+                "task": event.get("task", None),
+            },
+            urgent=event.get("urgent", False),
+        )
+
+    async def tasks_delta(self, event):
+        await self.queue_frame(
+            {
+                "type": "tasks_delta",
+                "seq": event["seq"],
+                "resync": event["resync"],
+                "changes": event["changes"],
+            },
+            urgent=event.get("urgent", False),
+        )
+
+    @database_sync_to_async
+    def get_task_snapshot(self):
+        return build_task_snapshot(self.user.id)
@@ -0,0 +1,254 @@
+"""
+Versioned task-list deltas for the notifications websocket.
+
+Instead of re-serialising a user's whole task list after every change, the
+server sends `tasks_delta` frames describing only the tasks that changed:
+
+    {"type": "tasks_delta", "seq": 42, "resync": false, "changes": [
+        {"op": "added", "task": {...inbox row...}},
+        {"op": "status_changed", "task": {...inbox row...}},
+        {"op": "removed", "task": {"id": 7}},
+    ]}
+
+`seq` is a per-user counter kept in the shared cache, so every process agrees
+on it. A client remembers the last `seq` it applied; when a frame arrives
+with anything other than `last + 1` it has missed something (or the counter
+was evicted) and sends `{"type": "resync"}` to get a `tasks_snapshot`, which
+carries the newest tasks together with the `seq` they are current to.
+Frames with `"resync": true` carry no changes and ask for the same thing;
+they are sent when a change touches more than `DELTA_MAX_CHANGES` of a
+user's tasks.
+
+Changes are passed around as `{user_id: {task_id: op}}`, with `RESYNC` in
+place of the inner dict for users that should simply re-fetch. Users without
+an open socket (`workflows.presence`) are dropped before anything is
+serialised; their snapshot on connect covers what they missed.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+from workflows.presence import online_user_ids
+
+ADDED = "added"
+STATUS_CHANGED = "status_changed"
+REMOVED = "removed"
+RESYNC = "resync"
+
+# A user touched by more tasks than this in one frame is told to resync
+DELTA_MAX_CHANGES = 100
+SNAPSHOT_LIMIT = 200
+
+_delta_buffer = threading.local()
+
+
+def _sequence_key(user_id):
+    return f"workflows:task-seq:{user_id}"
+
+
+def current_sequence(user_id) -> int:
+    """The last `seq` sent to the user, 0 if none has been sent."""
+    return cache.get_or_set(_sequence_key(user_id), 0, timeout=None)
+
+
+def next_sequence(user_id) -> int:
+    key = _sequence_key(user_id)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        return cache.incr(key)
+
+
+def _merge_op(previous, op):
+    # a task that is new to the client stays "added" until it is removed
+    if previous == ADDED and op == STATUS_CHANGED:
+        return ADDED
+    if previous == REMOVED and op != REMOVED:
+        return ADDED
+    return op
+
+
+def merge_changes(into, changes):
+    """
+    Merge `changes` into `into` in place; both are `{user_id: {task_id: op}}`.
+    A task added and then removed drops out, later ops otherwise win.
+    """
+    for user_id, tasks in changes.items():
+        current = into.get(user_id)
+        if current == RESYNC:
+            continue
+        if tasks == RESYNC or len(tasks) + len(current or ()) > DELTA_MAX_CHANGES:
+            into[user_id] = RESYNC
+            continue
+        current = into.setdefault(user_id, {})
+        for task_id, op in tasks.items():
+            previous = current.get(task_id)
+            if previous == ADDED and op == REMOVED:
+                # added and removed before the client heard of it
+                del current[task_id]
+            else:
+                current[task_id] = _merge_op(previous, op)
+        if not current:
+            del into[user_id]
+    return into
+
+
+def changes_for(user_ids, task_ids, op):
+    """The same `op` on `task_ids` for every user in `user_ids`."""
+    task_ids = list(task_ids)
+    if not task_ids:
+        return {}
+    if len(task_ids) > DELTA_MAX_CHANGES:
+        return {user_id: RESYNC for user_id in user_ids}
+    return {user_id: {task_id: op for task_id in task_ids} for user_id in user_ids}
+
+
+def assignee_changes(task_ids, op):
+    """`op` on each of `task_ids` for the users it is assigned to."""
+    from workflows.models import ApprovalTaskAssignment
+
+    changes = {}
+    for user_id, task_id in ApprovalTaskAssignment.objects.filter(
+        task_id__in=list(task_ids)
+    ).values_list("user_id", "task_id"):
+        merge_changes(changes, {user_id: {task_id: op}})
+    return changes
+
+
+def encode_changes(changes):
+    """JSON-safe form of `changes`, for the notification outbox."""
+    return {
+        str(user_id): tasks if tasks == RESYNC else {str(t): op for t, op in tasks.items()}
+        for user_id, tasks in changes.items()
+    }
+
+
+def decode_changes(payload):
+    return {
+        int(user_id): tasks if tasks == RESYNC else {int(t): op for t, op in tasks.items()}
+        for user_id, tasks in payload.items()
+    }
+
+
+def task_rows(task_ids):
+    """Inbox rows of `task_ids`, keyed by task id."""
+    from workflows.serializers import ApprovalTaskInboxSerializer, approval_task_row_queryset
+
+    if not task_ids:
+        return {}
+    tasks = approval_task_row_queryset().filter(id__in=task_ids)
+    return {row["id"]: row for row in ApprovalTaskInboxSerializer(tasks, many=True).data}
+
+
+def delta_messages(changes):
+    """Build one `(group, tasks_delta)` pair per user in `changes`."""
+    from workflows.notifications import user_group
+
+    rows = task_rows(
+        {
+            task_id
+            for tasks in changes.values()
+            if tasks != RESYNC
+            for task_id, op in tasks.items()
+            if op != REMOVED
+        }
+    )
+
+    messages = []
+    for user_id, tasks in changes.items():
+        delta = []
+        if tasks != RESYNC:
+            for task_id, op in sorted(tasks.items()):
+                if op == REMOVED:
+                    delta.append({"op": REMOVED, "task": {"id": task_id}})
+                elif task_id in rows:
+                    delta.append({"op": op, "task": rows[task_id]})
+                else:
+                    # deleted since the change was recorded
+                    delta.append({"op": REMOVED, "task": {"id": task_id}})
+        messages.append(
+            (
+                user_group(user_id),
+                {
+                    "type": "tasks_delta",
+                    "seq": next_sequence(user_id),
+                    "resync": tasks == RESYNC,
+                    "changes": delta,
+                },
+            )
+        )
+    return messages
+
+
+@contextmanager
+def coalesced_task_deltas():
+    """Collect `send_task_deltas` calls and send one merged frame per user on exit"""
+    if getattr(_delta_buffer, "changes", None) is not None:
+        # already coalescing further up the stack
+        yield
+        return
+
+    _delta_buffer.changes = {}
+    try:
+        yield
+        changes = _delta_buffer.changes
+    finally:
+        _delta_buffer.changes = None
+    _send(changes)
+
+
+def send_task_deltas(changes):
+    """Send `tasks_delta` frames for `changes`, or buffer them while coalescing."""
+    buffered = getattr(_delta_buffer, "changes", None)
+    if buffered is not None:
+        merge_changes(buffered, changes)
+        return
+    _send(changes)
+
+
+def _send(changes):
+    # offline users get a fresh snapshot when they connect; skip their seq
+    # bump and rows
+    online_users = online_user_ids(changes)
+    changes = {user_id: tasks for user_id, tasks in changes.items() if user_id in online_users}
+    if changes:
+        from workflows.notifications import fan_out
+
+        fan_out(delta_messages(changes))
+
+
+def enqueue_task_deltas(changes):
+    """Record `changes` in the notification outbox, delivered after commit."""
+    if changes:
+        from workflows.outbox import enqueue
+
+        enqueue("task_deltas", changes=encode_changes(changes))
+
+
+def build_task_snapshot(user_id, limit=SNAPSHOT_LIMIT):
+    """
+    The `tasks_snapshot` frame sent on connect and on resync: the user's
+    `limit` most recently updated tasks and the `seq` they reflect. Older
+    tasks are paged from the inbox endpoint.
+    """
+    from workflows.models import ApprovalTaskAssignment
+    from workflows.serializers import ApprovalTaskInboxSerializer, approval_task_row_queryset
+
+    # Read the sequence first: a delta racing with the query below is then
+    # re-applied on top of the snapshot, which is harmless as ops are upserts.
+    seq = current_sequence(user_id)
+    task_ids = list(
+        ApprovalTaskAssignment.objects.filter(user_id=user_id)
+        .order_by("-task_updated_at", "-task_id")
+        .values_list("task_id", flat=True)[: limit + 1]
+    )
+    tasks = approval_task_row_queryset().filter(id__in=task_ids[:limit])
+    tasks = sorted(tasks, key=lambda task: (task.updated_at, task.id), reverse=True)
+    return {
+        "type": "tasks_snapshot",
+        "seq": seq,
+        "has_more": len(task_ids) > limit,
+        "tasks": ApprovalTaskInboxSerializer(tasks, many=True).data,
+    }
@@ -0,0 +1,160 @@
+"""
+SLA escalation of pending approval tasks.
+
+A task that becomes pending on a step with an `sla` gets a `due_at`.
+`EscalationScheduler` keeps the deadlines falling inside a short lookahead
+window in a heap, read from the partial `due_at` index, and sleeps until the
+next one. The work it does follows the number of tasks coming due, not the
+size of the task table. An overdue task is escalated according to its step's
+`escalation_action`:
+
+- `notify`: its approvers are reminded that it is overdue
+- `reassign`: users holding the step's `escalation_role` (or the institution
+  owner) are assigned to it and may act on it
+- `auto_advance`: it is approved without an approver and the next level starts
+
+Escalation is claimed with a conditional UPDATE on `escalated_at`, so several
+schedulers can run side by side and a task is escalated at most once.
+"""
+import asyncio
+import heapq
+import logging
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from workflows.events import record_events, task_event
+from workflows.models import ApprovalTask
+
+logger = logging.getLogger(__name__)
+
+ESCALATION_LOOKAHEAD = timedelta(minutes=10)
+ESCALATION_REFRESH_SECONDS = 30
+ESCALATION_BATCH_SIZE = 1000
+AUTO_ADVANCE_COMMENT = "Approved automatically after the approval deadline passed."
+
+
+def due_tasks(until, limit=ESCALATION_BATCH_SIZE):
+    """`(due_at, task_id)` of unescalated pending tasks due by `until`, earliest first."""
+    return list(
+        ApprovalTask.objects.filter(
+            status="pending", escalated_at__isnull=True, due_at__lte=until
+        )
+        .order_by("due_at")
+        .values_list("due_at", "id")[:limit]
+    )
+
+
+def escalate_task(task_id, now=None):
+    """
+    Escalate one overdue task. Returns the escalation action taken, or None
+    if the task was approved, rejected or escalated in the meantime.
+    """
+    from workflows.assignments import escalate_assignments
+    from workflows.chain import get_chain_for_task
+    from workflows.outbox import enqueue
+    from users.models import UserRole
+
+    now = now or timezone.now()
+    with db_transaction.atomic():
+        claimed = ApprovalTask.objects.filter(
+            pk=task_id, status="pending", escalated_at__isnull=True, due_at__lte=now
+        ).update(escalated_at=now)
+        if not claimed:
+            return None
+
+        task = ApprovalTask.objects.select_related("step").get(pk=task_id)
+        chain = get_chain_for_task(task)
+        level = chain.level_for_step(task.step_id)
+        action = level.escalation_action if level else "notify"
+        record_events(
+            [
+                task_event(
+                    task.id, task.step.Institution_id, "pending", "pending", at=now, escalation=action
+                )
+            ]
+        )
+
+        if action == "auto_advance":
+            task.comment = AUTO_ADVANCE_COMMENT
+            task.mark_completed(None)
+        elif action == "reassign":
+            if level.escalation_role_id:
+                user_ids = UserRole.objects.filter(
+                    role_id=level.escalation_role_id
+                ).values_list("user_id", flat=True)
+            else:
+                user_ids = [chain.owner_id]
+            escalate_assignments(task, user_ids)
+
+        enqueue("task_escalated", task_id=task.id, action=action)
+    return action
+
+
+class EscalationScheduler:
+    """Heap of upcoming deadlines, refilled from the database every `refresh` seconds."""
+
+    def __init__(
+        self,
+        lookahead=ESCALATION_LOOKAHEAD,
+        refresh=ESCALATION_REFRESH_SECONDS,
+        batch_size=ESCALATION_BATCH_SIZE,
+    ):
+        self.lookahead = lookahead
+        self.refresh_seconds = refresh
+        self.batch_size = batch_size
+        self.heap = []
+        self.queued = set()
+
+    async def refresh(self):
+        rows = await database_sync_to_async(due_tasks)(
+            timezone.now() + self.lookahead, self.batch_size
+        )
+        for due_at, task_id in rows:
+            if task_id not in self.queued:
+                heapq.heappush(self.heap, (due_at, task_id))
+                self.queued.add(task_id)
+        return len(rows)
+
+    async def run_due(self):
+        """Escalate every queued task that is now due. Returns how many were escalated."""
+        escalated = 0
+        now = timezone.now()
+        while self.heap and self.heap[0][0] <= now:
+            _, task_id = heapq.heappop(self.heap)
+            self.queued.discard(task_id)
+            try:
+                action = await database_sync_to_async(escalate_task)(task_id, now)
+            except Exception as e:
+                # left unescalated, so the next refresh queues it again
+                logger.warning(f"Escalating approval task {task_id} failed: {e}")
+                continue
+            if action:
+                logger.info(f"Escalated approval task {task_id}: {action}")
+                escalated += 1
+        return escalated
+
+    def seconds_until_next(self):
+        if not self.heap:
+            return self.refresh_seconds
+        return max((self.heap[0][0] - timezone.now()).total_seconds(), 0)
+
+    async def run(self, once=False):
+        loop = asyncio.get_running_loop()
+        next_refresh = 0
+        while True:
+            backlog = False
+            if loop.time() >= next_refresh:
+                backlog = await self.refresh() >= self.batch_size
+                next_refresh = loop.time() + self.refresh_seconds
+            escalated = await self.run_due()
+            if once:
+                return
+            if backlog and escalated:
+                # more overdue tasks than one batch; fetch the next straight away
+                next_refresh = loop.time()
+            await asyncio.sleep(
+                min(self.seconds_until_next(), max(next_refresh - loop.time(), 0))
+            )
@@ -0,0 +1,103 @@
+"""
+Binary frames for the notifications websocket.
+
+Frames are JSON text by default. A client that offers the
+`BINARY_SUBPROTOCOL` websocket subprotocol instead receives MessagePack
+binary frames in which every map key found in `FIELD_NAMES` is replaced by
+its index in that tuple. Inbox rows and the nested task, step and approver
+payloads repeat the same few dozen keys, so this roughly halves a frame
+before compression.
+
+The first frame on a binary connection is
+`{"type": "fields", "fields": FIELD_NAMES}` with plain string keys, so
+clients need not hard-code the dictionary. Keys missing from it are sent
+as strings; other keys (e.g. step ids) are converted the way `json.dumps`
+converts them, since an int key stands for a field name. `FIELD_NAMES` is append-only; reordering it needs a new
+subprotocol version.
+
+msgpack is optional. Without it the subprotocol is not offered and every
+client gets JSON.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BINARY_SUBPROTOCOL = "workflows.msgpack.v1"
+
+FIELD_NAMES = (
+    # frames
+    "type", "seq", "resync", "changes", "op", "task", "tasks", "has_more",
+    "message", "frames",
+    # inbox rows
+    "id", "status", "updated_at", "institution", "step", "step_name", "level",
+    "action", "action_label", "content_type", "object_id", "content_object",
+    "approved_by", "comment",
+    # ApprovalTaskSerializer
+    "Institution", "action_details", "code", "label", "category", "roles",
+    "roles_details", "approvers", "approvers_details", "sla",
+    "escalation_action", "escalation_role", "quorum", "quorum_count",
+    # approvers: ProfileSerializer / CustomUserSerializer
+    "approver_user", "user", "bio", "email", "fullname", "is_active",
+    "is_email_verified", "is_password_verified", "is_staff", "permissions",
+    "permissions_details", "branches", "name", "description",
+    # BranchSerializer
+    "branch_name", "branch_location", "branch_email", "branch_phone_number",
+    "branch_latitude", "branch_longitude", "branch_opening_time",
+    "branch_closing_time", "institution_name",
+)
+FIELD_INDEX = {name: index for index, name in enumerate(FIELD_NAMES)}
+
+
+def binary_frames_available():
+    return msgpack is not None
+
+
+_SCALARS = frozenset({str, int, float, bool, type(None)})
+
+
+def _compact_key(key):
+    index = FIELD_INDEX.get(key)
+    if index is not None:
+        return index
+    return key if type(key) is str else json.dumps(key)
+
+
+def compact(value):
+    """Replace dictionary keys by their `FIELD_NAMES` index, recursively."""
+    # scalars are most of a frame; skip the call for them
+    if isinstance(value, dict):
+        return {
+            _compact_key(key): item if type(item) in _SCALARS else compact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [item if type(item) in _SCALARS else compact(item) for item in value]
+    return value
+
+
+def expand(value):
+    """Undo `compact`."""
+    if isinstance(value, dict):
+        return {
+            FIELD_NAMES[key] if isinstance(key, int) else key: expand(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    return value
+
+
+def dictionary_frame():
+    return msgpack.packb({"type": "fields", "fields": FIELD_NAMES})
+
+
+def encode_frame(frame):
+    # default=str mirrors json.dumps(default=str) on the text protocol
+    return msgpack.packb(compact(frame), default=str)
+
+
+def decode_frame(data):
+    return expand(msgpack.unpackb(data, strict_map_key=False))
@@ -0,0 +1,71 @@
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand
+
+from workflows.notifications import fan_out
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the per-recipient cost of workflow notification fan-out: one "
+        "async_to_sync(group_send) per recipient versus a single fan_out() call"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--recipients", type=int, nargs="+", default=[10, 100, 1000]
+        )
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--configured-layer",
+            action="store_true",
+            help="Use the CHANNEL_LAYERS backend instead of an in-memory layer.",
+        )
+
+    def handle(self, *args, **options):
+        if options["configured_layer"]:
+            channel_layer = get_channel_layer()
+        else:
+            channel_layer = InMemoryChannelLayer(capacity=options["repeat"] * 2 + 10)
+        self.stdout.write(f"Channel layer: {type(channel_layer).__name__}")
+        self.stdout.write(
+            f"{'recipients':>10} {'per-send us/recipient':>22} {'fan_out us/recipient':>21} {'speedup':>8}"
+        )
+
+        for count in options["recipients"]:
+            prefix = f"bench_{uuid.uuid4().hex[:8]}"
+            groups = [f"{prefix}_{i}" for i in range(count)]
+            for group in groups:
+                async_to_sync(channel_layer.group_add)(group, f"{prefix}.channel.{group}")
+            message = {"type": "notification_message", "message": "benchmark"}
+
+            looped = self.best_of(
+                options["repeat"],
+                lambda: [
+                    async_to_sync(channel_layer.group_send)(group, message)
+                    for group in groups
+                ],
+            )
+            batched = self.best_of(
+                options["repeat"],
+                lambda: fan_out(((group, message) for group in groups), channel_layer),
+            )
+
+            for group in groups:
+                async_to_sync(channel_layer.group_discard)(group, f"{prefix}.channel.{group}")
+
+            self.stdout.write(
+                f"{count:>10} {looped / count * 1e6:>22.1f} {batched / count * 1e6:>21.1f} "
+                f"{looped / batched:>7.1f}x"
+            )
+
+    def best_of(self, repeat, func):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        return min(timings)
@@ -0,0 +1,310 @@
+import json
+import statistics
+import subprocess
+import time
+import uuid
+from contextlib import contextmanager
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction as db_transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from institution.models import Institution
+from users.models import CustomUser, Profile, Role, UserRole
+from workflows.models import (
+    ApprovalTask,
+    InstitutionApprovalStep,
+    InstitutionApprovalStepApprovorRole,
+    WorkflowAction,
+    WorkflowCategory,
+)
+from workflows.services import start_workflow
+from workflows.views import (
+    ApproveTaskAPIView,
+    InstitutionApprovalStepAPIView,
+    InstitutionApprovalStepReorderAPIView,
+)
+
+
+@contextmanager
+def _no_op_finish_workflow(model):
+    # The benchmark approves users, which have no finish_workflow(); the
+    # engine is measured, not the domain hook it ends with.
+    installed = not hasattr(model, "finish_workflow")
+    if installed:
+        model.finish_workflow = lambda self: None
+    try:
+        yield
+    finally:
+        if installed:
+            del model.finish_workflow
+
+
+def _percentile(values, quantile):
+    values = sorted(values)
+    return values[min(int(quantile * len(values)), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the approval workflow engine: seed institutions, steps and tasks "
+        "in a transaction, time the approval path and count its queries, write a "
+        "JSON report and roll everything back. Compare reports across commits with "
+        "--baseline to catch N+1 queries and new row locks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--institutions", type=int, default=2)
+        parser.add_argument("--steps", type=int, default=3, help="Steps per action.")
+        parser.add_argument(
+            "--tasks", type=int, default=200, help="Objects put through the workflow per institution."
+        )
+        parser.add_argument("--repeat", type=int, default=20, help="Samples per operation.")
+        parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+        parser.add_argument(
+            "--baseline",
+            help="Earlier report to compare with; fails if an operation now runs more queries.",
+        )
+
+    def handle(self, *args, **options):
+        if options["steps"] < 2:
+            raise CommandError("--steps must be at least 2 so there is something to reorder")
+        if options["tasks"] < 2:
+            raise CommandError("--tasks must be at least 2")
+
+        self.factory = APIRequestFactory()
+        results = {}
+        with db_transaction.atomic():
+            with _no_op_finish_workflow(CustomUser):
+                fixtures = self.seed(options)
+                self.stderr.write(
+                    f"Seeded {len(fixtures)} institution(s) with {options['steps']} step(s) "
+                    f"and {options['tasks']} object(s) each"
+                )
+                results["start_workflow"] = self.run_start(fixtures)
+                results["mark_completed"] = self.run_decisions(fixtures, "completed", options["repeat"])
+                results["mark_rejected"] = self.run_decisions(fixtures, "rejected", options["repeat"])
+                results["inbox_get"] = self.run_inbox(fixtures, options["repeat"])
+                results["step_list_get"] = self.run_step_list(fixtures, options["repeat"])
+                # last: step edits only invalidate cached chains on commit
+                results["reorder_patch"] = self.run_reorder(fixtures, options["repeat"])
+            db_transaction.set_rollback(True)
+
+        report = {
+            "meta": {
+                "created_at": timezone.now().isoformat(),
+                "git_commit": self.git_commit(),
+                "database": connection.vendor,
+                "django": django.get_version(),
+                "parameters": {
+                    name: options[name] for name in ("institutions", "steps", "tasks", "repeat")
+                },
+            },
+            "operations": {name: self.summarise(samples) for name, samples in results.items()},
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+        if options["baseline"]:
+            self.compare(report, options["baseline"])
+
+    def seed(self, options):
+        token = uuid.uuid4().hex[:8]
+        category = WorkflowCategory.objects.create(code=f"bench-{token}", label="Benchmark")
+        action = WorkflowAction.objects.create(
+            category=category, code=f"bench-{token}", label="Benchmark"
+        )
+
+        fixtures = []
+        for i in range(options["institutions"]):
+            owner = CustomUser.objects.create(
+                email=f"bench-{token}-{i}-owner@example.invalid", fullname="Benchmark owner"
+            )
+            institution = Institution.objects.create(
+                institution_owner=owner,
+                institution_name=f"Benchmark {token} {i}",
+                created_by=owner,
+            )
+            steps, approvers = [], []
+            for level in range(1, options["steps"] + 1):
+                approver = CustomUser.objects.create(
+                    email=f"bench-{token}-{i}-{level}@example.invalid",
+                    fullname=f"Benchmark approver {level}",
+                )
+                Profile.objects.create(user=approver, institution=institution)
+                role = Role.objects.create(
+                    name=f"Benchmark level {level}", description="", institution=institution
+                )
+                UserRole.objects.create(user=approver, role=role)
+                step = InstitutionApprovalStep.objects.create(
+                    Institution=institution, step_name=f"Level {level}", action=action, level=level
+                )
+                InstitutionApprovalStepApprovorRole.objects.create(step=step, approver_role=role)
+                steps.append(step)
+                approvers.append(approver)
+
+            objects = CustomUser.objects.bulk_create(
+                CustomUser(
+                    email=f"bench-{token}-{i}-object-{n}@example.invalid",
+                    fullname=f"Benchmark object {n}",
+                )
+                for n in range(options["tasks"])
+            )
+            fixtures.append(
+                {
+                    "action": action,
+                    "institution": institution,
+                    "owner": owner,
+                    "steps": steps,
+                    "approvers": approvers,
+                    "objects": objects,
+                }
+            )
+        return fixtures
+
+    def measure(self, func):
+        """`(seconds, queries, locking queries)` of one call."""
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+        locking = sum("FOR UPDATE" in query["sql"] for query in queries.captured_queries)
+        return elapsed, len(queries.captured_queries), locking
+
+    def run_start(self, fixtures):
+        return [
+            self.measure(
+                lambda fixture=fixture: start_workflow(
+                    fixture["action"].code, fixture["institution"], fixture["objects"]
+                )
+            )
+            for fixture in fixtures
+        ]
+
+    def run_decisions(self, fixtures, decision, repeat):
+        samples = []
+        for n in range(repeat):
+            fixture = fixtures[n % len(fixtures)]
+            task = (
+                ApprovalTask.objects.select_related("step")
+                .filter(step=fixture["steps"][0], status="pending")
+                .first()
+            )
+            if task is None:
+                break
+            approver = fixture["approvers"][0]
+            task.comment = "Benchmark"
+            if decision == "completed":
+                samples.append(self.measure(lambda: task.mark_completed(approver)))
+            else:
+                samples.append(self.measure(lambda: task.mark_rejected(approver)))
+        return samples
+
+    def run_inbox(self, fixtures, repeat):
+        def get(approver):
+            request = self.factory.get("/workflows/task/", {"detail": "row"})
+            force_authenticate(request, approver)
+            ApproveTaskAPIView.as_view()(request).render()
+
+        return [
+            self.measure(lambda n=n: get(fixtures[n % len(fixtures)]["approvers"][1]))
+            for n in range(repeat)
+        ]
+
+    def run_step_list(self, fixtures, repeat):
+        def get(fixture):
+            request = self.factory.get("/")
+            force_authenticate(request, fixture["owner"])
+            InstitutionApprovalStepAPIView.as_view()(
+                request, Institution_id=fixture["institution"].id
+            ).render()
+
+        return [self.measure(lambda n=n: get(fixtures[n % len(fixtures)])) for n in range(repeat)]
+
+    def run_reorder(self, fixtures, repeat):
+        def patch(fixture):
+            # swap the first and last levels, re-levelling every in-flight object
+            steps = sorted(
+                InstitutionApprovalStep.objects.filter(
+                    Institution=fixture["institution"], action=fixture["action"]
+                ).values_list("id", "level"),
+                key=lambda step: step[1],
+            )
+            (first_id, first_level), (last_id, last_level) = steps[0], steps[-1]
+            payload = {
+                "steps": [
+                    {"id": first_id, "level": last_level},
+                    {"id": last_id, "level": first_level},
+                ]
+            }
+            request = self.factory.patch("/", payload, format="json")
+            force_authenticate(request, fixture["owner"])
+            InstitutionApprovalStepReorderAPIView.as_view()(
+                request, Institution_id=fixture["institution"].id
+            ).render()
+
+        return [self.measure(lambda n=n: patch(fixtures[n % len(fixtures)])) for n in range(repeat)]
+
+    def summarise(self, samples):
+        if not samples:
+            return {"samples": 0}
+        timings = [seconds * 1000 for seconds, _, _ in samples]
+        queries = [count for _, count, _ in samples]
+        return {
+            "samples": len(samples),
+            "wall_ms": {
+                "min": round(min(timings), 3),
+                "median": round(statistics.median(timings), 3),
+                "p95": round(_percentile(timings, 0.95), 3),
+                "max": round(max(timings), 3),
+            },
+            "queries": {
+                "min": min(queries),
+                "median": statistics.median(queries),
+                "max": max(queries),
+            },
+            "locking_queries": max(locking for _, _, locking in samples),
+        }
+
+    def compare(self, report, baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["parameters"] != report["meta"]["parameters"]:
+            self.stderr.write(
+                self.style.WARNING("Baseline was run with different parameters; comparing anyway")
+            )
+
+        regressions = []
+        for name, current in report["operations"].items():
+            previous = baseline["operations"].get(name)
+            if not previous or not previous.get("samples") or not current.get("samples"):
+                continue
+            before, after = previous["wall_ms"]["median"], current["wall_ms"]["median"]
+            change = (after - before) / before * 100 if before else 0
+            self.stderr.write(
+                f"{name}: queries {previous['queries']['max']} -> {current['queries']['max']}, "
+                f"locks {previous['locking_queries']} -> {current['locking_queries']}, "
+                f"median {before:.1f}ms -> {after:.1f}ms ({change:+.0f}%)"
+            )
+            if current["queries"]["max"] > previous["queries"]["max"]:
+                regressions.append(f"{name} runs more queries")
+            if current["locking_queries"] > previous["locking_queries"]:
+                regressions.append(f"{name} takes more row locks")
+        if regressions:
+            raise CommandError("Regressions against baseline: " + "; ".join(regressions))
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,50 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from workflows.outbox import OUTBOX_BATCH_SIZE, dispatch_pending, purge_dispatched
+
+
+class Command(BaseCommand):
+    help = "Deliver workflow notifications recorded in the outbox to the channel layer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=OUTBOX_BATCH_SIZE)
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=0.5,
+            help="Seconds to sleep when the outbox is empty.",
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="Drain the outbox once and exit."
+        )
+        parser.add_argument(
+            "--purge-after-days",
+            type=int,
+            default=7,
+            help="Delete delivered events older than this many days (0 keeps them).",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        purge_after = timedelta(days=options["purge_after_days"])
+        last_purge = 0.0
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Dispatching workflow notifications..."))
+        while True:
+            sent, failed = dispatch_pending(batch_size)
+            if sent or failed:
+                self.stdout.write(f"Sent: {sent}, failed: {failed}")
+
+            if options["purge_after_days"] and time.monotonic() - last_purge > 3600:
+                purged = purge_dispatched(purge_after)
+                if purged:
+                    self.stdout.write(f"Purged {purged} delivered event(s)")
+                last_purge = time.monotonic()
+
+            if sent + failed < batch_size:
+                if options["once"]:
+                    break
+                time.sleep(options["interval"])
@@ -0,0 +1,177 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction as db_transaction
+
+
+def _init_worker():
+    # workers are spawned rather than forked, so they never share the
+    # parent's database connection (still streaming ids); set Django up here
+    import django
+
+    django.setup()
+
+
+def _finish_chunk(model_label, ids):
+    """Run `finish_workflow()` on every object in `ids`. Returns (succeeded, failures)."""
+    model = apps.get_model(model_label)
+    succeeded, failures = 0, []
+    for pk, obj in sorted(model.objects.in_bulk(ids).items()):
+        try:
+            with db_transaction.atomic():
+                obj.finish_workflow()
+            succeeded += 1
+        except Exception as e:
+            failures.append((pk, f"{obj}: {e}"))
+    return succeeded, failures
+
+
+class Command(BaseCommand):
+    help = (
+        "Call finish_workflow() on every object of a model, in chunks spread over "
+        "a process pool. Progress and failed ids are checkpointed after each "
+        "chunk, so an interrupted run resumes where it stopped and a later run "
+        "retries the objects that failed."
+    )
+    # subclasses bound to one model set this instead of taking --model
+    model_label = None
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model",
+            default=self.model_label,
+            required=self.model_label is None,
+            help="Model to process, as app_label.ModelName.",
+        )
+        parser.add_argument("--chunk-size", type=int, default=500)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Worker processes; 1 runs in this process.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="Checkpoint file (default: finish_workflows-<model>.json in the working directory).",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore an existing checkpoint and start from the first object.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options["model"])
+        except (LookupError, ValueError):
+            raise CommandError(f"Unknown model {options['model']!r}")
+        if not hasattr(model, "finish_workflow"):
+            raise CommandError(f"{model._meta.label} has no finish_workflow()")
+
+        model_label = model._meta.label
+        chunk_size = options["chunk_size"]
+        workers = max(options["workers"], 1)
+        checkpoint_path = options["checkpoint"] or f"finish_workflows-{model_label}.json"
+
+        state = {"model": model_label, "last_id": None, "succeeded": 0, "failed_ids": []}
+        if not options["restart"] and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                state = json.load(f)
+            if state.get("model") != model_label:
+                raise CommandError(
+                    f"{checkpoint_path} belongs to {state.get('model')}, not {model_label}"
+                )
+            state.setdefault("failed_ids", [])
+            self.stdout.write(
+                f"Resuming {model_label} after id {state['last_id']} "
+                f"({state['succeeded']} finished, {len(state['failed_ids'])} failed to retry)"
+            )
+
+        # objects that failed before are retried first
+        retry_ids = iter(list(state["failed_ids"]))
+        ids = model.objects.order_by("pk")
+        if state["last_id"] is not None:
+            ids = ids.filter(pk__gt=state["last_id"])
+        ids = ids.values_list("pk", flat=True).iterator(chunk_size=chunk_size)
+        chunks = chain(
+            iter(lambda: list(islice(retry_ids, chunk_size)), []),
+            iter(lambda: list(islice(ids, chunk_size)), []),
+        )
+
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(
+                f"Finishing {model_label} workflows with {workers} worker(s)..."
+            )
+        )
+        started = time.monotonic()
+        processed = 0
+
+        for ids_chunk, (succeeded, failures) in self.run_chunks(model_label, chunks, workers):
+            for pk, reason in failures:
+                self.stderr.write(self.style.WARNING(f"Skipped {model_label} {pk}: {reason}"))
+            # retried ids are behind last_id; they leave the list unless they failed again
+            if state["last_id"] is None or ids_chunk[-1] > state["last_id"]:
+                state["last_id"] = ids_chunk[-1]
+            state["succeeded"] += succeeded
+            state["failed_ids"] = sorted(
+                set(state["failed_ids"]).difference(ids_chunk).union(pk for pk, _ in failures)
+            )
+            self.save_checkpoint(checkpoint_path, state)
+
+            processed += len(ids_chunk)
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"Up to id {state['last_id']}: {processed} object(s) in {elapsed:.1f}s "
+                f"({processed / elapsed if elapsed else 0:.0f}/s)"
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Completed: {state['succeeded']}, Failed: {len(state['failed_ids'])}"
+            )
+        )
+        if state["failed_ids"]:
+            self.save_checkpoint(checkpoint_path, state)
+            self.stdout.write(
+                f"Failed ids are kept in {checkpoint_path}; run the command again to retry them."
+            )
+        elif os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def run_chunks(self, model_label, chunks, workers):
+        """
+        Yield `(ids, result)` for each chunk in id order. Chunks run
+        concurrently but are only yielded once every earlier chunk is done,
+        so the checkpoint never skips over unfinished work.
+        """
+        if workers == 1:
+            for ids in chunks:
+                yield ids, _finish_chunk(model_label, ids)
+            return
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        ) as pool:
+            pending = []  # (ids, future) in submission order
+            for ids in chunks:
+                pending.append((ids, pool.submit(_finish_chunk, model_label, ids)))
+                # keep at most two chunks per worker in flight
+                while len(pending) >= workers * 2 or (pending and pending[0][1].done()):
+                    ids, future = pending.pop(0)
+                    yield ids, future.result()
+            for ids, future in pending:
+                yield ids, future.result()
+
+    def save_checkpoint(self, path, state):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,235 @@
+import asyncio
+import json
+import os
+import resource
+import statistics
+import time
+import uuid
+
+import django
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.models import CustomUser
+from workflows import framing
+from workflows.notifications import group_send_many, user_group
+
+IN_MEMORY_CHANNEL_LAYER = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 1000},
+    },
+}
+PATH = "/api/ws/notifications/"
+
+
+def _percentile(values, quantile):
+    values = sorted(values)
+    return values[min(int(quantile * len(values)), len(values) - 1)]
+
+
+def _rss_bytes():
+    """Current resident set size; the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the notifications websocket: open many authenticated sockets against "
+        "core.asgi.application in-process on the in-memory channel layer, fan notifications "
+        "out to all of them and report connect latency, delivery latency percentiles and "
+        "memory per connection as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000, help="Sockets to open.")
+        parser.add_argument(
+            "--concurrency", type=int, default=100, help="Connects in flight at once."
+        )
+        parser.add_argument(
+            "--messages", type=int, default=5, help="Notifications fanned out to every socket."
+        )
+        parser.add_argument(
+            "--interval", type=float, default=0.2, help="Seconds between notifications."
+        )
+        parser.add_argument(
+            "--urgent",
+            action="store_true",
+            help="Publish urgent notifications, which skip the per-socket batching window.",
+        )
+        parser.add_argument(
+            "--binary", action="store_true", help="Negotiate the MessagePack subprotocol."
+        )
+        parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for delivery.")
+        parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+
+    def handle(self, *args, **options):
+        if options["clients"] < 1:
+            raise CommandError("--clients must be at least 1")
+        if options["binary"] and not framing.binary_frames_available():
+            raise CommandError("--binary needs msgpack installed")
+
+        # Consumers read the database from worker threads, which cannot see an
+        # open transaction here: the users are committed and deleted afterwards.
+        prefix = f"loadtest-{uuid.uuid4().hex[:8]}-"
+        users = CustomUser.objects.bulk_create(
+            CustomUser(email=f"{prefix}{n}@example.invalid", fullname=f"Load test {n}")
+            for n in range(options["clients"])
+        )
+        if users[0].pk is None:
+            users = list(CustomUser.objects.filter(email__startswith=prefix).order_by("id"))
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        self.stderr.write(f"Created {len(users)} user(s)")
+
+        try:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYER):
+                from core.asgi import application
+
+                results = asyncio.run(self.run(application, users, tokens, options))
+        finally:
+            CustomUser.objects.filter(email__startswith=prefix).delete()
+
+        report = {
+            "meta": {
+                "created_at": timezone.now().isoformat(),
+                "django": django.get_version(),
+                "parameters": {
+                    name: options[name]
+                    for name in ("clients", "concurrency", "messages", "interval", "urgent", "binary")
+                },
+            },
+            **results,
+        }
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+            self.stderr.write(f"Report written to {options['output']}")
+        else:
+            self.stdout.write(output)
+
+    async def run(self, application, users, tokens, options):
+        subprotocols = [framing.BINARY_SUBPROTOCOL] if options["binary"] else None
+        semaphore = asyncio.Semaphore(options["concurrency"])
+        clients = [None] * len(users)
+        connect_ms = []
+        failures = 0
+
+        async def connect(index):
+            nonlocal failures
+            async with semaphore:
+                communicator = WebsocketCommunicator(
+                    application,
+                    f"{PATH}?token={tokens[index]}",
+                    headers=[(b"origin", b"http://localhost")],
+                    subprotocols=subprotocols,
+                )
+                started = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=options["timeout"])
+                if not connected:
+                    failures += 1
+                    return
+                # connected once the snapshot arrived
+                frames = []
+                while not any(frame["type"] == "tasks_snapshot" for frame in frames):
+                    frames, _ = await self.receive(communicator, options)
+                connect_ms.append((time.perf_counter() - started) * 1000)
+                clients[index] = communicator
+
+        rss_before = await sync_to_async(_rss_bytes)()
+        await asyncio.gather(*(connect(index) for index in range(len(users))))
+        connected = [(user, client) for user, client in zip(users, clients) if client]
+        rss_after = await sync_to_async(_rss_bytes)()
+        self.stderr.write(f"Connected {len(connected)} socket(s), {failures} refused")
+
+        delivery_ms = await self.fan_out(connected, options)
+
+        await asyncio.gather(*(client.disconnect() for _, client in connected))
+
+        expected = len(connected) * options["messages"]
+        return {
+            "connect": {
+                "connected": len(connected),
+                "refused": failures,
+                "latency_ms": self.summarise(connect_ms),
+            },
+            "fan_out": {
+                "expected": expected,
+                "delivered": len(delivery_ms),
+                "latency_ms": self.summarise(delivery_ms),
+            },
+            "memory": {
+                "rss_before_bytes": rss_before,
+                "rss_after_bytes": rss_after,
+                "per_connection_bytes": (
+                    (rss_after - rss_before) // len(connected) if connected else None
+                ),
+            },
+        }
+
+    async def fan_out(self, connected, options):
+        channel_layer = get_channel_layer()
+        delivery_ms = []
+
+        async def listen(client):
+            received = 0
+            while received < options["messages"]:
+                try:
+                    frames, arrived = await self.receive(client, options)
+                except asyncio.TimeoutError:
+                    return
+                for frame in frames:
+                    if frame["type"] == "notification" and frame.get("task"):
+                        delivery_ms.append((arrived - frame["task"]["sent_at"]) * 1000)
+                        received += 1
+
+        listeners = [asyncio.ensure_future(listen(client)) for _, client in connected]
+        for n in range(options["messages"]):
+            message = {
+                "type": "notification_message",
+                "message": f"Load test notification {n}",
+                "task": {"sent_at": time.perf_counter()},
+                "urgent": options["urgent"],
+            }
+            await group_send_many(
+                channel_layer, [(user_group(user.id), message) for user, _ in connected]
+            )
+            await asyncio.sleep(options["interval"])
+        await asyncio.gather(*listeners)
+        return delivery_ms
+
+    async def receive(self, client, options):
+        """The frames of the next websocket message, unbatched, and when it arrived."""
+        output = await client.receive_output(timeout=options["timeout"])
+        arrived = time.perf_counter()
+        if output["type"] != "websocket.send":
+            raise asyncio.TimeoutError(f"Socket closed: {output}")
+        if output.get("bytes") is not None:
+            frame = framing.decode_frame(output["bytes"])
+        else:
+            frame = json.loads(output["text"])
+        if frame["type"] == "batch":
+            return frame["frames"], arrived
+        return [frame], arrived
+
+    def summarise(self, samples):
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "min": round(min(samples), 3),
+            "median": round(statistics.median(samples), 3),
+            "p95": round(_percentile(samples, 0.95), 3),
+            "p99": round(_percentile(samples, 0.99), 3),
+            "max": round(max(samples), 3),
+        }
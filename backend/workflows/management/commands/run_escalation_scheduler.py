@@ -0,0 +1,45 @@
+import asyncio
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from workflows.escalation import (
+    ESCALATION_BATCH_SIZE,
+    ESCALATION_LOOKAHEAD,
+    ESCALATION_REFRESH_SECONDS,
+    EscalationScheduler,
+)
+
+
+class Command(BaseCommand):
+    help = "Escalate pending approval tasks as their step SLA deadlines pass"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--lookahead-minutes",
+            type=float,
+            default=ESCALATION_LOOKAHEAD.total_seconds() / 60,
+            help="How far ahead deadlines are loaded into memory.",
+        )
+        parser.add_argument(
+            "--refresh",
+            type=float,
+            default=ESCALATION_REFRESH_SECONDS,
+            help="Seconds between reloads of upcoming deadlines.",
+        )
+        parser.add_argument("--batch-size", type=int, default=ESCALATION_BATCH_SIZE)
+        parser.add_argument(
+            "--once", action="store_true", help="Escalate the tasks that are overdue now and exit."
+        )
+
+    def handle(self, *args, **options):
+        scheduler = EscalationScheduler(
+            lookahead=timedelta(minutes=options["lookahead_minutes"]),
+            refresh=options["refresh"],
+            batch_size=options["batch_size"],
+        )
+        self.stdout.write(self.style.MIGRATE_HEADING("Running approval escalation scheduler..."))
+        try:
+            asyncio.run(scheduler.run(once=options["once"]))
+        except KeyboardInterrupt:
+            pass
@@ -1,38 +1,33 @@
+from urllib.parse import parse_qs
+
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from rest_framework_simplejwt.tokens import AccessToken
-from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
-from django.contrib.auth import get_user_model
 
-User = get_user_model()
+from workflows.principals import resolve_token
+
 
 @database_sync_to_async
 def get_user(token_key):
-    try:
-        access_token = AccessToken(token_key)
-        user_id = access_token['user_id']
-        return User.objects.get(id=user_id)
-    except (InvalidToken, TokenError, User.DoesNotExist):
-        return AnonymousUser()
+    """The `UserPrincipal` for `token_key`, or AnonymousUser."""
+    return resolve_token(token_key) or AnonymousUser()
 
 class TokenAuthMiddleware(BaseMiddleware):
     async def __call__(self, scope, receive, send):
-        query_string = scope.get('query_string', b'').decode()
-        query_params = dict(param.split('=') for param in query_string.split('&') if param)
-        
-        token = query_params.get('token', None)
-        
+        query_params = parse_qs(scope.get('query_string', b'').decode())
+
+        token = query_params.get('token', [None])[0]
+
         if not token and 'headers' in scope:
             headers = dict(scope['headers'])
             if b'authorization' in headers:
                 auth_header = headers[b'authorization'].decode()
                 if auth_header.startswith('Bearer '):
                     token = auth_header.split(' ')[1]
-        
+
         if token:
             scope['user'] = await get_user(token)
         else:
             scope['user'] = AnonymousUser()
-        
-        return await super().__call__(scope, receive, send)
\ No newline at end of file
+
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,65 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:13
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_assignments(apps, schema_editor):
+    ApprovalTask = apps.get_model("workflows", "ApprovalTask")
+    ApprovalTaskAssignment = apps.get_model("workflows", "ApprovalTaskAssignment")
+    StepRole = apps.get_model("workflows", "InstitutionApprovalStepApprovorRole")
+    StepUser = apps.get_model("workflows", "InstitutionApprovalStepApprovorUser")
+    UserRole = apps.get_model("users", "UserRole")
+
+    users_by_role = {}
+    for role_id, user_id in UserRole.objects.values_list("role_id", "user_id"):
+        users_by_role.setdefault(role_id, set()).add(user_id)
+
+    users_by_step = {}
+    for step_id, role_id in StepRole.objects.values_list("step_id", "approver_role_id"):
+        users_by_step.setdefault(step_id, set()).update(users_by_role.get(role_id, ()))
+    for step_id, user_id in StepUser.objects.values_list("step_id", "approver_user__user_id"):
+        users_by_step.setdefault(step_id, set()).add(user_id)
+
+    batch = []
+    tasks = ApprovalTask.objects.values_list("id", "step_id", "status", "step__Institution_id")
+    for task_id, step_id, status, institution_id in tasks.iterator(chunk_size=2000):
+        for user_id in users_by_step.get(step_id, ()):
+            batch.append(
+                ApprovalTaskAssignment(
+                    task_id=task_id, user_id=user_id, status=status, institution_id=institution_id
+                )
+            )
+        if len(batch) >= 2000:
+            ApprovalTaskAssignment.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    ApprovalTaskAssignment.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('institution', '0003_alter_institution_unique_together'),
+        ('users', '0002_rename_institution_role_institution_and_more'),
+        ('workflows', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApprovalTaskAssignment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('not_started', 'Not Started'), ('pending', 'Pending'), ('completed', 'Completed'), ('rejected', 'Rejected'), ('terminated', 'Terminated')], max_length=20)),
+                ('institution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='institution.institution')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='assignments', to='workflows.approvaltask')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='approval_assignments', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'status', 'institution', 'task'], name='wf_assignment_inbox_idx')],
+                'unique_together': {('task', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_assignments, migrations.RunPython.noop),
+    ]
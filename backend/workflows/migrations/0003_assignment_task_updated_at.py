@@ -0,0 +1,44 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:41
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_task_updated_at(apps, schema_editor):
+    ApprovalTask = apps.get_model("workflows", "ApprovalTask")
+    ApprovalTaskAssignment = apps.get_model("workflows", "ApprovalTaskAssignment")
+    ApprovalTaskAssignment.objects.update(
+        task_updated_at=Subquery(
+            ApprovalTask.objects.filter(pk=OuterRef("task_id")).values("updated_at")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0002_approval_task_assignments'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='approvaltaskassignment',
+            name='wf_assignment_inbox_idx',
+        ),
+        migrations.AddField(
+            model_name='approvaltaskassignment',
+            name='task_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_task_updated_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='approvaltaskassignment',
+            index=models.Index(fields=['user', 'task_updated_at', 'task'], name='wf_assignment_inbox_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='approvaltaskassignment',
+            index=models.Index(fields=['user', 'status', 'task_updated_at', 'task'], name='wf_assignment_status_idx'),
+        ),
+    ]
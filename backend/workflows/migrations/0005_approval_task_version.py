@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0004_workflow_notification_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='approvaltask',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
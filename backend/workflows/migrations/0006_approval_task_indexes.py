@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('users', '0002_rename_institution_role_institution_and_more'),
+        ('workflows', '0005_approval_task_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='approvaltask',
+            index=models.Index(fields=['content_type', 'object_id', 'status'], name='wf_task_object_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='approvaltask',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['step', 'updated_at'], name='wf_task_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('workflows', '0006_approval_task_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='approvaltask',
+            name='display_label',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('users', '0002_rename_institution_role_institution_and_more'),
+        ('workflows', '0007_approval_task_display_label'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='approvaltask',
+            name='due_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='approvaltask',
+            name='escalated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='approvaltaskassignment',
+            name='escalated',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='institutionapprovalstep',
+            name='escalation_action',
+            field=models.CharField(choices=[('notify', 'Notify'), ('reassign', 'Reassign'), ('auto_advance', 'Auto-advance')], default='notify', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='institutionapprovalstep',
+            name='escalation_role',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='users.role'),
+        ),
+        migrations.AddField(
+            model_name='institutionapprovalstep',
+            name='sla',
+            field=models.DurationField(blank=True, help_text='How long a task may stay pending at this step', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='approvaltask',
+            index=models.Index(condition=models.Q(('escalated_at__isnull', True), ('status', 'pending')), fields=['due_at'], name='wf_task_due_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_transition_times(apps, schema_editor):
+    # best available approximation: the last update of a pending task is its
+    # activation, the last update of a closed one is when it was closed
+    ApprovalTask = apps.get_model("workflows", "ApprovalTask")
+    ApprovalTask.objects.filter(status="pending").update(started_at=F("updated_at"))
+    ApprovalTask.objects.filter(
+        status__in=["completed", "rejected", "terminated"]
+    ).update(finished_at=F("updated_at"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('institution', '0003_alter_institution_unique_together'),
+        ('workflows', '0008_approval_sla_escalation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='approvaltask',
+            name='finished_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='approvaltask',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='approvaltask',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.CreateModel(
+            name='ApprovalTurnaroundRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket_start', models.DateTimeField()),
+                ('bin', models.PositiveSmallIntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total_seconds', models.FloatField(default=0)),
+                ('max_seconds', models.FloatField(default=0)),
+                ('action', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='workflows.workflowaction')),
+                ('institution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='institution.institution')),
+                ('step', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='workflows.institutionapprovalstep')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['institution', 'granularity', 'bucket_start'], name='wf_turnaround_report_idx')],
+                'unique_together': {('granularity', 'bucket_start', 'step', 'bin')},
+            },
+        ),
+        migrations.RunPython(backfill_transition_times, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('institution', '0003_alter_institution_unique_together'),
+        ('workflows', '0009_approval_turnaround_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WorkflowDefinition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('digest', models.CharField(max_length=64)),
+                ('definition', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('Institution', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='institution.institution')),
+                ('action', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='workflows.workflowaction')),
+            ],
+            options={
+                'unique_together': {('Institution', 'action', 'digest'), ('Institution', 'action', 'version')},
+            },
+        ),
+        migrations.AddField(
+            model_name='approvaltask',
+            name='definition',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='tasks', to='workflows.workflowdefinition'),
+        ),
+    ]
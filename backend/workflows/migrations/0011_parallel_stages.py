@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('institution', '0003_alter_institution_unique_together'),
+        ('users', '0002_rename_institution_role_institution_and_more'),
+        ('workflows', '0010_workflow_definitions'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='institutionapprovalstep',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='institutionapprovalstep',
+            name='quorum',
+            field=models.CharField(choices=[('all', 'All'), ('any', 'Any'), ('n_of_m', 'N of M')], default='all', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='institutionapprovalstep',
+            name='quorum_count',
+            field=models.PositiveIntegerField(blank=True, help_text='Approvals needed when quorum is "n_of_m"', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='institutionapprovalstep',
+            index=models.Index(fields=['Institution', 'action', 'level'], name='wf_step_chain_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:45
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('institution', '0003_alter_institution_unique_together'),
+        ('workflows', '0011_parallel_stages'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApprovalTaskEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(choices=[('not_started', 'Not Started'), ('pending', 'Pending'), ('completed', 'Completed'), ('rejected', 'Rejected'), ('terminated', 'Terminated')], max_length=20)),
+                ('to_status', models.CharField(choices=[('not_started', 'Not Started'), ('pending', 'Pending'), ('completed', 'Completed'), ('rejected', 'Rejected'), ('terminated', 'Terminated')], max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('institution', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='institution.institution')),
+                ('task', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='events', to='workflows.approvaltask')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['institution', 'id'], name='wf_event_export_idx'), models.Index(fields=['task', 'id'], name='wf_event_task_idx')],
+            },
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models, transaction as db_transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.utils import timezone
 
 from users.models import CustomUser, Profile
 
@@ -27,9 +28,40 @@ class InstitutionApprovalStep(models.Model):
     action = models.ForeignKey(WorkflowAction, on_delete=models.CASCADE)
     level = models.PositiveIntegerField(help_text="Lower number = first to approve")
 
+    ESCALATION_CHOICES = [
+        ("notify", "Notify"),
+        ("reassign", "Reassign"),
+        ("auto_advance", "Auto-advance"),
+    ]
+    sla = models.DurationField(
+        null=True, blank=True, help_text="How long a task may stay pending at this step"
+    )
+    escalation_action = models.CharField(
+        max_length=20, choices=ESCALATION_CHOICES, default="notify"
+    )
+    # users with this role may act on overdue tasks when escalation is "reassign";
+    # the institution owner is used when it is not set
+    escalation_role = models.ForeignKey(
+        "users.Role", on_delete=models.SET_NULL, null=True, blank=True, related_name="+"
+    )
+
+    QUORUM_CHOICES = [
+        ("all", "All"),
+        ("any", "Any"),
+        ("n_of_m", "N of M"),
+    ]
+    # steps sharing a level approve in parallel; the stage is complete once
+    # its quorum is met (the strictest one when its steps disagree)
+    quorum = models.CharField(max_length=10, choices=QUORUM_CHOICES, default="all")
+    quorum_count = models.PositiveIntegerField(
+        null=True, blank=True, help_text='Approvals needed when quorum is "n_of_m"'
+    )
+
     class Meta:
-        unique_together = ("Institution", "action", "level")
         ordering = ["level"]
+        indexes = [
+            models.Index(fields=["Institution", "action", "level"], name="wf_step_chain_idx"),
+        ]
 
     def __str__(self):
         return f"{self.Institution} - {self.action} (Level {self.level})"
@@ -56,6 +88,33 @@ class InstitutionApprovalStepApprovorUser(models.Model):
         return f"{self.step} - {self.approver_user}"
 
 
+class WorkflowDefinition(models.Model):
+    """
+    Immutable snapshot of the approval chain of one (Institution, action):
+    levels, approvers, SLAs and the Institution owner, in the compact form
+    written by `workflows.chain.chain_to_definition`. Tasks keep the
+    definition they were started with, so editing steps only affects
+    workflows started afterwards. Identical chains share one row.
+    """
+
+    Institution = models.ForeignKey("institution.Institution", on_delete=models.CASCADE)
+    action = models.ForeignKey(WorkflowAction, on_delete=models.CASCADE)
+    version = models.PositiveIntegerField()
+    # sha256 of the canonical JSON of `definition`
+    digest = models.CharField(max_length=64)
+    definition = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [
+            ("Institution", "action", "version"),
+            ("Institution", "action", "digest"),
+        ]
+
+    def __str__(self):
+        return f"{self.Institution} - {self.action} (v{self.version})"
+
+
 class ApprovalTask(models.Model):
     STATUS_CHOICES = [
         ("not_started", "Not Started"),
@@ -66,11 +125,23 @@ class ApprovalTask(models.Model):
     ]
 
     step = models.ForeignKey(InstitutionApprovalStep, on_delete=models.CASCADE)
+    # the chain this task is evaluated against; null for tasks started before
+    # definitions were recorded, which follow the live steps
+    definition = models.ForeignKey(
+        WorkflowDefinition,
+        on_delete=models.RESTRICT,
+        null=True,
+        blank=True,
+        related_name="tasks",
+    )
 
     # Link to any model needing approval: Product, PurchaseOrder, etc.
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     content_object = GenericForeignKey("content_type", "object_id")
+    # str(content_object) when the task was created, so task lists can be
+    # rendered without loading the target objects; empty for older tasks
+    display_label = models.CharField(max_length=255, blank=True, default="")
     status = models.CharField(
         max_length=20, choices=STATUS_CHOICES, default="not_started"
     )
@@ -83,78 +154,385 @@ class ApprovalTask(models.Model):
         related_name="approved_tasks",
     )
     updated_at = models.DateTimeField(auto_now=True)
-    created_at = models.DateField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # when the task became pending, and when it left pending
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # bumped by every status transition, see workflows.transitions
+    version = models.PositiveIntegerField(default=0)
+    # when a pending task breaches its step's SLA, see workflows.escalation
+    due_at = models.DateTimeField(null=True, blank=True)
+    escalated_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         unique_together = ("step", "content_type", "object_id")
+        indexes = [
+            # all tasks of one object: rejection, next level, participants
+            models.Index(
+                fields=["content_type", "object_id", "status"],
+                name="wf_task_object_status_idx",
+            ),
+            # the open work of a step, oldest first
+            models.Index(
+                fields=["step", "updated_at"],
+                name="wf_task_pending_idx",
+                condition=models.Q(status="pending"),
+            ),
+            # upcoming SLA deadlines, read by the escalation scheduler
+            models.Index(
+                fields=["due_at"],
+                name="wf_task_due_idx",
+                condition=models.Q(status="pending", escalated_at__isnull=True),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.step} - {self.content_object} [{self.status}]"
 
-    def mark_completed(self, user:CustomUser):
-        from django.db import transaction as db_transaction
+    @classmethod
+    def display_label_for(cls, obj):
+        """Value stored in `display_label` for a task on `obj`."""
+        return str(obj)[: cls._meta.get_field("display_label").max_length]
+
+    def _lock_stage(self, stage):
+        """
+        Statuses of the other tasks of this object in `stage`. The whole stage
+        is locked first when it runs in parallel, so decisions on sibling
+        tasks are counted one at a time.
+        """
+        if len(stage) < 2:
+            return []
+        statuses = (
+            ApprovalTask.objects.select_for_update()
+            .filter(
+                step_id__in=[level.step_id for level in stage],
+                content_type_id=self.content_type_id,
+                object_id=self.object_id,
+            )
+            .order_by("id")
+            .values_list("id", "status")
+        )
+        return [task_status for task_id, task_status in statuses if task_id != self.id]
+
+    def _advance(self, chain, user):
+        """
+        Activate the first later stage that still needs approvals, or finish
+        the workflow when there is none. Stages already satisfied by
+        approvals given before a reorder moved them behind this one are
+        skipped and their open tasks terminated. Returns
+        `(activated, terminated_ids)`.
+        """
+        from workflows.transitions import (
+            TransitionConflict,
+            activate_stage,
+            transition_open_tasks,
+        )
+
+        stage_tasks = ApprovalTask.objects.filter(
+            content_type_id=self.content_type_id, object_id=self.object_id
+        )
+        statuses = {}
+        for step_id, task_status in stage_tasks.values_list("step_id", "status"):
+            statuses.setdefault(step_id, []).append(task_status)
+
+        terminated_ids = []
+        step_id = self.step_id
+        while True:
+            stage = chain.next_stage(step_id)
+            if not stage:
+                self.content_object.finish_workflow()
+                return [], terminated_ids
+            step_id = stage[0].step_id
+            step_ids = [level.step_id for level in stage]
+            stage_statuses = [task_status for step in step_ids for task_status in statuses.get(step, [])]
+
+            if not stage_statuses or stage_statuses.count("completed") >= chain.required_approvals(stage):
+                terminated_ids += transition_open_tasks(
+                    stage_tasks.filter(step_id__in=step_ids), "terminated", actor=user, cause=self.id
+                )
+                continue
+            if "not_started" in stage_statuses:
+                return (
+                    activate_stage(
+                        stage_tasks.filter(step_id__in=step_ids),
+                        stage,
+                        actor=user,
+                        cause=self.id,
+                    ),
+                    terminated_ids,
+                )
+            if "pending" in stage_statuses:
+                # already waiting for its approvers
+                return [], terminated_ids
+            # a concurrent rejection closed the rest of the workflow
+            raise TransitionConflict(self.id, "completed")
+
+    def mark_completed(self, user:CustomUser, notify=True):
+        """
+        Complete this task. Once its stage (the steps sharing its level) has
+        the approvals its quorum asks for, the stage's remaining open tasks
+        are terminated and the next stage that still needs approvals is
+        activated, or the workflow is finished after the last one. Pass
+        `notify=False` when the caller coalesces notifications.
+
+        Returns `(activated, terminated_ids)`: the tasks of the next stage
+        that became pending and the ids of open tasks that were no longer
+        needed; both are empty while the stage still waits for approvals.
+
+        Raises `TransitionConflict` if the task or the next stage changed since
+        they were read; nothing is written in that case. `user` is None when
+        the escalation scheduler auto-advances an overdue task.
+        """
+        from workflows.chain import get_chain_for_task
+        from workflows.transitions import transition, transition_open_tasks
+
         with db_transaction.atomic():
             if self.status != "pending":
                 raise ValueError("Task must be in pending state to be completed")
+            profile = None
+            if user is not None:
+                try:
+                    profile:Profile = user.profile
+                except Profile.DoesNotExist:
+                    raise ValueError(f"No Profile associated to user {user!r}")
+
+            chain = get_chain_for_task(self)
+            stage = chain.stage_for_step(self.step_id)
+            others = self._lock_stage(stage)
+
+            transition(self, "completed", actor=user, approved_by=profile, comment=self.comment)
+
+            activated, terminated_ids = [], []
+            # otherwise the stage is still waiting for its other approvers
+            if not stage or others.count("completed") + 1 >= chain.required_approvals(stage):
+                if others:
+                    terminated_ids = transition_open_tasks(
+                        ApprovalTask.objects.filter(
+                            step_id__in=[level.step_id for level in stage],
+                            content_type_id=self.content_type_id,
+                            object_id=self.object_id,
+                        ),
+                        "terminated",
+                        actor=user,
+                        cause=self.id,
+                    )
+                activated, skipped_ids = self._advance(chain, user)
+                terminated_ids += skipped_ids
+
+            if notify:
+                from workflows.outbox import enqueue, enqueue_many
+
+                # Notify next approvers via WebSocket (delivered from the outbox)
+                enqueue_many(
+                    "task_update",
+                    [{"task_id": task_id} for task_id in [t.id for t in activated] + terminated_ids],
+                )
+                # Notify task completion
+                enqueue("task_completion", task_id=self.id)
+
+            return activated, terminated_ids
+
+    def mark_rejected(self, user:CustomUser, notify=True):
+        """
+        Reject this task. The workflow is rejected and its open tasks are
+        terminated unless other approvers of a parallel stage can still reach
+        the stage's quorum without it. Returns the ids of the terminated
+        tasks, or None when the workflow carries on.
+
+        Raises `TransitionConflict` if the task changed since it was read.
+        """
+        from workflows.chain import get_chain_for_task
+        from workflows.transitions import OPEN_STATUSES, transition, transition_open_tasks
+
+        with db_transaction.atomic():
+            if self.status != "pending":
+                raise ValueError("Task must be in pending state to be rejected")
             try:
                 profile:Profile = user.profile
-            except CustomUser.DoesNotExist:
+            except Profile.DoesNotExist:
                 raise ValueError(f"No Profile associated to user {user!r}")
 
-            self.status = "completed"
-            self.approved_by = profile
-            self.save(update_fields=["status", "updated_at", "comment", "approved_by"])
+            chain = get_chain_for_task(self)
+            stage = chain.stage_for_step(self.step_id)
+            others = self._lock_stage(stage)
 
-            related_tasks = ApprovalTask.objects.filter(
-                content_type=self.content_type,
-                object_id=self.object_id,
-            ).select_related("step")
+            transition(self, "rejected", actor=user, approved_by=profile, comment=self.comment)
 
-            current_level = self.step.level
-            next_task = related_tasks.filter(step__level=current_level + 1).first()
+            reachable = sum(
+                1 for task_status in others if task_status in OPEN_STATUSES + ("completed",)
+            )
+            if others and reachable >= chain.required_approvals(stage):
+                if notify:
+                    from workflows.outbox import enqueue
 
-            if next_task:
-                next_task.status = "pending"
-                next_task.save(update_fields=["status"])
+                    enqueue("task_rejection", task_id=self.id)
+                return None
 
-                # Notify next approvers via WebSocket
-                from workflows.notifications import notify_task_update
-                notify_task_update(next_task)
-            else:
-                self.content_object.finish_workflow()
+            # Terminate other tasks
+            terminated_ids = transition_open_tasks(
+                ApprovalTask.objects.filter(
+                    content_type_id=self.content_type_id,
+                    object_id=self.object_id,
+                ).exclude(id=self.id),
+                "terminated",
+                actor=user,
+                cause=self.id,
+            )
 
-            # Notify task completion
-            from workflows.notifications import notify_task_completion
-            notify_task_completion(self)
+            if notify:
+                from workflows.outbox import enqueue, enqueue_many
 
-    def mark_rejected(self, user:CustomUser):
-        with db_transaction.atomic():
-            if self.status != "pending":
-                raise ValueError("Task must be in pending state to be rejected")
-            try:
-                profile:Profile = user.profile
-            except CustomUser.DoesNotExist:
-                raise ValueError(f"No Profile associated to user {user!r}")
+                # Notify task rejection
+                enqueue("task_rejection", task_id=self.id)
 
-            self.status = "rejected"
-            self.approved_by = profile
-            self.save(update_fields=["status", "updated_at", "comment", "approved_by"])
+                # Notify terminated tasks
+                enqueue_many("task_update", [{"task_id": task_id} for task_id in terminated_ids])
 
-            # Terminate other tasks
-            terminated_tasks = ApprovalTask.objects.filter(
-                content_type=self.content_type,
-                object_id=self.object_id
-            ).exclude(id=self.id).filter(status__in=["not_started", "pending"])
+            self.content_object.finish_workflow()
 
-            terminated_tasks.update(status="terminated")
+            return terminated_ids
 
-            # Notify task rejection
-            from workflows.notifications import notify_task_rejection
-            notify_task_rejection(self)
 
-            # Notify terminated tasks
-            from workflows.notifications import notify_task_update
-            for task in terminated_tasks:
-                notify_task_update(task)
+class ApprovalTaskEvent(models.Model):
+    """
+    Append-only history of approval tasks: one row per status transition
+    (and per escalation), written by `workflows.transitions` in the
+    transaction that made it. Rows are never updated and outlive the tasks
+    they describe, which is why `task` carries no database constraint.
+    """
 
-            self.content_object.finish_workflow()
+    task = models.ForeignKey(
+        ApprovalTask,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        db_index=False,
+        related_name="events",
+    )
+    institution = models.ForeignKey(
+        "institution.Institution", on_delete=models.CASCADE, db_index=False
+    )
+    # equal for events that leave the status alone, such as escalations
+    from_status = models.CharField(max_length=20, choices=ApprovalTask.STATUS_CHOICES)
+    to_status = models.CharField(max_length=20, choices=ApprovalTask.STATUS_CHOICES)
+    # None for the system: escalations, cascades of a reorder
+    actor = models.ForeignKey(
+        "users.CustomUser",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    created_at = models.DateTimeField(default=timezone.now)
+    payload = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            # exports, keyset-paginated on id
+            models.Index(fields=["institution", "id"], name="wf_event_export_idx"),
+            # the history of one task
+            models.Index(fields=["task", "id"], name="wf_event_task_idx"),
+        ]
+
+    def __str__(self):
+        return f"Task {self.task_id}: {self.from_status or '-'} -> {self.to_status}"
+
+
+class ApprovalTaskAssignment(models.Model):
+    """
+    Denormalised (user, task) pairs for every user allowed to act on a task,
+    either through one of the step's roles or as an explicit approver.
+
+    Kept in sync by `workflows.assignments` so the task inbox and the
+    "who should be notified" lookups are single indexed range scans.
+    """
+
+    user = models.ForeignKey(
+        "users.CustomUser", on_delete=models.CASCADE, related_name="approval_assignments"
+    )
+    task = models.ForeignKey(ApprovalTask, on_delete=models.CASCADE, related_name="assignments")
+    status = models.CharField(max_length=20, choices=ApprovalTask.STATUS_CHOICES)
+    institution = models.ForeignKey("institution.Institution", on_delete=models.CASCADE)
+    # copy of task.updated_at, the keyset the inbox is paginated on
+    task_updated_at = models.DateTimeField()
+    # granted by SLA escalation rather than by the step's approvers; kept
+    # when the step's approvers change
+    escalated = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ("task", "user")
+        indexes = [
+            models.Index(
+                fields=["user", "task_updated_at", "task"],
+                name="wf_assignment_inbox_idx",
+            ),
+            models.Index(
+                fields=["user", "status", "task_updated_at", "task"],
+                name="wf_assignment_status_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} -> task {self.task_id} [{self.status}]"
+
+
+class WorkflowNotificationOutbox(models.Model):
+    """
+    Workflow notifications recorded in the same transaction as the change that
+    caused them, and delivered to the channel layer afterwards by the
+    `dispatch_workflow_notifications` command (see `workflows.outbox`).
+    """
+
+    event = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    available_at = models.DateTimeField(default=timezone.now)
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["available_at", "id"],
+                name="wf_outbox_pending_idx",
+                condition=models.Q(dispatched_at__isnull=True),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.event} #{self.pk} ({'sent' if self.dispatched_at else 'pending'})"
+
+
+class ApprovalTurnaroundRollup(models.Model):
+    """
+    Pre-aggregated approval times (time from `started_at` to `finished_at` of
+    completed and rejected tasks), one row per time bucket, step and
+    histogram bin. Maintained by `workflows.analytics` from the decisions
+    recorded in the notification outbox.
+    """
+
+    GRANULARITY_CHOICES = [("hour", "Hour"), ("day", "Day")]
+
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    bucket_start = models.DateTimeField()
+    step = models.ForeignKey(InstitutionApprovalStep, on_delete=models.CASCADE)
+    # copies of the step's, so reports filter without joining
+    institution = models.ForeignKey("institution.Institution", on_delete=models.CASCADE)
+    action = models.ForeignKey(WorkflowAction, on_delete=models.CASCADE)
+    # index into workflows.analytics.BIN_EDGES
+    bin = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+    total_seconds = models.FloatField(default=0)
+    max_seconds = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = ("granularity", "bucket_start", "step", "bin")
+        indexes = [
+            models.Index(
+                fields=["institution", "granularity", "bucket_start"],
+                name="wf_turnaround_report_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.step_id} {self.granularity} {self.bucket_start:%Y-%m-%d %H:%M} bin {self.bin}: {self.count}"
@@ -1,22 +1,61 @@
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+import asyncio
 import json
 
-def notify_task_update(task):
-    """Send WebSocket notification about task update"""
-    channel_layer = get_channel_layer()
+from workflows.deltas import (
+    ADDED,
+    RESYNC,
+    STATUS_CHANGED,
+    assignee_changes,
+    changes_for,
+    send_task_deltas,
+)
+from workflows.presence import online_user_ids
 
-    # Get all users who should be notified (approvers and users with approver roles)
-    approver_users = set()
+# Upper bound on in-flight group_send calls during one fan-out
+FANOUT_CONCURRENCY = 100
+
+def user_group(user_id):
+    return f"user_{user_id}_notifications"
 
-    # Add users with approver roles
-    for role in task.step.roles.all():
-        for user_role in role.approver_role.user_roles.all():
-            approver_users.add(user_role.user.id)
+async def group_send_many(channel_layer, messages, concurrency=FANOUT_CONCURRENCY):
+    """Send (group, message) pairs concurrently on the running event loop"""
+    semaphore = asyncio.Semaphore(concurrency)
 
-    # Add explicit approvers
-    for approver in task.step.approver.all():
-        approver_users.add(approver.approver_user.user.id)
+    async def send(group, message):
+        async with semaphore:
+            await channel_layer.group_send(group, message)
+
+    results = await asyncio.gather(
+        *(send(group, message) for group, message in messages), return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+def fan_out(messages, channel_layer=None):
+    """
+    Deliver a list of (group, message) pairs with a single sync->async hop.
+
+    All sends share one event loop and run concurrently, so the channel
+    layer can keep several Redis requests in flight instead of paying a
+    full async_to_sync round trip per recipient.
+    """
+    messages = list(messages)
+    if not messages:
+        return
+    channel_layer = channel_layer or get_channel_layer()
+    async_to_sync(group_send_many)(channel_layer, messages)
+
+def notify_task_update(task):
+    """Send WebSocket notification about task update"""
+    # Get all users who should be notified (approvers and users with approver roles)
+    from workflows.assignments import task_recipient_user_ids
+    approver_users = task_recipient_user_ids([task.id])
+    online_users = online_user_ids(approver_users)
+    if not online_users:
+        return
 
     # Import here to avoid circular import
     from workflows.serializers import ApprovalTaskSerializer
@@ -26,118 +65,128 @@ def notify_task_update(task):
     task_data = serializer.data
 
     # Send notification to each user
-    for user_id in approver_users:
-        async_to_sync(channel_layer.group_send)(
-            f"user_{user_id}_notifications",
-            {
-                "type": "notification_message",
-                "message": f"You have a new task to approve: {task.step.step_name}",
-                "task": task_data
-            }
-        )
+    message = {
+        "type": "notification_message",
+        "message": f"You have a new task to approve: {task.step.step_name}",
+        "task": task_data
+    }
+    fan_out((user_group(user_id), message) for user_id in online_users)
 
-        # Also send updated tasks list
-        send_updated_tasks_to_user(user_id)
+    # Also send the changed row of their task lists
+    send_task_deltas(changes_for(online_users, [task.id], STATUS_CHANGED))
 
 def notify_task_completion(task):
     """Notify about task completion"""
-    channel_layer = get_channel_layer()
-
     # Notify the task creator/owner if applicable
     if hasattr(task.content_object, 'created_by') and task.content_object.created_by:
         user_id = task.content_object.created_by.id
-        async_to_sync(channel_layer.group_send)(
-            f"user_{user_id}_notifications",
+        if not online_user_ids([user_id]):
+            return
+        if task.approved_by:
+            message = f"Your {task.step.action.label} was approved by {task.approved_by.user.fullname}"
+        else:
+            message = f"Your {task.step.action.label} was approved automatically after its deadline passed"
+        fan_out([(
+            user_group(user_id),
             {
                 "type": "notification_message",
-                "message": f"Your {task.step.action.label} was approved by {task.approved_by.user.fullname}"
+                "message": message
             }
-        )
+        )])
 
 def notify_task_rejection(task):
     """Notify about task rejection"""
-    channel_layer = get_channel_layer()
-
     # Notify the task creator/owner if applicable
     if hasattr(task.content_object, 'created_by') and task.content_object.created_by:
         user_id = task.content_object.created_by.id
-        async_to_sync(channel_layer.group_send)(
-            f"user_{user_id}_notifications",
+        if not online_user_ids([user_id]):
+            return
+        fan_out([(
+            user_group(user_id),
             {
                 "type": "notification_message",
                 "message": f"Your {task.step.action.label} was rejected by {task.approved_by.user.fullname}"
             }
-        )
-
-def send_updated_tasks_to_user(user_id):
-    """Send updated tasks list to a specific user"""
-    from django.contrib.auth import get_user_model
-    User = get_user_model()
-
-    try:
-        user = User.objects.get(id=user_id)
-        user_roles = user.user_roles.values_list("role_id", flat=True)
-
-        # Import here to avoid circular import
-        from django.db.models import Q
-        from workflows.models import ApprovalTask
-        from workflows.serializers import ApprovalTaskSerializer
-
-        tasks = ApprovalTask.objects.filter(
-            Q(step__roles__approver_role__id__in=user_roles) |
-            Q(step__approver__approver_user__user__id=user.id)
-        ).distinct()
-
-        serializer = ApprovalTaskSerializer(tasks, many=True)
-        tasks_data = serializer.data
-
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"user_{user_id}_notifications",
+        )])
+
+def notify_task_escalated(task, action):
+    """Tell everyone assigned to an overdue task, including users it was reassigned to"""
+    from workflows.assignments import task_recipient_user_ids
+
+    if action == "auto_advance":
+        text = f"Task '{task.step.step_name}' was approved automatically after its deadline passed"
+    elif action == "reassign":
+        text = f"Overdue task '{task.step.step_name}' has been escalated to you"
+    else:
+        text = f"Task '{task.step.step_name}' is overdue"
+    message = {
+        "type": "notification_message",
+        "message": text,
+        # overdue work is not held back with the batched updates
+        "urgent": action != "auto_advance",
+    }
+    recipients = online_user_ids(task_recipient_user_ids([task.id]))
+    fan_out((user_group(user_id), message) for user_id in recipients)
+
+def notify_tasks_created(user_ids, step_name, task_count, task_ids=None, assignee_ids=()):
+    """
+    Send one batched notification per approver for newly started workflows.
+    `task_ids` are sent as task list deltas; when the batch was too large to
+    list them, `assignee_ids` are told to resync instead.
+    """
+    message = {
+        "type": "notification_message",
+        "message": f"You have {task_count} new task(s) to approve: {step_name}"
+    }
+    fan_out((user_group(user_id), message) for user_id in online_user_ids(user_ids))
+
+    if task_ids is not None:
+        send_task_deltas(assignee_changes(task_ids, ADDED))
+    else:
+        send_task_deltas({user_id: RESYNC for user_id in assignee_ids})
+
+def notify_bulk_task_updates(updates_by_user, actor, task_ids=()):
+    """Send one coalesced notification per user affected by a batch of transitions"""
+    online_users = online_user_ids(updates_by_user)
+    fan_out(
+        (
+            user_group(user_id),
             {
-                "type": "tasks_update",
-                "tasks": tasks_data
+                "type": "notification_message",
+                "message": f"{task_count} task(s) you are involved in were updated by {actor.fullname}"
             }
         )
-    except User.DoesNotExist:
-        pass
+        for user_id, task_count in updates_by_user.items()
+        if user_id in online_users
+    )
+
+    # Also send the changed rows of their task lists
+    send_task_deltas(assignee_changes(task_ids, STATUS_CHANGED))
 
 def notify_workflow_participants(task, status_change, user):
     """Notify all participants in a workflow about status changes"""
-    channel_layer = get_channel_layer()
-
     # Import here to avoid circular import
-    from django.db.models import Q
+    from workflows.assignments import task_recipient_user_ids
     from workflows.models import ApprovalTask
 
     # Get all tasks related to this workflow
-    related_tasks = ApprovalTask.objects.filter(
+    related_task_ids = ApprovalTask.objects.filter(
         content_type=task.content_type,
         object_id=task.object_id
-    )
+    ).values_list("id", flat=True)
 
     # Collect all users involved in this workflow
-    involved_users = set()
-    for related_task in related_tasks:
-        # Add users with approver roles
-        for role in related_task.step.roles.all():
-            for user_role in role.approver_role.user_roles.all():
-                involved_users.add(user_role.user.id)
-
-        # Add explicit approvers
-        for approver in related_task.step.approver.all():
-            involved_users.add(approver.approver_user.user.id)
+    involved_users = task_recipient_user_ids(list(related_task_ids))
+    involved_users.discard(user.id)
+    involved_users = online_user_ids(involved_users)
 
     # Send notification to all involved users
-    for user_id in involved_users:
-        if user_id != user.id:
-            async_to_sync(channel_layer.group_send)(
-                f"user_{user_id}_notifications",
-                {
-                    "type": "notification_message",
-                    "message": f"Task '{task.step.step_name}' has been {status_change} by {user.fullname}"
-                }
-            )
-
-            # Also send updated tasks list
-            send_updated_tasks_to_user(user_id)
+    message = {
+        "type": "notification_message",
+        "message": f"Task '{task.step.step_name}' has been {status_change} by {user.fullname}"
+    }
+    fan_out((user_group(user_id), message) for user_id in involved_users)
+
+    # Also send the changed row of their task lists; the other tasks of the
+    # workflow that changed with it have their own task_update events
+    send_task_deltas(assignee_changes([task.id], STATUS_CHANGED))
@@ -0,0 +1,223 @@
+"""
+Transactional outbox for workflow notifications (and the turnaround
+rollups of `workflows.analytics`).
+
+Approval transitions call `enqueue()` instead of talking to the channel layer:
+the event row commits (or rolls back) together with the task changes, so no
+network I/O happens while task rows are locked and nothing is lost while
+Redis is unavailable. `dispatch_pending()` delivers committed events in
+batches with retry and backoff; run it through the
+`dispatch_workflow_notifications` management command.
+"""
+import logging
+from datetime import timedelta
+
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from workflows.models import WorkflowNotificationOutbox
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_MAX_BACKOFF_SECONDS = 300
+# how long a claimed batch stays hidden from other dispatchers
+OUTBOX_CLAIM_SECONDS = 60
+
+
+def enqueue(event, **payload):
+    """Record a notification event in the current transaction."""
+    if event not in HANDLERS:
+        raise ValueError(f"Unknown workflow notification event {event!r}")
+    return WorkflowNotificationOutbox.objects.create(event=event, payload=payload)
+
+
+def enqueue_many(event, payloads):
+    """Record one event per payload with a single INSERT."""
+    if event not in HANDLERS:
+        raise ValueError(f"Unknown workflow notification event {event!r}")
+    return WorkflowNotificationOutbox.objects.bulk_create(
+        [WorkflowNotificationOutbox(event=event, payload=payload) for payload in payloads]
+    )
+
+
+def _task(payload):
+    from workflows.serializers import approval_task_queryset
+
+    return approval_task_queryset().get(pk=payload["task_id"])
+
+
+def _user(user_id):
+    from django.contrib.auth import get_user_model
+
+    return get_user_model().objects.get(pk=user_id)
+
+
+def _handle_task_update(payload):
+    from workflows.notifications import notify_task_update
+
+    notify_task_update(_task(payload))
+
+
+def _handle_task_completion(payload):
+    from workflows.notifications import notify_task_completion
+
+    notify_task_completion(_task(payload))
+
+
+def _handle_task_rejection(payload):
+    from workflows.notifications import notify_task_rejection
+
+    notify_task_rejection(_task(payload))
+
+
+def _handle_workflow_participants(payload):
+    from workflows.notifications import notify_workflow_participants
+
+    notify_workflow_participants(
+        _task(payload), payload["status_change"], _user(payload["user_id"])
+    )
+
+
+def _handle_task_escalated(payload):
+    from workflows.notifications import notify_task_escalated
+
+    notify_task_escalated(_task(payload), payload["action"])
+
+
+def _handle_tasks_created(payload):
+    from workflows.notifications import notify_tasks_created
+
+    notify_tasks_created(
+        payload["user_ids"],
+        payload["step_name"],
+        payload["task_count"],
+        task_ids=payload.get("task_ids"),
+        assignee_ids=payload.get("assignee_ids", ()),
+    )
+
+
+def _handle_bulk_task_updates(payload):
+    from workflows.notifications import notify_bulk_task_updates
+
+    # JSON object keys are strings
+    updates_by_user = {int(user_id): count for user_id, count in payload["updates_by_user"].items()}
+    notify_bulk_task_updates(
+        updates_by_user, _user(payload["actor_id"]), payload.get("task_ids", ())
+    )
+
+
+def _handle_task_deltas(payload):
+    from workflows.deltas import decode_changes, send_task_deltas
+
+    send_task_deltas(decode_changes(payload["changes"]))
+
+
+def _handle_turnaround(payload):
+    from django.utils.dateparse import parse_datetime
+    from workflows.analytics import apply_turnaround
+
+    apply_turnaround(**{**payload, "finished_at": parse_datetime(payload["finished_at"])})
+
+
+HANDLERS = {
+    "task_update": _handle_task_update,
+    "task_completion": _handle_task_completion,
+    "task_rejection": _handle_task_rejection,
+    "workflow_participants": _handle_workflow_participants,
+    "task_escalated": _handle_task_escalated,
+    "tasks_created": _handle_tasks_created,
+    "bulk_task_updates": _handle_bulk_task_updates,
+    "task_deltas": _handle_task_deltas,
+    "turnaround": _handle_turnaround,
+}
+
+
+def _backoff(attempts):
+    return timedelta(seconds=min(2 ** attempts, OUTBOX_MAX_BACKOFF_SECONDS))
+
+
+def _claim(batch_size, now):
+    """
+    Claim up to `batch_size` due events by moving their `available_at` past
+    the delivery window, in a short transaction of its own.
+    """
+    with db_transaction.atomic():
+        events = list(
+            WorkflowNotificationOutbox.objects.select_for_update(skip_locked=True)
+            .filter(
+                dispatched_at__isnull=True,
+                available_at__lte=now,
+                attempts__lt=OUTBOX_MAX_ATTEMPTS,
+            )
+            .order_by("available_at", "id")[:batch_size]
+        )
+        WorkflowNotificationOutbox.objects.filter(pk__in=[event.pk for event in events]).update(
+            available_at=now + timedelta(seconds=OUTBOX_CLAIM_SECONDS)
+        )
+    return events
+
+
+def dispatch_pending(batch_size=OUTBOX_BATCH_SIZE):
+    """
+    Deliver one batch of due events. Returns `(sent, failed)` counts.
+
+    Rows are claimed with `SELECT ... FOR UPDATE SKIP LOCKED` in a short
+    transaction that hides them from other dispatchers for
+    `OUTBOX_CLAIM_SECONDS`, so several dispatchers can drain the outbox
+    concurrently. Delivery runs outside any transaction: no row lock is held
+    across channel layer round-trips, and a handler's database error does not
+    affect the rest of the batch. Events claimed by a dispatcher that died
+    are delivered again once their claim expires. Task list deltas are
+    coalesced across the batch, so a user touched by many events gets a
+    single `tasks_delta` frame.
+    """
+    from django.core.exceptions import ObjectDoesNotExist
+    from workflows.deltas import coalesced_task_deltas
+
+    now = timezone.now()
+    events = _claim(batch_size, now)
+    if not events:
+        return 0, 0
+
+    def retry(event, error):
+        logger.warning(f"Workflow notification {event.pk} ({event.event}) failed: {error}")
+        event.attempts += 1
+        event.last_error = str(error)
+        event.available_at = now + _backoff(event.attempts)
+        retried.append(event)
+
+    delivered, retried = [], []
+    try:
+        with coalesced_task_deltas():
+            for event in events:
+                try:
+                    HANDLERS[event.event](event.payload)
+                except ObjectDoesNotExist:
+                    # the task or user went away before delivery; nothing to send
+                    pass
+                except Exception as e:
+                    retry(event, e)
+                    continue
+                delivered.append(event)
+    except Exception as e:
+        # the coalesced task list deltas are sent last
+        for event in [event for event in delivered if event.event == "task_deltas"]:
+            delivered.remove(event)
+            retry(event, e)
+
+    WorkflowNotificationOutbox.objects.filter(pk__in=[event.pk for event in delivered]).update(
+        dispatched_at=timezone.now()
+    )
+    WorkflowNotificationOutbox.objects.bulk_update(
+        retried, ["attempts", "last_error", "available_at"]
+    )
+    return len(delivered), len(retried)
+
+
+def purge_dispatched(older_than):
+    """Delete delivered events older than `older_than` (a timedelta)."""
+    cutoff = timezone.now() - older_than
+    deleted, _ = WorkflowNotificationOutbox.objects.filter(dispatched_at__lt=cutoff).delete()
+    return deleted
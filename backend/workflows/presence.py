@@ -0,0 +1,58 @@
+"""
+Which users have a notifications websocket open.
+
+Each user has a connection count in the shared cache (the same Redis as the
+channel layer in production). `NotificationConsumer` increments it on
+connect and decrements it on disconnect, and every open connection refreshes
+its TTL with a heartbeat. If a server dies without running `disconnect`, the
+count stops being refreshed and expires within `PRESENCE_TTL`. A count that
+is too high only means a user is treated as online for a while longer.
+
+`notify_*` and the task list deltas look recipients up here first and skip
+serialising and sending to users who are not connected. Those users get a
+fresh `tasks_snapshot` when they do connect.
+"""
+from django.core.cache import cache
+
+PRESENCE_TTL = 90
+PRESENCE_HEARTBEAT_SECONDS = 30
+
+
+def _presence_key(user_id):
+    return f"workflows:presence:{user_id}"
+
+
+def user_connected(user_id):
+    key = _presence_key(user_id)
+    cache.add(key, 0, timeout=PRESENCE_TTL)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # expired between the two calls
+        cache.add(key, 1, timeout=PRESENCE_TTL)
+    cache.touch(key, PRESENCE_TTL)
+
+
+def user_disconnected(user_id):
+    key = _presence_key(user_id)
+    try:
+        if cache.decr(key) <= 0:
+            cache.delete(key)
+    except ValueError:
+        pass
+
+
+def heartbeat(user_id):
+    """Keep the user online for another `PRESENCE_TTL` seconds."""
+    key = _presence_key(user_id)
+    if not cache.touch(key, PRESENCE_TTL):
+        # expired while the connection was still open
+        cache.add(key, 1, timeout=PRESENCE_TTL)
+
+
+def online_user_ids(user_ids):
+    """The subset of `user_ids` with an open connection, in one cache round trip."""
+    keys = {_presence_key(user_id): user_id for user_id in user_ids}
+    if not keys:
+        return set()
+    return {keys[key] for key, count in cache.get_many(keys).items() if count and count > 0}
@@ -0,0 +1,180 @@
+"""
+Cached websocket principals.
+
+`TokenAuthMiddleware` does not load a `CustomUser` on every connect. It
+resolves the access token to a `UserPrincipal`: the user's id, institution,
+role ids and `is_active` flag, which is everything the notification socket
+needs. Principals are cached in two layers, like compiled chains:
+
+- a process-local `TTLCache` keyed by the raw token, which also skips
+  re-verifying the token's signature;
+- the shared Django cache, keyed by user id, so processes that just started
+  after a deploy do not all go to the database during the reconnect storm.
+
+Both layers are keyed by a per-user version that is bumped when the user is
+saved or deleted, or when their profile or roles change. The version is read
+from the shared cache on every connect, so a deactivated user is turned away
+at their next connect on any process. Updates made with `QuerySet.update()`
+bypass the signals; call `invalidate_principal()` after those. While the
+shared cache is unreachable every connect loads the principal from the
+database.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional
+
+from cachetools import TTLCache
+from django.core.cache import cache
+from django.db import transaction
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+PRINCIPAL_CACHE_SIZE = 10_000
+PRINCIPAL_CACHE_TTL = 5 * 60
+PRINCIPAL_SHARED_TIMEOUT = 60 * 60
+
+_local_principals = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+_local_lock = Lock()
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class UserPrincipal:
+    """The authenticated user of a websocket, without a database row behind it."""
+
+    id: int
+    institution_id: Optional[int]
+    role_ids: frozenset
+    is_active: bool
+
+    is_authenticated = True
+    is_anonymous = False
+
+    @property
+    def pk(self):
+        return self.id
+
+
+def _version_key(user_id):
+    return f"workflows:principal-version:{user_id}"
+
+
+def _principal_key(user_id, version):
+    return f"workflows:principal:{user_id}:{version}"
+
+
+def _current_version(user_id) -> Optional[int]:
+    """The user's principal version, or None while the shared cache is unreachable."""
+    key = _version_key(user_id)
+    try:
+        version = cache.get(key)
+        if version is None:
+            # seeded from the clock, see chain._current_version
+            cache.add(key, time.time_ns(), timeout=None)
+            version = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Principal cache unavailable, loading user {user_id} from the database: {e}")
+        return None
+    return version
+
+
+def _cache_get(key):
+    # backends raise their own connection errors
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logger.warning(f"Principal cache unavailable, reading {key} from the database: {e}")
+        return None
+
+
+def _cache_set(key, value):
+    try:
+        cache.set(key, value, timeout=PRINCIPAL_SHARED_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Principal cache unavailable, not storing {key}: {e}")
+
+
+def load_principal(user_id) -> Optional[UserPrincipal]:
+    """Read a user's principal from the database; None if the user is gone."""
+    from django.contrib.auth import get_user_model
+    from users.models import UserRole
+
+    user = (
+        get_user_model()
+        .objects.filter(pk=user_id)
+        .values("id", "is_active", "profile__institution_id")
+        .first()
+    )
+    if user is None:
+        return None
+    return UserPrincipal(
+        id=user["id"],
+        institution_id=user["profile__institution_id"],
+        role_ids=frozenset(
+            UserRole.objects.filter(user_id=user_id).values_list("role_id", flat=True)
+        ),
+        is_active=user["is_active"],
+    )
+
+
+def resolve_token(token_key) -> Optional[UserPrincipal]:
+    """
+    The active principal `token_key` authenticates, or None for invalid or
+    expired tokens and inactive or deleted users. The common case costs one
+    shared cache read and no database query.
+    """
+    with _local_lock:
+        entry = _local_principals.get(token_key)
+    if entry is None:
+        try:
+            access_token = AccessToken(token_key)
+            user_id, expires = access_token["user_id"], access_token["exp"]
+        except (InvalidToken, TokenError, KeyError):
+            return None
+        principal = version = None
+    else:
+        user_id, expires, principal, version = entry
+
+    if expires <= time.time():
+        with _local_lock:
+            _local_principals.pop(token_key, None)
+        return None
+
+    current = _current_version(user_id)
+    if current is None:
+        # without the version the local entry may be stale too
+        principal = load_principal(user_id)
+        if principal is None:
+            return None
+    elif principal is None or version != current:
+        shared_key = _principal_key(user_id, current)
+        principal = _cache_get(shared_key)
+        if principal is None:
+            principal = load_principal(user_id)
+            if principal is None:
+                return None
+            _cache_set(shared_key, principal)
+        with _local_lock:
+            _local_principals[token_key] = (user_id, expires, principal, current)
+
+    return principal if principal.is_active else None
+
+
+def invalidate_principal(user_id):
+    """Drop the cached principal of `user_id` once the current transaction commits."""
+
+    def _bump():
+        key = _version_key(user_id)
+        try:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.add(key, time.time_ns(), timeout=None)
+        except Exception as e:
+            # other processes keep the old principal until its TTL runs out
+            logger.error(f"Could not invalidate the principal of user {user_id}: {e}")
+
+    transaction.on_commit(_bump)
@@ -1,6 +1,7 @@
 from rest_framework import serializers
+from django.contrib.contenttypes.models import ContentType
 
-from workflows.models import ApprovalTask
+from workflows.models import ApprovalTask, WorkflowAction
 
 class ApprovalTaskStatusUpdateSerializer(serializers.Serializer):
     status = serializers.ChoiceField(choices= [
@@ -10,3 +11,106 @@ class ApprovalTaskStatusUpdateSerializer(serializers.Serializer):
         ("rejected", "Rejected"),
         ("terminated", "Terminated"),
     ])
+
+
+class WorkflowStartSerializer(serializers.Serializer):
+    action_code = serializers.CharField(max_length=100)
+    content_type = serializers.CharField(
+        help_text="Model of the objects needing approval, as `app_label.model`."
+    )
+    object_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False
+    )
+
+    def validate_content_type(self, value):
+        from workflows.services import institution_field
+
+        try:
+            app_label, model = value.lower().split(".")
+            content_type = ContentType.objects.get_by_natural_key(app_label, model)
+        except (ValueError, ContentType.DoesNotExist):
+            raise serializers.ValidationError(f"Unknown content type {value!r}.")
+        model_class = content_type.model_class()
+        if model_class is None:
+            raise serializers.ValidationError(f"Unknown content type {value!r}.")
+        # approving the last stage calls finish_workflow() on the object
+        if not hasattr(model_class, "finish_workflow"):
+            raise serializers.ValidationError(f"{value} has no finish_workflow().")
+        if institution_field(model_class) is None:
+            raise serializers.ValidationError(f"{value} does not belong to an Institution.")
+        return content_type
+
+    def validate_action_code(self, value):
+        if not WorkflowAction.objects.filter(code=value).exists():
+            raise serializers.ValidationError(f"Unknown workflow action {value!r}.")
+        return value
+
+
+class InstitutionApprovalStepCreateSerializer(serializers.Serializer):
+    # without an explicit `level` the step goes after this action's last level
+    action = serializers.IntegerField(required=False, min_value=1)
+
+
+class ApprovalTaskInboxFilterSerializer(serializers.Serializer):
+    status = serializers.MultipleChoiceField(
+        choices=ApprovalTask.STATUS_CHOICES, required=False
+    )
+    action = serializers.IntegerField(required=False)
+    institution = serializers.IntegerField(required=False)
+    updated_after = serializers.DateTimeField(required=False)
+    updated_before = serializers.DateTimeField(required=False)
+    detail = serializers.ChoiceField(choices=["row", "full"], default="full")
+    cursor = serializers.CharField(required=False)
+    page_size = serializers.IntegerField(required=False, min_value=1)
+
+
+class ApprovalTaskBulkStatusItemSerializer(serializers.Serializer):
+    task_id = serializers.IntegerField(min_value=1)
+    status = serializers.ChoiceField(choices=[
+        ("completed", "Completed"),
+        ("rejected", "Rejected"),
+    ])
+    comment = serializers.CharField(required=False, allow_blank=True, default="")
+
+
+class ApprovalTaskBulkStatusUpdateSerializer(serializers.Serializer):
+    tasks = ApprovalTaskBulkStatusItemSerializer(many=True, allow_empty=False, max_length=500)
+
+    def validate_tasks(self, value):
+        task_ids = [item["task_id"] for item in value]
+        if len(task_ids) != len(set(task_ids)):
+            raise serializers.ValidationError("Each task may only appear once.")
+        return value
+
+
+class ApprovalTaskBulkStatusResponseSerializer(serializers.Serializer):
+    updated = serializers.ListField(child=serializers.IntegerField())
+    failed = serializers.DictField(child=serializers.CharField())
+
+
+class TurnaroundReportFilterSerializer(serializers.Serializer):
+    granularity = serializers.ChoiceField(choices=["hour", "day"], default="day")
+    group_by = serializers.ChoiceField(
+        choices=["step", "action", "institution"], default="step"
+    )
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    action = serializers.IntegerField(required=False)
+
+
+class TurnaroundReportRowSerializer(serializers.Serializer):
+    step = serializers.IntegerField(required=False)
+    action = serializers.IntegerField(required=False)
+    institution = serializers.IntegerField(required=False)
+    count = serializers.IntegerField()
+    avg_seconds = serializers.FloatField()
+    p95_seconds = serializers.FloatField()
+    max_seconds = serializers.FloatField()
+
+
+class EventExportFilterSerializer(serializers.Serializer):
+    output = serializers.ChoiceField(choices=["ndjson", "csv"], default="ndjson")
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    # resume after the last event id received
+    after = serializers.IntegerField(required=False, min_value=0)
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from users.serializers import ProfileSerializer
+from django.db.models import Manager, Prefetch, prefetch_related_objects
+from users.serializers import ProfileSerializer, user_serializer_prefetches
 from workflows.models import (
     ApprovalTask,
     InstitutionApprovalStep,
@@ -39,6 +40,48 @@ class InstitutionApproverUserSerializer(serializers.ModelSerializer):
         fields = ["id", "approver_user"]
 
 
+def approval_step_prefetches(prefix=""):
+    """
+    Lookups that let `InstitutionApprovalStepSerializer` serialize the steps
+    reached through `prefix` (e.g. "step__" for tasks) with a constant number
+    of queries, whatever the number of steps, roles or approvers.
+    """
+    return [
+        Prefetch(
+            f"{prefix}roles",
+            queryset=InstitutionApprovalStepApprovorRole.objects.select_related("approver_role"),
+            to_attr="prefetched_roles",
+        ),
+        Prefetch(
+            f"{prefix}approver",
+            queryset=InstitutionApprovalStepApprovorUser.objects.select_related(
+                "approver_user__user"
+            ).prefetch_related(*user_serializer_prefetches("approver_user__user__")),
+            to_attr="prefetched_approvers",
+        ),
+    ]
+
+
+def approval_step_queryset():
+    return InstitutionApprovalStep.objects.select_related("action__category").prefetch_related(
+        *approval_step_prefetches()
+    )
+
+
+def approval_task_queryset():
+    return ApprovalTask.objects.select_related(
+        "step__action__category", "approved_by__user"
+    ).prefetch_related(
+        *approval_step_prefetches("step__"),
+        *user_serializer_prefetches("approved_by__user__"),
+    )
+
+
+def approval_task_row_queryset():
+    """Queryset for `ApprovalTaskInboxSerializer`."""
+    return ApprovalTask.objects.select_related("step__action")
+
+
 class InstitutionApprovalStepSerializer(serializers.ModelSerializer):
    # returns a list of Role.name
     roles_details = serializers.SerializerMethodField()
@@ -64,10 +107,29 @@ class InstitutionApprovalStepSerializer(serializers.ModelSerializer):
             "action",
             "action_details",
             "level",
+            "sla",
+            "escalation_action",
+            "escalation_role",
+            "quorum",
+            "quorum_count",
         ]
 
+    def validate(self, attrs):
+        quorum = attrs.get("quorum", getattr(self.instance, "quorum", "all"))
+        quorum_count = attrs.get("quorum_count", getattr(self.instance, "quorum_count", None))
+        if quorum == "n_of_m" and not quorum_count:
+            raise serializers.ValidationError(
+                {"quorum_count": 'Required when quorum is "n_of_m".'}
+            )
+        return attrs
+
+    # Steps loaded with `approval_step_prefetches()` carry `prefetched_roles`
+    # and `prefetched_approvers`; anything else falls back to per-step queries.
+
     def get_roles(self, obj):
         # list of raw role-IDs
+        if hasattr(obj, "prefetched_roles"):
+            return [r.approver_role_id for r in obj.prefetched_roles]
         return list(
             InstitutionApprovalStepApprovorRole.objects
                 .filter(step=obj)
@@ -76,13 +138,18 @@ class InstitutionApprovalStepSerializer(serializers.ModelSerializer):
 
     def get_roles_details(self, obj):
         # fetch the actual Role objects and serialize them
-        qs = Role.objects.filter(
-            id__in=self.get_roles(obj)
-        )
+        if hasattr(obj, "prefetched_roles"):
+            qs = [r.approver_role for r in obj.prefetched_roles]
+        else:
+            qs = Role.objects.filter(
+                id__in=self.get_roles(obj)
+            )
         return WorkFlowRoleSerializer(qs, many=True).data
 
     def get_approvers(self, obj):
         # return the PKs of the through‐model instances
+        if hasattr(obj, "prefetched_approvers"):
+            return [a.id for a in obj.prefetched_approvers]
         return list(
             InstitutionApprovalStepApprovorUser.objects
                 .filter(step=obj)
@@ -91,7 +158,10 @@ class InstitutionApprovalStepSerializer(serializers.ModelSerializer):
 
     def get_approvers_details(self, obj):
         # grab the through‐model queryset
-        qs = InstitutionApprovalStepApprovorUser.objects.filter(step=obj)
+        if hasattr(obj, "prefetched_approvers"):
+            qs = obj.prefetched_approvers
+        else:
+            qs = InstitutionApprovalStepApprovorUser.objects.filter(step=obj)
         # serialize each with its own ID + nested Profile
         return InstitutionApproverUserSerializer(qs, many=True).data
 
@@ -136,6 +206,24 @@ class ApprovalTaskStatusUpdateSerializer(serializers.ModelSerializer):
         fields = ["id", "step", "status", "updated_at", "content_object", "object_id"]
 
 
+def task_content_label(task):
+    return task.display_label or str(task.content_object)
+
+
+class ApprovalTaskListSerializer(serializers.ListSerializer):
+    """
+    Loads the content objects of tasks without a `display_label` in one
+    query per content type, instead of one query per task.
+    """
+
+    def to_representation(self, data):
+        tasks = list(data.all() if isinstance(data, Manager) else data)
+        prefetch_related_objects(
+            [task for task in tasks if not task.display_label], "content_object"
+        )
+        return super().to_representation(tasks)
+
+
 class ApprovalTaskSerializer(serializers.ModelSerializer):
     step = InstitutionApprovalStepSerializer()
     content_object = serializers.SerializerMethodField()
@@ -143,6 +231,40 @@ class ApprovalTaskSerializer(serializers.ModelSerializer):
     class Meta:
         model = ApprovalTask
         fields = ["id", "step", "status", "updated_at", "content_object", "object_id", "comment", "approved_by"]
+        list_serializer_class = ApprovalTaskListSerializer
+
+    def get_content_object(self, obj):
+        return task_content_label(obj)
+
+
+class ApprovalTaskInboxSerializer(serializers.ModelSerializer):
+    """Flat inbox row of a task, its step and action (see `approval_task_row_queryset`)."""
+
+    institution = serializers.IntegerField(source="step.Institution_id")
+    step_name = serializers.CharField(source="step.step_name")
+    level = serializers.IntegerField(source="step.level")
+    action = serializers.IntegerField(source="step.action_id")
+    action_label = serializers.CharField(source="step.action.label")
+    content_object = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ApprovalTask
+        fields = [
+            "id",
+            "status",
+            "updated_at",
+            "institution",
+            "step",
+            "step_name",
+            "level",
+            "action",
+            "action_label",
+            "content_type",
+            "object_id",
+            "content_object",
+            "approved_by",
+        ]
+        list_serializer_class = ApprovalTaskListSerializer
 
     def get_content_object(self, obj):
-        return str(obj.content_object)
+        return task_content_label(obj)
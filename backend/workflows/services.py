@@ -0,0 +1,357 @@
+from itertools import islice
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction as db_transaction
+from django.db.models import Case, PositiveIntegerField, Q, Value, When
+from django.utils import timezone
+
+from workflows.assignments import assign_tasks, step_user_ids
+from workflows.chain import (
+    bump_chain_version,
+    freeze_chain,
+    get_approval_chain,
+    get_definition_chain,
+)
+from workflows.deltas import (
+    DELTA_MAX_CHANGES,
+    REMOVED,
+    RESYNC,
+    STATUS_CHANGED,
+    assignee_changes,
+    enqueue_task_deltas,
+    merge_changes,
+)
+from workflows.models import (
+    ApprovalTask,
+    ApprovalTaskAssignment,
+    InstitutionApprovalStep,
+    WorkflowAction,
+)
+from workflows.outbox import enqueue
+from workflows.transitions import OPEN_STATUSES, relevel_open_tasks
+
+START_WORKFLOW_CHUNK_SIZE = 1000
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def institution_field(model):
+    """Name of `model`'s foreign key to Institution, or None."""
+    from institution.models import Institution
+
+    for field in model._meta.concrete_fields:
+        if field.many_to_one and field.related_model is Institution:
+            return field.name
+    return None
+
+
+def start_workflow(action_code, institution, objects, chunk_size=START_WORKFLOW_CHUNK_SIZE):
+    """
+    Create the `ApprovalTask`s of `action_code` for every object in `objects`.
+
+    The step chain is resolved and frozen into a `WorkflowDefinition` once,
+    tasks are inserted with `bulk_create` in chunks of `chunk_size` objects
+    (first stage `pending`, the rest `not_started`, all labelled with
+    `str(obj)`) and each first-level approver receives a single notification
+    through the notification outbox. Objects that already have tasks for the
+    action are skipped.
+
+    Returns `(started, skipped_ids)`: the number of objects the workflow was
+    started for and the pks of the skipped objects.
+    """
+    action = WorkflowAction.objects.get(code=action_code)
+    institution_id = getattr(institution, "pk", institution)
+    chain = get_approval_chain(institution_id, action.id)
+    if not chain.levels:
+        raise ValueError(
+            f"No approval steps configured for {action_code!r} in institution {institution_id}"
+        )
+
+    first_stage = {level.step_id: level for level in chain.first_stage}
+    started_at = timezone.now()
+    step_ids = [level.step_id for level in chain.levels]
+    users_by_step = step_user_ids(step_ids)
+    object_count = 0
+    skipped_ids = []
+    task_ids = []
+
+    with db_transaction.atomic():
+        definition_id = freeze_chain(chain)
+        for chunk in _chunked(objects, chunk_size):
+            keyed = [(ContentType.objects.get_for_model(obj).pk, obj) for obj in chunk]
+            started = set(
+                ApprovalTask.objects.filter(
+                    _object_filter((content_type_id, obj.pk) for content_type_id, obj in keyed),
+                    step__Institution_id=institution_id,
+                    step__action_id=action.id,
+                ).values_list("content_type_id", "object_id")
+            )
+
+            tasks = []
+            new_keys = []
+            for content_type_id, obj in keyed:
+                if (content_type_id, obj.pk) in started:
+                    skipped_ids.append(obj.pk)
+                    continue
+                new_keys.append((content_type_id, obj.pk))
+                display_label = ApprovalTask.display_label_for(obj)
+                for level in chain.levels:
+                    first = level.step_id in first_stage
+                    tasks.append(
+                        ApprovalTask(
+                            step_id=level.step_id,
+                            definition_id=definition_id,
+                            content_type_id=content_type_id,
+                            object_id=obj.pk,
+                            display_label=display_label,
+                            status="pending" if first else "not_started",
+                            started_at=started_at if first else None,
+                            due_at=level.due_at(started_at) if first else None,
+                        )
+                    )
+            if not new_keys:
+                continue
+            ApprovalTask.objects.bulk_create(tasks, batch_size=chunk_size, ignore_conflicts=True)
+
+            # ignore_conflicts leaves the pks unset, so read the new tasks back
+            task_ids += assign_tasks(
+                ApprovalTask.objects.filter(_object_filter(new_keys), step_id__in=step_ids),
+                users_by_step,
+            )
+            object_count += len(new_keys)
+
+        if object_count:
+            # past DELTA_MAX_CHANGES objects approvers resync their task lists
+            # rather than receiving every new row
+            listed = object_count <= DELTA_MAX_CHANGES
+            enqueue(
+                "tasks_created",
+                user_ids=sorted(set().union(*(users_by_step[step_id] for step_id in first_stage))),
+                step_name=", ".join(level.step_name for level in first_stage.values()),
+                task_count=object_count,
+                task_ids=task_ids if listed else None,
+                assignee_ids=[] if listed else sorted(set().union(*users_by_step.values())),
+            )
+
+    return object_count, skipped_ids
+
+
+def unauthorized_task_ids(user, task_ids):
+    """
+    Set-based permission check for acting on many tasks at once.
+
+    Returns `(missing_ids, forbidden_ids)`. Authorisation is answered from the
+    compiled approval chains, so it costs two queries however many tasks are
+    checked.
+    """
+    role_ids = set(user.user_roles.values_list("role_id", flat=True))
+    rows = ApprovalTask.objects.filter(id__in=task_ids).values_list(
+        "id",
+        "step_id",
+        "step__Institution_id",
+        "step__action_id",
+        "definition_id",
+        "escalated_at",
+    )
+
+    found, forbidden = set(), set()
+    for task_id, step_id, institution_id, action_id, definition_id, escalated_at in rows:
+        found.add(task_id)
+        if definition_id:
+            chain = get_definition_chain(definition_id)
+        else:
+            chain = get_approval_chain(institution_id, action_id)
+        if not chain.can_approve(step_id, user.id, role_ids, escalated=escalated_at is not None):
+            forbidden.add(task_id)
+    return set(task_ids) - found, forbidden
+
+
+def _object_filter(keys):
+    """A `Q` matching the tasks of the `(content_type_id, object_id)` pairs in `keys`."""
+    object_ids_by_type = {}
+    for content_type_id, object_id in keys:
+        object_ids_by_type.setdefault(content_type_id, []).append(object_id)
+    object_filter = Q()
+    for content_type_id, object_ids in object_ids_by_type.items():
+        object_filter |= Q(content_type_id=content_type_id, object_id__in=object_ids)
+    return object_filter
+
+
+def bulk_update_task_status(user, updates):
+    """
+    Apply many approve/reject transitions in one transaction.
+
+    `updates` maps task ids to `(status, comment)` with status `completed` or
+    `rejected`. Tasks are processed per object in level order, so completing
+    consecutive levels of the same object in one batch works. Nothing is
+    locked up front: each transition is a compare-and-swap, and a task changed
+    by someone else in the meantime is reported in `failed` while the rest of
+    the batch goes through. Each affected user receives one coalesced
+    notification, recorded in the notification outbox.
+
+    Returns `(updated_ids, failed)` where `failed` maps task ids to the reason
+    their transition was refused.
+    """
+    updated, failed = [], {}
+
+    with db_transaction.atomic():
+        tasks = list(
+            ApprovalTask.objects.filter(id__in=updates)
+            .select_related("step")
+            .prefetch_related("content_object")
+            .order_by("id")
+        )
+        tasks_by_id = {task.id: task for task in tasks}
+        tasks.sort(key=lambda t: (t.content_type_id, t.object_id, t.step.level))
+
+        # every task whose status moved, including activated and terminated ones
+        changed_ids = set()
+        for task in tasks:
+            new_status, comment = updates[task.id]
+            task.comment = comment
+            try:
+                if new_status == "completed":
+                    activated, terminated_ids = task.mark_completed(user, notify=False)
+                    for next_task in activated:
+                        changed_ids.add(next_task.id)
+                        if next_task.id in tasks_by_id:
+                            tasks_by_id[next_task.id].status = next_task.status
+                            tasks_by_id[next_task.id].version = next_task.version
+                else:
+                    terminated_ids = task.mark_rejected(user, notify=False) or ()
+                for terminated_id in terminated_ids:
+                    changed_ids.add(terminated_id)
+                    if terminated_id in tasks_by_id:
+                        tasks_by_id[terminated_id].status = "terminated"
+                        tasks_by_id[terminated_id].version += 1
+            except ValueError as e:
+                failed[task.id] = str(e)
+                continue
+            updated.append(task.id)
+            changed_ids.add(task.id)
+
+        if updated:
+            changed = [tasks_by_id[task_id] for task_id in updated]
+            enqueue(
+                "bulk_task_updates",
+                updates_by_user=_coalesce_recipients(changed, user),
+                actor_id=user.id,
+                task_ids=sorted(changed_ids),
+            )
+
+    return updated, failed
+
+
+def _coalesce_recipients(tasks, actor):
+    """Map every user involved in the objects of `tasks` to how many of them changed."""
+    changed_per_object = {}
+    for task in tasks:
+        key = (task.content_type_id, task.object_id)
+        changed_per_object[key] = changed_per_object.get(key, 0) + 1
+
+    objects_by_user = {}
+    assignments = ApprovalTaskAssignment.objects.filter(
+        task__in=ApprovalTask.objects.filter(_object_filter(changed_per_object))
+    ).values_list("user_id", "task__content_type_id", "task__object_id")
+    for user_id, content_type_id, object_id in assignments:
+        objects_by_user.setdefault(user_id, set()).add((content_type_id, object_id))
+
+    # the owners of the objects hear about their approvals too
+    for task in tasks:
+        created_by_id = getattr(task.content_object, "created_by_id", None)
+        if created_by_id:
+            objects_by_user.setdefault(created_by_id, set()).add(
+                (task.content_type_id, task.object_id)
+            )
+
+    objects_by_user.pop(actor.id, None)
+    return {
+        user_id: sum(changed_per_object[key] for key in keys)
+        for user_id, keys in objects_by_user.items()
+    }
+
+
+def reorder_steps(institution_id, action_id, new_levels):
+    """
+    Move the steps of one action to the levels in `new_levels` (`{step_id:
+    level}`; steps left out keep theirs) and re-level the in-flight tasks.
+    Steps given the same level form a parallel stage.
+
+    The steps move in a single `UPDATE ... CASE` however many there are.
+    Unlike other step edits, a reorder also applies to workflows in flight:
+    their open tasks move to a copy of their own `WorkflowDefinition` with
+    the new levels, and each object's lowest open stage becomes pending (see
+    `relevel_open_tasks`). Users
+    assigned to the moved steps are told to resync, since every row they
+    hold shows a new level.
+
+    Returns the ids of the steps whose level changed.
+    """
+    with db_transaction.atomic():
+        steps = InstitutionApprovalStep.objects.filter(
+            Institution_id=institution_id, action_id=action_id
+        )
+        # locks the chain against concurrent reorders
+        current = {
+            step_id: (level, sla)
+            for step_id, level, sla in steps.select_for_update().values_list("id", "level", "sla")
+        }
+        moved = [
+            step_id for step_id, level in new_levels.items() if current[step_id][0] != level
+        ]
+        if not moved:
+            return []
+
+        steps.filter(id__in=moved).update(
+            level=Case(
+                *[When(id=step_id, then=Value(new_levels[step_id])) for step_id in moved],
+                output_field=PositiveIntegerField(),
+            )
+        )
+
+        # Workflows in flight move to a copy of their own definition with only
+        # the levels changed; approver edits made since they started stay out.
+        open_tasks = ApprovalTask.objects.filter(
+            step__Institution_id=institution_id,
+            step__action_id=action_id,
+            status__in=OPEN_STATUSES,
+            definition__isnull=False,
+        )
+        moved_levels = {step_id: new_levels[step_id] for step_id in moved}
+        for definition_id in set(open_tasks.values_list("definition_id", flat=True)):
+            relevelled = get_definition_chain(definition_id).relevel(moved_levels)
+            open_tasks.filter(definition_id=definition_id).update(
+                definition_id=freeze_chain(relevelled)
+            )
+
+        promoted_ids, demoted_ids = relevel_open_tasks(
+            institution_id, action_id, {step_id: sla for step_id, (_, sla) in current.items()}
+        )
+        # deadline reassignments belong to the pending task they were made for
+        stale = ApprovalTaskAssignment.objects.filter(task_id__in=demoted_ids, escalated=True)
+        changes = {}
+        for user_id, task_id in stale.values_list("user_id", "task_id"):
+            merge_changes(changes, {user_id: {task_id: REMOVED}})
+        stale.delete()
+
+        merge_changes(changes, assignee_changes(promoted_ids + demoted_ids, STATUS_CHANGED))
+        merge_changes(
+            changes,
+            {
+                user_id: RESYNC
+                for user_id in ApprovalTaskAssignment.objects.filter(task__step_id__in=moved)
+                .values_list("user_id", flat=True)
+                .distinct()
+            },
+        )
+        enqueue_task_deltas(changes)
+        # the chain is cached by version and updates skip signals
+        bump_chain_version(institution_id, action_id)
+    return moved
@@ -1,5 +1,106 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.db import transaction as db_transaction
 from django.dispatch import receiver
 from django.contrib.contenttypes.models import ContentType
-from workflows.models import WorkflowAction, InstitutionApprovalStep, ApprovalTask
+from institution.models import Institution
+from users.models import CustomUser, Profile, UserRole
+from workflows.assignments import (
+    assign_tasks,
+    rebuild_user_assignments,
+    schedule_step_rebuild,
+    sync_task_status,
+)
+from workflows.chain import bump_chain_version
+from workflows.principals import invalidate_principal
+from workflows.models import (
+    WorkflowAction,
+    InstitutionApprovalStep,
+    InstitutionApprovalStepApprovorRole,
+    InstitutionApprovalStepApprovorUser,
+    ApprovalTask,
+)
+
+
+def _cascading_from(kwargs, *models):
+    """Whether a post_delete was triggered by deleting an instance of `models`."""
+    return isinstance(kwargs.get("origin"), models)
+
+
+@receiver(pre_save, sender=InstitutionApprovalStep)
+def remember_previous_chain(sender, instance, **kwargs):
+    # A step moved to another action must also invalidate the chain it left.
+    instance._previous_chain = None
+    if instance.pk:
+        instance._previous_chain = (
+            InstitutionApprovalStep.objects.filter(pk=instance.pk)
+            .values_list("Institution_id", "action_id")
+            .first()
+        )
+
+
+@receiver(post_save, sender=InstitutionApprovalStep)
+@receiver(post_delete, sender=InstitutionApprovalStep)
+def invalidate_chain_for_step(sender, instance, **kwargs):
+    bump_chain_version(instance.Institution_id, instance.action_id)
+    previous = getattr(instance, "_previous_chain", None)
+    if previous and previous != (instance.Institution_id, instance.action_id):
+        bump_chain_version(*previous)
+
+
+@receiver(post_save, sender=InstitutionApprovalStepApprovorRole)
+@receiver(post_delete, sender=InstitutionApprovalStepApprovorRole)
+@receiver(post_save, sender=InstitutionApprovalStepApprovorUser)
+@receiver(post_delete, sender=InstitutionApprovalStepApprovorUser)
+def invalidate_chain_for_step_link(sender, instance, **kwargs):
+    chain = (
+        InstitutionApprovalStep.objects.filter(pk=instance.step_id)
+        .values_list("Institution_id", "action_id")
+        .first()
+    )
+    if chain:
+        bump_chain_version(*chain)
+
+
+@receiver(post_save, sender=InstitutionApprovalStepApprovorRole)
+@receiver(post_delete, sender=InstitutionApprovalStepApprovorRole)
+@receiver(post_save, sender=InstitutionApprovalStepApprovorUser)
+@receiver(post_delete, sender=InstitutionApprovalStepApprovorUser)
+def sync_step_assignments(sender, instance, **kwargs):
+    # The step's tasks (and their assignments) are going away with it.
+    if _cascading_from(kwargs, InstitutionApprovalStep, Institution, CustomUser):
+        return
+    # once per step and transaction, however many rows the edit touched
+    schedule_step_rebuild(instance.step_id)
+
+
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def sync_user_assignments(sender, instance, **kwargs):
+    if _cascading_from(kwargs, CustomUser, Institution):
+        return
+    rebuild_user_assignments(instance.user_id)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_principal_for_user(sender, instance, update_fields=None, **kwargs):
+    # logins only touch last_login
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return
+    invalidate_principal(instance.pk)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+@receiver(post_save, sender=UserRole)
+@receiver(post_delete, sender=UserRole)
+def invalidate_principal_for_membership(sender, instance, **kwargs):
+    invalidate_principal(instance.user_id)
+
+
+@receiver(post_save, sender=ApprovalTask)
+def sync_task_assignments(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        assign_tasks(ApprovalTask.objects.filter(pk=instance.pk))
+    elif update_fields is None or {"status", "updated_at"} & set(update_fields):
+        sync_task_status([instance.pk], instance.status, instance.updated_at)
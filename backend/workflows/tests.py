@@ -1,3 +1,1469 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+from datetime import timedelta
 
-# Create your tests here.
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection
+from django.db.models import F, Q
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from institution.models import Branch, Institution, UserBranch
+from users.models import (
+    CustomUser,
+    Permission,
+    PermissionCategory,
+    Profile,
+    Role,
+    RolePermission,
+    UserRole,
+)
+from workflows import (
+    analytics,
+    chain,
+    deltas,
+    escalation,
+    framing,
+    notifications,
+    outbox,
+    presence,
+    principals,
+)
+from workflows.assignments import user_tasks_queryset
+from workflows.consumers import NotificationConsumer
+from workflows.events import EXPORT_FIELDS, csv_lines, iter_events, ndjson_lines
+from workflows.models import (
+    ApprovalTask,
+    ApprovalTaskAssignment,
+    ApprovalTaskEvent,
+    ApprovalTurnaroundRollup,
+    InstitutionApprovalStep,
+    InstitutionApprovalStepApprovorRole,
+    InstitutionApprovalStepApprovorUser,
+    WorkflowAction,
+    WorkflowCategory,
+    WorkflowDefinition,
+    WorkflowNotificationOutbox,
+)
+from workflows.serializers import (
+    ApprovalTaskInboxSerializer,
+    ApprovalTaskSerializer,
+    InstitutionApprovalStepSerializer,
+    approval_step_queryset,
+    approval_task_queryset,
+    approval_task_row_queryset,
+)
+from workflows.services import bulk_update_task_status, reorder_steps, start_workflow
+from workflows.transitions import OPEN_STATUSES, activate_stage
+from workflows.views import (
+    ApproveTaskAPIView,
+    ApproveTaskBulkStatusAPIView,
+    ApproveTaskDetailAPIView,
+    InstitutionApprovalStepAPIView,
+    TurnaroundReportAPIView,
+    WorkflowEventExportAPIView,
+    WorkflowStartAPIView,
+)
+
+
+# the suite needs a database but no Redis
+LOCAL_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+LOCAL_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+class WorkflowTestMixin:
+    """Builds an institution with one approval chain of `step_count` steps."""
+
+    @classmethod
+    def setUpClass(cls):
+        local_services = override_settings(
+            CACHES=LOCAL_CACHES, CHANNEL_LAYERS=LOCAL_CHANNEL_LAYERS
+        )
+        local_services.enable()
+        cls.addClassCleanup(local_services.disable)
+        super().setUpClass()
+
+    @classmethod
+    def create_workflow(cls, step_count=3, approvers_per_step=2):
+        # ids are reused after each rollback; drop chains cached by other tests
+        cache.clear()
+        chain._local_chains.clear()
+        cls.owner = CustomUser.objects.create_user("owner@example.com", "pass", fullname="Owner")
+        cls.institution = Institution.objects.create(
+            institution_owner=cls.owner, institution_name="Acme", created_by=cls.owner
+        )
+        cls.branch = Branch.objects.filter(institution=cls.institution).first()
+        category = WorkflowCategory.objects.create(code="product_workflows", label="Products")
+        cls.action = WorkflowAction.objects.create(
+            category=category, code="product_creation", label="Product creation"
+        )
+        permission_category = PermissionCategory.objects.create(
+            permission_category_name="Products", permission_category_description=""
+        )
+        permission = Permission.objects.create(
+            permission_code="can_approve",
+            permission_name="Can approve",
+            category=permission_category,
+        )
+
+        cls.approvers = []
+        for level in range(1, step_count + 1):
+            step = InstitutionApprovalStep.objects.create(
+                Institution=cls.institution,
+                step_name=f"Level {level}",
+                action=cls.action,
+                level=level,
+            )
+            role = Role.objects.create(
+                name=f"approver {level}", description="", institution=cls.institution
+            )
+            RolePermission.objects.create(role=role, permission=permission)
+            InstitutionApprovalStepApprovorRole.objects.create(step=step, approver_role=role)
+            for index in range(approvers_per_step):
+                user = CustomUser.objects.create_user(
+                    f"approver{level}.{index}@example.com", "pass", fullname=f"Approver {level}.{index}"
+                )
+                UserRole.objects.create(user=user, role=role)
+                UserBranch.objects.create(user=user, branch=cls.branch)
+                profile = Profile.objects.create(user=user, institution=cls.institution)
+                InstitutionApprovalStepApprovorUser.objects.create(step=step, approver_user=profile)
+                cls.approvers.append(user)
+
+
+class InstitutionApprovalStepSerializerQueryTests(WorkflowTestMixin, TestCase):
+    # steps, roles, approvers (+profile, user), user roles, role permissions, branches
+    STEP_QUERIES = 6
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=8, approvers_per_step=3)
+
+    def serialize_steps(self, limit):
+        steps = approval_step_queryset().filter(Institution=self.institution)[:limit]
+        return InstitutionApprovalStepSerializer(steps, many=True).data
+
+    def test_query_count_does_not_grow_with_steps(self):
+        with self.assertNumQueries(self.STEP_QUERIES):
+            one = self.serialize_steps(1)
+        with self.assertNumQueries(self.STEP_QUERIES):
+            many = self.serialize_steps(8)
+
+        self.assertEqual(len(one), 1)
+        self.assertEqual(len(many), 8)
+
+    def test_prefetched_output_matches_unprefetched(self):
+        steps = InstitutionApprovalStep.objects.filter(Institution=self.institution)
+        expected = InstitutionApprovalStepSerializer(steps, many=True).data
+
+        self.assertEqual(self.serialize_steps(8), expected)
+
+
+class ApprovalTaskSerializerQueryTests(WorkflowTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=1)
+        cls.objects = [
+            CustomUser.objects.create(email=f"object{i}@example.com", fullname=f"Object {i}")
+            for i in range(30)
+        ]
+        start_workflow(cls.action.code, cls.institution, cls.objects)
+
+    def count_queries(self, serializer_class, queryset):
+        with CaptureQueriesContext(connection) as queries:
+            data = serializer_class(queryset, many=True).data
+        return len(queries), data
+
+    def test_labelled_rows_do_not_load_content_objects(self):
+        with self.assertNumQueries(1):
+            rows = ApprovalTaskInboxSerializer(
+                approval_task_row_queryset().order_by("id"), many=True
+            ).data
+
+        self.assertEqual(len(rows), 60)
+        self.assertEqual(rows[0]["content_object"], str(self.objects[0]))
+
+    def test_content_objects_are_loaded_once_per_content_type(self):
+        ApprovalTask.objects.update(display_label="")
+
+        for serializer_class, queryset in (
+            (ApprovalTaskInboxSerializer, approval_task_row_queryset()),
+            (ApprovalTaskSerializer, approval_task_queryset()),
+        ):
+            with self.subTest(serializer_class.__name__):
+                queryset = queryset.order_by("id")
+                one, _ = self.count_queries(serializer_class, queryset[:1])
+                many, data = self.count_queries(serializer_class, queryset)
+
+                self.assertEqual(one, many)
+                self.assertEqual(data[-1]["content_object"], str(self.objects[-1]))
+
+
+class InstitutionAccessTests(WorkflowTestMixin, TestCase):
+    """Institution-scoped endpoints are only open to the Institution's owner."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=1)
+        start_workflow(cls.action.code, cls.institution, [cls.owner])
+        cls.outsider = CustomUser.objects.create_user("outsider@example.com", "pass", fullname="Outsider")
+
+    def call(self, view, user, method="get", data=None, **kwargs):
+        request = getattr(APIRequestFactory(), method)("/", data, format="json" if method != "get" else None)
+        force_authenticate(request, user)
+        return view.as_view()(request, Institution_id=self.institution.id, **kwargs)
+
+    def test_event_export_is_owner_only(self):
+        self.assertEqual(self.call(WorkflowEventExportAPIView, self.outsider).status_code, 403)
+        self.assertEqual(self.call(WorkflowEventExportAPIView, self.approvers[0]).status_code, 403)
+
+        self.assertEqual(self.call(WorkflowEventExportAPIView, self.owner).status_code, 200)
+
+    def test_start_workflow_checks_institution_and_objects(self):
+        other_owner = CustomUser.objects.create_user("other@example.com", "pass", fullname="Other")
+        other = Institution.objects.create(
+            institution_owner=other_owner, institution_name="Other", created_by=other_owner
+        )
+        foreign, _ = Profile.objects.update_or_create(user=other_owner, defaults={"institution": other})
+        own = Profile.objects.get(user=self.approvers[0])
+
+        def start(user, content_type, object_ids):
+            data = {"action_code": self.action.code, "content_type": content_type, "object_ids": object_ids}
+            return self.call(WorkflowStartAPIView, user, "post", data)
+
+        # profiles stand in for a model that can finish a workflow
+        with mock.patch.object(Profile, "finish_workflow", create=True):
+            self.assertEqual(start(self.outsider, "users.profile", [own.id]).status_code, 403)
+            self.assertEqual(start(self.owner, "users.customuser", [self.owner.id]).status_code, 400)
+            response = start(self.owner, "users.profile", [own.id, foreign.id])
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data["object_ids"], [foreign.id])
+
+            self.assertEqual(start(self.approvers[1], "users.profile", [own.id]).status_code, 201)
+
+    def test_step_create_rejects_a_malformed_action(self):
+        data = {"step_name": "Final check", "action": "first"}
+        response = self.call(InstitutionApprovalStepAPIView, self.owner, "post", data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("action", response.data["detail"])
+
+        data["action"] = self.action.id
+        response = self.call(InstitutionApprovalStepAPIView, self.owner, "post", data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["level"], 3)
+
+    def test_turnaround_report_is_owner_only(self):
+        self.assertEqual(self.call(TurnaroundReportAPIView, self.outsider).status_code, 403)
+        self.assertEqual(self.call(TurnaroundReportAPIView, self.owner).status_code, 200)
+
+
+class InboxViewTests(WorkflowTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=1)
+        cls.objects = [
+            CustomUser.objects.create(email=f"object{i}@example.com", fullname=f"Object {i}")
+            for i in range(15)
+        ]
+        start_workflow(cls.action.code, cls.institution, cls.objects)
+
+    def get(self, **params):
+        request = APIRequestFactory().get("/", params)
+        force_authenticate(request, self.approvers[0])
+        return ApproveTaskAPIView.as_view()(request)
+
+    def test_default_is_the_list_of_nested_tasks(self):
+        response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 15)
+        self.assertEqual(response.data[0]["step"]["action_details"]["category"]["code"], "product_workflows")
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        for detail in ("row", "full"):
+            with self.subTest(detail=detail):
+                with CaptureQueriesContext(connection) as one:
+                    self.get(detail=detail, page_size=1).render()
+                with CaptureQueriesContext(connection) as many:
+                    self.get(detail=detail, page_size=15).render()
+
+                self.assertEqual(len(one), len(many))
+
+    def test_rows_are_paginated(self):
+        response = self.get(detail="row", page_size=10)
+
+        self.assertEqual(len(response.data["results"]), 10)
+        self.assertIsNotNone(response.data["next"])
+        self.assertEqual(response.data["results"][0]["step_name"], "Level 1")
+
+
+class WorkflowProgressTests(WorkflowTestMixin, TestCase):
+    """Approvals move a workflow through its stages until it is finished."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=3, approvers_per_step=1)
+        cls.steps = list(
+            InstitutionApprovalStep.objects.filter(Institution=cls.institution).order_by("level")
+        )
+        cls.item = CustomUser.objects.create(email="item@example.com", fullname="Item")
+
+    def setUp(self):
+        cache.clear()
+        chain._local_chains.clear()
+        patcher = mock.patch.object(CustomUser, "finish_workflow", create=True)
+        self.finish_workflow = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            start_workflow(self.action.code, self.institution, [self.item])
+
+    def task(self, step):
+        return ApprovalTask.objects.select_related("step").get(step=step, object_id=self.item.pk)
+
+    def statuses(self):
+        return [self.task(step).status for step in self.steps]
+
+    def approve(self, step):
+        task = self.task(step)
+        task.mark_completed(self.approvers[self.steps.index(step)], notify=False)
+
+    def test_reorder_behind_a_completed_step(self):
+        first, second, third = self.steps
+        self.start()
+        self.approve(first)
+        with self.captureOnCommitCallbacks(execute=True):
+            reorder_steps(self.institution.id, self.action.id, {third.id: 1, first.id: 3})
+        self.assertEqual(self.statuses(), ["completed", "not_started", "pending"])
+
+        self.approve(third)
+        self.assertEqual(self.statuses(), ["completed", "pending", "completed"])
+        # the completed step now sits at the last level and is not reopened
+        self.approve(second)
+        self.assertEqual(self.statuses(), ["completed", "completed", "completed"])
+        self.finish_workflow.assert_called_once()
+
+    def test_reorder_keeps_the_frozen_approvers(self):
+        first, second, third = self.steps
+        self.start()
+        newcomer = CustomUser.objects.create_user("newcomer@example.com", "pass", fullname="Newcomer")
+        profile, _ = Profile.objects.update_or_create(user=newcomer, defaults={"institution": self.institution})
+        InstitutionApprovalStepApprovorUser.objects.create(step=second, approver_user=profile)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reorder_steps(self.institution.id, self.action.id, {second.id: 1, first.id: 2})
+        task_chain = chain.get_chain_for_task(self.task(second))
+        self.assertEqual(
+            [(level.step_id, level.level) for level in task_chain.levels],
+            [(second.id, 1), (first.id, 2), (third.id, 3)],
+        )
+        self.assertNotIn(newcomer.id, task_chain.level_for_step(second.id).approver_user_ids)
+        self.assertEqual(self.statuses(), ["not_started", "pending", "not_started"])
+        self.assertEqual(
+            list(
+                ApprovalTaskEvent.objects.filter(task_id=self.task(first).id)
+                .order_by("id")
+                .values_list("from_status", "to_status")
+            )[-1],
+            ("pending", "not_started"),
+        )
+
+    def test_restart_skips_started_objects(self):
+        self.start()
+        item_task_ids = set(ApprovalTask.objects.filter(object_id=self.item.pk).values_list("id", flat=True))
+        InstitutionApprovalStep.objects.create(
+            Institution=self.institution, step_name="Level 4", action=self.action, level=4
+        )
+        other = CustomUser.objects.create(email="other@example.com", fullname="Other")
+        WorkflowNotificationOutbox.objects.all().delete()
+
+        started, skipped_ids = start_workflow(self.action.code, self.institution, [self.item, other])
+        self.assertEqual((started, skipped_ids), (1, [self.item.pk]))
+        self.assertEqual(
+            set(ApprovalTask.objects.filter(object_id=self.item.pk).values_list("id", flat=True)),
+            item_task_ids,
+        )
+        created = WorkflowNotificationOutbox.objects.get(event="tasks_created")
+        self.assertEqual(created.payload["task_count"], 1)
+        self.assertEqual(
+            set(created.payload["task_ids"]),
+            set(ApprovalTask.objects.filter(object_id=other.pk).values_list("id", flat=True)),
+        )
+
+    def test_step_edit_rebuilds_assignments_once(self):
+        step = InstitutionApprovalStep.objects.create(
+            Institution=self.institution, step_name="Level 4", action=self.action, level=4
+        )
+        roles = [
+            Role.objects.create(name=f"extra {n}", description="", institution=self.institution)
+            for n in range(3)
+        ]
+        with mock.patch("workflows.assignments.rebuild_step_assignments") as rebuild:
+            with self.captureOnCommitCallbacks(execute=True):
+                InstitutionApprovalStepApprovorRole.objects.filter(step=step).delete()
+                for role in roles:
+                    InstitutionApprovalStepApprovorRole.objects.create(step=step, approver_role=role)
+        rebuild.assert_called_once_with([step.id])
+
+    def test_role_change_keeps_frozen_assignments(self):
+        first = self.steps[0]
+        self.start()
+        task = self.task(first)
+        role = Role.objects.get(name="approver 1")
+        # later edits of the step only apply to workflows started afterwards
+        InstitutionApprovalStepApprovorRole.objects.filter(step=first).delete()
+        InstitutionApprovalStepApprovorUser.objects.filter(step=first).delete()
+
+        approver = self.approvers[0]
+        UserRole.objects.create(
+            user=approver, role=Role.objects.create(name="other", description="", institution=self.institution)
+        )
+        newcomer = CustomUser.objects.create_user("newcomer@example.com", "pass", fullname="Newcomer")
+        UserRole.objects.create(user=newcomer, role=role)
+
+        for user in (approver, newcomer):
+            self.assertEqual(list(user_tasks_queryset(user.id).values_list("id", flat=True)), [task.id])
+
+    def test_role_change_skips_finished_workflows(self):
+        self.start()
+        for step in self.steps:
+            self.approve(step)
+        approver = self.approvers[0]
+        role = Role.objects.create(name="other", description="", institution=self.institution)
+
+        with mock.patch("workflows.assignments.get_definition_chain") as get_definition_chain:
+            UserRole.objects.filter(user=approver).delete()
+            UserRole.objects.create(user=approver, role=role)
+        get_definition_chain.assert_not_called()
+        # decided tasks keep the assignments they were decided with
+        self.assertEqual(
+            list(user_tasks_queryset(approver.id).values_list("id", flat=True)),
+            [self.task(self.steps[0]).id],
+        )
+
+    def test_freeze_gives_up_on_lasting_integrity_errors(self):
+        relevelled = chain.get_approval_chain(self.institution.id, self.action.id).relevel(
+            {self.steps[0].id: 9}
+        )
+        error = IntegrityError("FOREIGN KEY constraint failed")
+        with mock.patch.object(WorkflowDefinition.objects, "create", side_effect=error) as create:
+            with self.assertRaises(IntegrityError):
+                chain.freeze_chain(relevelled)
+        self.assertEqual(create.call_count, chain.FREEZE_ATTEMPTS)
+
+    def test_approvals_without_the_cache(self):
+        self.start()
+        chain._local_chains.clear()
+        broken = mock.Mock(**{
+            f"{method}.side_effect": ConnectionError("cache is down")
+            for method in ("get", "add", "set", "incr")
+        })
+        with mock.patch.object(chain, "cache", broken), self.assertLogs(chain.logger, "WARNING"):
+            task_chain = chain.get_chain_for_task(self.task(self.steps[0]))
+            self.assertEqual([level.step_id for level in task_chain.levels], [step.id for step in self.steps])
+            for step in self.steps:
+                self.approve(step)
+            with self.captureOnCommitCallbacks(execute=True):
+                chain.bump_chain_version(self.institution.id, self.action.id)
+        self.assertEqual(self.statuses(), ["completed"] * 3)
+        self.finish_workflow.assert_called_once()
+
+
+class ApproveTaskViewTests(WorkflowTestMixin, TestCase):
+    """Approving and rejecting tasks through the status endpoints."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=1)
+        cls.item = CustomUser.objects.create(email="item@example.com", fullname="Item")
+        cls.other_item = CustomUser.objects.create(email="other@example.com", fullname="Other item")
+        start_workflow(cls.action.code, cls.institution, [cls.item, cls.other_item])
+        cls.task = ApprovalTask.objects.get(step__level=1, object_id=cls.item.pk)
+        cls.other_task = ApprovalTask.objects.get(step__level=1, object_id=cls.other_item.pk)
+
+    def setUp(self):
+        patcher = mock.patch.object(CustomUser, "finish_workflow", create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def update(self, user, data, task=None):
+        request = APIRequestFactory().patch("/", data, format="json")
+        force_authenticate(request, user)
+        return ApproveTaskDetailAPIView.as_view()(request, task_id=(task or self.task).id)
+
+    def concurrent_update(self, task):
+        """Approve `task` for someone else right after the transition read it."""
+        get_chain_for_task = chain.get_chain_for_task
+
+        def get_chain(read_task):
+            if read_task.pk == task.pk:
+                ApprovalTask.objects.filter(pk=task.pk).update(version=F("version") + 1)
+            return get_chain_for_task(read_task)
+
+        return mock.patch("workflows.chain.get_chain_for_task", get_chain)
+
+    def test_stale_version_conflicts(self):
+        with self.concurrent_update(self.task):
+            response = self.update(self.approvers[0], {"status": "completed"})
+        self.assertEqual(response.status_code, 409)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, "pending")
+
+    def test_bulk_update_reports_stale_tasks(self):
+        updates = {self.task.id: ("completed", ""), self.other_task.id: ("completed", "")}
+        with self.concurrent_update(self.task):
+            updated, failed = bulk_update_task_status(self.approvers[0], updates)
+        self.assertEqual(updated, [self.other_task.id])
+        self.assertEqual(list(failed), [self.task.id])
+        self.assertEqual(ApprovalTask.objects.get(pk=self.task.id).status, "pending")
+
+    def bulk_update(self, user, task_ids):
+        data = {"tasks": [{"task_id": task_id, "status": "completed"} for task_id in task_ids]}
+        request = APIRequestFactory().patch("/", data, format="json")
+        force_authenticate(request, user)
+        return ApproveTaskBulkStatusAPIView.as_view()(request)
+
+    def test_bulk_update_authorises_every_task(self):
+        missing_id = ApprovalTask.objects.order_by("-id").values_list("id", flat=True).first() + 1
+        task_ids = [self.task.id, self.other_task.id]
+
+        response = self.bulk_update(self.approvers[0], task_ids + [missing_id])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.data["task_ids"], [missing_id])
+
+        # the second level's approver may not act on the first level
+        response = self.bulk_update(self.approvers[1], task_ids)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.data["task_ids"], sorted(task_ids))
+        self.assertEqual(
+            set(ApprovalTask.objects.filter(id__in=task_ids).values_list("status", flat=True)),
+            {"pending"},
+        )
+
+        response = self.bulk_update(self.approvers[0], task_ids)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data["updated"]), sorted(task_ids))
+
+    def test_approval_rolls_back_with_its_notification(self):
+        enqueue = outbox.enqueue
+
+        def enqueue_failing_participants(event, **payload):
+            if event == "workflow_participants":
+                raise RuntimeError("outbox down")
+            return enqueue(event, **payload)
+
+        with mock.patch("workflows.outbox.enqueue", enqueue_failing_participants):
+            with self.assertRaises(RuntimeError):
+                self.update(self.approvers[0], {"status": "completed"})
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, "pending")
+
+        response = self.update(self.approvers[0], {"status": "completed"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(
+            WorkflowNotificationOutbox.objects.filter(event="workflow_participants").exists()
+        )
+
+
+class ParallelStageTests(WorkflowTestMixin, TestCase):
+    """Quorum rules of a stage of three parallel steps followed by a fourth."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=4, approvers_per_step=1)
+        cls.steps = list(
+            InstitutionApprovalStep.objects.filter(Institution=cls.institution).order_by("level")
+        )
+        InstitutionApprovalStep.objects.filter(id__in=[step.id for step in cls.steps[:3]]).update(level=1)
+        InstitutionApprovalStep.objects.filter(id=cls.steps[3].id).update(level=2)
+        cls.item = CustomUser.objects.create(email="item@example.com", fullname="Item")
+
+    def setUp(self):
+        patcher = mock.patch.object(CustomUser, "finish_workflow", create=True)
+        self.finish_workflow = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self, quorum, quorum_count=None):
+        InstitutionApprovalStep.objects.filter(Institution=self.institution).update(
+            quorum=quorum, quorum_count=quorum_count
+        )
+        # the updates above skip the signals that invalidate cached chains,
+        # and definition ids are reused once a test rolls back
+        cache.clear()
+        chain._local_chains.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            start_workflow(self.action.code, self.institution, [self.item])
+
+    def task(self, index):
+        return ApprovalTask.objects.select_related("step").get(
+            step=self.steps[index], object_id=self.item.pk
+        )
+
+    def statuses(self):
+        return [self.task(index).status for index in range(4)]
+
+    def decide(self, index, decision):
+        task = self.task(index)
+        if decision == "completed":
+            return task.mark_completed(self.approvers[index], notify=False)
+        return task.mark_rejected(self.approvers[index], notify=False)
+
+    def test_all_waits_for_every_step(self):
+        self.start("all")
+        self.assertEqual(self.statuses(), ["pending", "pending", "pending", "not_started"])
+        self.assertEqual(self.decide(0, "completed"), ([], []))
+        self.decide(1, "completed")
+        self.assertEqual(self.statuses(), ["completed", "completed", "pending", "not_started"])
+
+        activated, _ = self.decide(2, "completed")
+        self.assertEqual([task.step_id for task in activated], [self.steps[3].id])
+
+    def test_any_terminates_the_siblings(self):
+        self.start("any")
+        activated, terminated_ids = self.decide(1, "completed")
+
+        self.assertEqual(self.statuses(), ["terminated", "completed", "terminated", "pending"])
+        self.assertCountEqual(terminated_ids, [self.task(0).id, self.task(2).id])
+
+    def test_n_of_m_waits_for_the_quorum(self):
+        self.start("n_of_m", quorum_count=2)
+        self.decide(0, "completed")
+        self.assertEqual(self.statuses(), ["completed", "pending", "pending", "not_started"])
+        self.decide(2, "completed")
+        self.assertEqual(self.statuses(), ["completed", "terminated", "completed", "pending"])
+
+    def test_all_is_rejected_by_one_approver(self):
+        self.start("all")
+        terminated_ids = self.decide(0, "rejected")
+
+        self.assertEqual(len(terminated_ids), 3)
+        self.assertEqual(self.statuses(), ["rejected", "terminated", "terminated", "terminated"])
+        self.finish_workflow.assert_called_once()
+
+    def test_any_carries_on_while_an_approver_is_left(self):
+        self.start("any")
+        self.assertIsNone(self.decide(0, "rejected"))
+        self.assertIsNone(self.decide(1, "rejected"))
+        self.finish_workflow.assert_not_called()
+        self.assertEqual(self.statuses(), ["rejected", "rejected", "pending", "not_started"])
+
+        self.decide(2, "completed")
+        self.assertEqual(self.statuses(), ["rejected", "rejected", "completed", "pending"])
+
+    def test_n_of_m_is_rejected_once_the_quorum_is_unreachable(self):
+        self.start("n_of_m", quorum_count=2)
+        self.assertIsNone(self.decide(0, "rejected"))
+        self.decide(1, "rejected")
+
+        self.assertEqual(self.statuses(), ["rejected", "rejected", "terminated", "terminated"])
+        self.finish_workflow.assert_called_once()
+
+    def test_stage_already_activated_is_left_alone(self):
+        self.start("all")
+        stage = ApprovalTask.objects.filter(step__in=self.steps[:3], object_id=self.item.pk)
+
+        self.assertEqual(activate_stage(stage, ()), [])
+        self.assertEqual(self.statuses(), ["pending", "pending", "pending", "not_started"])
+
+
+class EscalationTests(WorkflowTestMixin, TestCase):
+    """Overdue pending tasks are escalated once, according to their step."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=1)
+        cls.steps = list(
+            InstitutionApprovalStep.objects.filter(Institution=cls.institution).order_by("level")
+        )
+        cls.item = CustomUser.objects.create(email="item@example.com", fullname="Item")
+
+    def setUp(self):
+        cache.clear()
+        chain._local_chains.clear()
+        patcher = mock.patch.object(CustomUser, "finish_workflow", create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start(self, action, role=None):
+        InstitutionApprovalStep.objects.filter(pk=self.steps[0].pk).update(
+            sla=timedelta(hours=1), escalation_action=action, escalation_role=role
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            start_workflow(self.action.code, self.institution, [self.item])
+        WorkflowNotificationOutbox.objects.all().delete()
+
+    def task(self, step):
+        return ApprovalTask.objects.get(step=step, object_id=self.item.pk)
+
+    def overdue(self):
+        return timezone.now() + timedelta(hours=2)
+
+    def test_notify_reminds_the_approvers_once(self):
+        self.start("notify")
+        task = self.task(self.steps[0])
+
+        self.assertIsNone(escalation.escalate_task(task.id))  # not due yet
+        self.assertEqual(escalation.escalate_task(task.id, self.overdue()), "notify")
+        self.assertIsNone(escalation.escalate_task(task.id, self.overdue()))
+
+        task.refresh_from_db()
+        self.assertEqual(task.status, "pending")
+        self.assertIsNotNone(task.escalated_at)
+        event = ApprovalTaskEvent.objects.get(task=task, payload__escalation="notify")
+        self.assertEqual((event.from_status, event.to_status), ("pending", "pending"))
+
+        presence.user_connected(self.approvers[0].id)
+        with mock.patch.object(notifications, "fan_out") as fan_out:
+            self.assertEqual(outbox.dispatch_pending(), (1, 0))
+        [(group, message)] = list(fan_out.call_args.args[0])
+        self.assertEqual(group, notifications.user_group(self.approvers[0].id))
+        self.assertTrue(message["urgent"])
+
+    def test_reassign_assigns_the_escalation_role(self):
+        role = Role.objects.get(institution=self.institution, name="approver 2")
+        self.start("reassign", role=role)
+        task = self.task(self.steps[0])
+
+        self.assertEqual(escalation.escalate_task(task.id, self.overdue()), "reassign")
+        escalated = ApprovalTaskAssignment.objects.filter(task=task, escalated=True)
+        self.assertEqual({a.user_id for a in escalated}, {self.approvers[1].id})
+        self.assertIn(task, user_tasks_queryset(self.approvers[1].id))
+        task_chain = chain.get_chain_for_task(task)
+        role_ids = [role.id]
+        self.assertFalse(task_chain.can_approve(task.step_id, self.approvers[1].id, role_ids))
+        self.assertTrue(
+            task_chain.can_approve(task.step_id, self.approvers[1].id, role_ids, escalated=True)
+        )
+
+    def test_reassign_without_a_role_goes_to_the_owner(self):
+        self.start("reassign")
+        task = self.task(self.steps[0])
+
+        self.assertEqual(escalation.escalate_task(task.id, self.overdue()), "reassign")
+        escalated = ApprovalTaskAssignment.objects.filter(task=task, escalated=True)
+        self.assertEqual({a.user_id for a in escalated}, {self.owner.id})
+
+    def test_auto_advance_approves_and_starts_the_next_level(self):
+        self.start("auto_advance")
+        task = self.task(self.steps[0])
+
+        self.assertEqual(escalation.escalate_task(task.id, self.overdue()), "auto_advance")
+        task.refresh_from_db()
+        self.assertEqual(task.status, "completed")
+        self.assertEqual(task.comment, escalation.AUTO_ADVANCE_COMMENT)
+        self.assertEqual(self.task(self.steps[1]).status, "pending")
+
+    def test_approved_tasks_are_not_escalated(self):
+        self.start("auto_advance")
+        task = ApprovalTask.objects.select_related("step").get(pk=self.task(self.steps[0]).pk)
+        task.mark_completed(self.approvers[0], notify=False)
+
+        self.assertIsNone(escalation.escalate_task(task.id, self.overdue()))
+        self.assertEqual(self.task(self.steps[1]).escalated_at, None)
+
+
+class EscalationSchedulerTests(WorkflowTestMixin, TransactionTestCase):
+    """
+    The scheduler escalates what is due and refills its heap from the
+    database; committed rows, since it queries from a worker thread.
+    """
+
+    def setUp(self):
+        self.create_workflow(step_count=2, approvers_per_step=1)
+        self.step = InstitutionApprovalStep.objects.get(Institution=self.institution, level=1)
+        InstitutionApprovalStep.objects.filter(pk=self.step.pk).update(sla=timedelta(hours=1))
+        items = [
+            CustomUser.objects.create(email=f"item{i}@example.com", fullname=f"Item {i}")
+            for i in range(3)
+        ]
+        start_workflow(self.action.code, self.institution, items)
+        self.tasks = list(ApprovalTask.objects.filter(step=self.step).order_by("id"))
+        patcher = mock.patch.object(CustomUser, "finish_workflow", create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_heap_holds_the_deadlines_inside_the_lookahead(self):
+        now = timezone.now()
+        overdue, upcoming, later = self.tasks
+        ApprovalTask.objects.filter(pk=overdue.pk).update(due_at=now - timedelta(minutes=1))
+        ApprovalTask.objects.filter(pk=upcoming.pk).update(due_at=now + timedelta(minutes=5))
+        ApprovalTask.objects.filter(pk=later.pk).update(due_at=now + timedelta(hours=1))
+
+        scheduler = escalation.EscalationScheduler(lookahead=timedelta(minutes=10))
+        self.assertEqual(async_to_sync(scheduler.refresh)(), 2)
+        self.assertEqual(async_to_sync(scheduler.refresh)(), 2)
+        self.assertEqual([task_id for _, task_id in scheduler.heap], [overdue.id, upcoming.id])
+
+        self.assertEqual(async_to_sync(scheduler.run_due)(), 1)
+        upcoming.refresh_from_db()
+        self.assertEqual(scheduler.heap, [(upcoming.due_at, upcoming.id)])
+        self.assertEqual(scheduler.queued, {upcoming.id})
+        self.assertGreater(scheduler.seconds_until_next(), 0)
+        self.assertEqual(
+            list(ApprovalTask.objects.filter(escalated_at__isnull=False).values_list("id", flat=True)),
+            [overdue.id],
+        )
+
+    def test_backlog_is_worked_through_without_waiting(self):
+        ApprovalTask.objects.filter(step=self.step).update(
+            due_at=timezone.now() - timedelta(minutes=1)
+        )
+        delays = []
+
+        class Stop(Exception):
+            pass
+
+        async def sleep(delay):
+            delays.append(delay)
+            if delay:
+                raise Stop
+
+        scheduler = escalation.EscalationScheduler(batch_size=1)
+        with mock.patch.object(escalation.asyncio, "sleep", sleep), self.assertRaises(Stop):
+            async_to_sync(scheduler.run)()
+        # one task per batch; a full batch is followed by another refresh at once
+        self.assertEqual(delays[:3], [0, 0, 0])
+        self.assertAlmostEqual(delays[3], escalation.ESCALATION_REFRESH_SECONDS, places=0)
+        self.assertFalse(
+            ApprovalTask.objects.filter(step=self.step, escalated_at__isnull=True).exists()
+        )
+
+
+class NotificationPresenceTests(WorkflowTestMixin, TestCase):
+    """Notifications are only built and sent for users with an open socket."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=2)
+        start_workflow(cls.action.code, cls.institution, [cls.owner])
+        cls.task = approval_task_queryset().get(status="pending")
+
+    def setUp(self):
+        cache.clear()
+
+    def test_connection_count(self):
+        user_id = self.approvers[0].id
+        presence.user_connected(user_id)
+        presence.user_connected(user_id)
+        presence.user_disconnected(user_id)
+        self.assertEqual(presence.online_user_ids([user_id]), {user_id})
+        presence.user_disconnected(user_id)
+        self.assertEqual(presence.online_user_ids([user_id]), set())
+
+    def test_offline_recipients_are_skipped(self):
+        with mock.patch.object(notifications, "fan_out") as fan_out:
+            with self.assertNumQueries(1):  # the recipients, nothing serialised
+                notifications.notify_task_update(self.task)
+        fan_out.assert_not_called()
+
+    def test_only_online_recipients_are_sent_to(self):
+        online = self.approvers[0]
+        presence.user_connected(online.id)
+        with mock.patch.object(notifications, "fan_out") as fan_out:
+            notifications.notify_task_update(self.task)
+        groups = {group for call in fan_out.call_args_list for group, _ in call.args[0]}
+        self.assertEqual(groups, {notifications.user_group(online.id)})
+
+
+class NotificationConsumerTests(WorkflowTestMixin, TransactionTestCase):
+    """
+    The notifications socket, end to end on the in-memory channel layer;
+    committed rows, since the consumer queries from a worker thread.
+    """
+
+    def setUp(self):
+        self.create_workflow(step_count=1, approvers_per_step=1)
+        items = [
+            CustomUser.objects.create(email=f"item{i}@example.com", fullname=f"Item {i}")
+            for i in range(2)
+        ]
+        start_workflow(self.action.code, self.institution, items)
+        self.user = self.approvers[0]
+        self.channel_layer = get_channel_layer()
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(
+            NotificationConsumer.as_asgi(), "/api/ws/notifications/"
+        )
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["type"], "tasks_snapshot")
+        return communicator, snapshot
+
+    async def publish(self, message, urgent=False):
+        await self.channel_layer.group_send(
+            notifications.user_group(self.user.id),
+            {"type": "notification_message", "message": message, "urgent": urgent},
+        )
+
+    def online(self):
+        return presence.online_user_ids([self.user.id]) == {self.user.id}
+
+    async def test_connect_snapshot_presence_and_disconnect(self):
+        self.assertFalse(self.online())
+        communicator, snapshot = await self.connect()
+        task_ids = await database_sync_to_async(
+            lambda: set(user_tasks_queryset(self.user.id).values_list("id", flat=True))
+        )()
+        self.assertEqual({task["id"] for task in snapshot["tasks"]}, task_ids)
+        self.assertEqual(len(task_ids), 2)
+        self.assertEqual(snapshot["seq"], 0)
+        self.assertTrue(self.online())
+
+        # deltas published to the user's group reach the socket
+        await self.channel_layer.group_send(
+            notifications.user_group(self.user.id),
+            {"type": "tasks_delta", "seq": 1, "resync": True, "changes": [], "urgent": True},
+        )
+        self.assertEqual((await communicator.receive_json_from())["seq"], 1)
+
+        await communicator.send_json_to({"type": "resync"})
+        self.assertEqual((await communicator.receive_json_from())["type"], "tasks_snapshot")
+
+        await communicator.disconnect()
+        self.assertFalse(self.online())
+        self.assertEqual(self.channel_layer.groups.get(notifications.user_group(self.user.id)), None)
+
+    async def test_anonymous_connections_are_refused(self):
+        communicator = WebsocketCommunicator(
+            NotificationConsumer.as_asgi(), "/api/ws/notifications/"
+        )
+        communicator.scope["user"] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertFalse(self.online())
+
+    @mock.patch.object(presence, "PRESENCE_TTL", 0.2)
+    @mock.patch.object(presence, "PRESENCE_HEARTBEAT_SECONDS", 0.02)
+    async def test_heartbeat_keeps_the_connection_online(self):
+        communicator, _ = await self.connect()
+        await asyncio.sleep(0.5)
+        self.assertTrue(self.online())
+        # expired while the socket stayed open; the next beat puts it back
+        cache.delete(presence._presence_key(self.user.id))
+        await asyncio.sleep(0.1)
+        self.assertTrue(self.online())
+
+        await communicator.disconnect()
+        self.assertFalse(self.online())
+
+    @mock.patch.object(presence, "PRESENCE_TTL", 0.2)
+    async def test_connection_without_heartbeats_expires(self):
+        # as when the server holding the socket dies without disconnecting
+        communicator, _ = await self.connect()
+        self.assertTrue(self.online())
+        await asyncio.sleep(0.5)
+        self.assertFalse(self.online())
+        await communicator.disconnect()
+
+    @mock.patch.object(NotificationConsumer, "batch_window", 0.2)
+    async def test_frames_close_together_arrive_as_one_batch(self):
+        communicator, _ = await self.connect()
+        await self.publish("first")
+        await self.publish("second")
+        self.assertTrue(await communicator.receive_nothing(timeout=0.05))
+        frame = await communicator.receive_json_from(timeout=1)
+        self.assertEqual(frame["type"], "batch")
+        self.assertEqual([f["message"] for f in frame["frames"]], ["first", "second"])
+        await communicator.disconnect()
+
+    @mock.patch.object(NotificationConsumer, "batch_window", 5)
+    async def test_urgent_frames_are_sent_at_once(self):
+        communicator, _ = await self.connect()
+        await self.publish("queued")
+        await self.publish("overdue", urgent=True)
+        # the queued frame goes first, without waiting for the window
+        queued = await communicator.receive_json_from(timeout=1)
+        urgent = await communicator.receive_json_from(timeout=1)
+        self.assertEqual((queued["type"], queued["message"]), ("notification", "queued"))
+        self.assertEqual((urgent["type"], urgent["message"]), ("notification", "overdue"))
+        await communicator.disconnect()
+
+    @mock.patch.object(NotificationConsumer, "batch_window", 5)
+    @mock.patch.object(NotificationConsumer, "batch_max_size", 3)
+    async def test_full_batch_is_sent_without_waiting(self):
+        communicator, _ = await self.connect()
+        for n in range(4):
+            await self.publish(f"update {n}")
+        frame = await communicator.receive_json_from(timeout=1)
+        self.assertEqual([f["message"] for f in frame["frames"]], ["update 0", "update 1", "update 2"])
+        # the fourth waits for the next batch
+        self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+        await communicator.disconnect()
+
+
+class TaskDeltaTests(WorkflowTestMixin, TestCase):
+    """Task list changes are folded into numbered frames and snapshots."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=1, approvers_per_step=1)
+        items = [
+            CustomUser.objects.create(email=f"item{i}@example.com", fullname=f"Item {i}")
+            for i in range(3)
+        ]
+        start_workflow(cls.action.code, cls.institution, items)
+        cls.user = cls.approvers[0]
+        cls.task_ids = list(ApprovalTask.objects.order_by("id").values_list("id", flat=True))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_sequence_is_counted_per_user(self):
+        other = self.owner
+        self.assertEqual(deltas.current_sequence(self.user.id), 0)
+        self.assertEqual([deltas.next_sequence(self.user.id) for _ in range(3)], [1, 2, 3])
+        self.assertEqual(deltas.next_sequence(other.id), 1)
+        self.assertEqual(deltas.current_sequence(self.user.id), 3)
+
+        presence.user_connected(self.user.id)
+        with mock.patch.object(notifications, "fan_out") as fan_out:
+            deltas.send_task_deltas({self.user.id: {self.task_ids[0]: deltas.STATUS_CHANGED}})
+            deltas.send_task_deltas({self.user.id: {self.task_ids[1]: deltas.STATUS_CHANGED}})
+        frames = [message for call in fan_out.call_args_list for _, message in call.args[0]]
+        self.assertEqual([frame["seq"] for frame in frames], [4, 5])
+
+    def test_ops_fold_into_one_per_task(self):
+        first, second, third = self.task_ids
+        changes = {}
+        deltas.merge_changes(changes, {self.user.id: {first: deltas.ADDED, second: deltas.STATUS_CHANGED}})
+        deltas.merge_changes(
+            changes,
+            {
+                self.user.id: {
+                    first: deltas.REMOVED,
+                    second: deltas.STATUS_CHANGED,
+                    third: deltas.REMOVED,
+                }
+            },
+        )
+        self.assertEqual(
+            changes, {self.user.id: {second: deltas.STATUS_CHANGED, third: deltas.REMOVED}}
+        )
+        deltas.merge_changes(changes, {self.user.id: {third: deltas.ADDED, second: deltas.STATUS_CHANGED}})
+        self.assertEqual(changes, {self.user.id: {second: deltas.STATUS_CHANGED, third: deltas.ADDED}})
+
+        # nothing left to tell the user
+        changes = deltas.merge_changes({}, {self.user.id: {first: deltas.ADDED}})
+        self.assertEqual(deltas.merge_changes(changes, {self.user.id: {first: deltas.REMOVED}}), {})
+
+    def test_large_changes_force_a_resync(self):
+        many = range(deltas.DELTA_MAX_CHANGES + 1)
+        self.assertEqual(
+            deltas.changes_for([self.user.id], many, deltas.ADDED), {self.user.id: deltas.RESYNC}
+        )
+
+        changes = deltas.changes_for([self.user.id], many[:-1], deltas.ADDED)
+        deltas.merge_changes(changes, {self.user.id: {-1: deltas.REMOVED}})
+        self.assertEqual(changes, {self.user.id: deltas.RESYNC})
+        # a resync absorbs anything merged after it
+        deltas.merge_changes(changes, {self.user.id: {self.task_ids[0]: deltas.ADDED}})
+        self.assertEqual(changes, {self.user.id: deltas.RESYNC})
+
+        [(group, frame)] = deltas.delta_messages(changes)
+        self.assertEqual(group, notifications.user_group(self.user.id))
+        self.assertEqual(frame, {"type": "tasks_delta", "seq": 1, "resync": True, "changes": []})
+
+    def test_snapshot_holds_the_latest_tasks(self):
+        now = timezone.now()
+        for age, task_id in enumerate(self.task_ids):
+            updated_at = now - timedelta(minutes=age)
+            ApprovalTask.objects.filter(pk=task_id).update(updated_at=updated_at)
+            ApprovalTaskAssignment.objects.filter(task_id=task_id).update(task_updated_at=updated_at)
+        deltas.next_sequence(self.user.id)
+
+        snapshot = deltas.build_task_snapshot(self.user.id, limit=2)
+        self.assertEqual(snapshot["type"], "tasks_snapshot")
+        self.assertEqual(snapshot["seq"], 1)
+        self.assertTrue(snapshot["has_more"])
+        self.assertEqual([task["id"] for task in snapshot["tasks"]], self.task_ids[:2])
+
+        snapshot = deltas.build_task_snapshot(self.user.id)
+        self.assertFalse(snapshot["has_more"])
+        self.assertEqual([task["id"] for task in snapshot["tasks"]], self.task_ids)
+        self.assertEqual(deltas.build_task_snapshot(self.owner.id)["tasks"], [])
+
+
+class TurnaroundRollupTests(WorkflowTestMixin, TestCase):
+    """Decisions reach the turnaround rollups through the outbox."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=1, approvers_per_step=1)
+        cls.objects = [
+            CustomUser.objects.create(email=f"object{i}@example.com", fullname=f"Object {i}")
+            for i in range(4)
+        ]
+        start_workflow(cls.action.code, cls.institution, cls.objects)
+        WorkflowNotificationOutbox.objects.all().delete()
+
+    def test_estimate_percentile(self):
+        self.assertIsNone(analytics.estimate_percentile({}, 0.95, 0))
+        # rank 95 is 45 of the 50 decisions into the 60-300 s bin
+        self.assertEqual(analytics.estimate_percentile({0: 50, 1: 50}, 0.95, 1000), 276)
+        # the open-ended last bin ends at the slowest decision
+        last = len(analytics.BIN_EDGES)
+        self.assertEqual(analytics.estimate_percentile({last: 10}, 0.5, 40 * 86400), 35 * 86400)
+
+    def test_rollup_numbers(self):
+        finished_at = timezone.now().replace(minute=30)
+        tasks = ApprovalTask.objects.select_related("step").order_by("id")
+        for task, seconds in zip(tasks, (30, 90, 120, 4000)):
+            task.started_at = finished_at - timedelta(seconds=seconds)
+            task.finished_at = finished_at
+            analytics.record_turnaround(task)
+        self.assertFalse(ApprovalTurnaroundRollup.objects.exists())
+
+        self.assertEqual(outbox.dispatch_pending(), (4, 0))
+        # bins 0, 1 and 5, hourly and daily
+        self.assertEqual(ApprovalTurnaroundRollup.objects.count(), 6)
+        for granularity in analytics.GRANULARITIES:
+            [row] = analytics.turnaround_report(
+                self.institution.id, granularity, since=finished_at - timedelta(hours=1)
+            )
+            self.assertEqual(row["count"], 4)
+            self.assertEqual(row["avg_seconds"], 1060)
+            self.assertEqual(row["max_seconds"], 4000)
+            # rank 3.8 falls 80% into the 3600-7200 s bin, capped at 4000 s
+            self.assertAlmostEqual(row["p95_seconds"], 3920)
+
+
+class EventExportTests(WorkflowTestMixin, TestCase):
+    """The event log is exported in id order, one keyset batch at a time."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=1)
+        item = CustomUser.objects.create(email="item@example.com", fullname="Item")
+        start_workflow(cls.action.code, cls.institution, [item])
+        first, second = ApprovalTask.objects.select_related("step").order_by("step__level")
+        with mock.patch.object(CustomUser, "finish_workflow", create=True):
+            first.comment = "Looks right"
+            first.mark_completed(cls.approvers[0], notify=False)
+            second.refresh_from_db()
+            second.comment = "Wrong price"
+            second.mark_rejected(cls.approvers[1], notify=False)
+        cls.first, cls.second = first, second
+        cls.expected = [
+            (first.id, "pending", "completed", cls.approvers[0].id, {"comment": "Looks right"}),
+            (second.id, "not_started", "pending", cls.approvers[0].id, {"cause": first.id}),
+            (second.id, "pending", "rejected", cls.approvers[1].id, {"comment": "Wrong price"}),
+        ]
+
+    def rows(self, events):
+        fields = ("task_id", "from_status", "to_status", "actor_id", "payload")
+        return [tuple(event[field] for field in fields) for event in events]
+
+    def test_events_are_exported_in_order(self):
+        events = list(iter_events(self.institution.id))
+        self.assertEqual(self.rows(events), self.expected)
+        self.assertEqual([event["id"] for event in events], sorted(event["id"] for event in events))
+        self.assertEqual(list(iter_events(self.institution.id + 1)), [])
+
+    def test_batches_continue_after_the_last_id(self):
+        with self.assertNumQueries(2):
+            events = list(iter_events(self.institution.id, batch_size=2))
+        self.assertEqual(self.rows(events), self.expected)
+        # a batch that comes back full is followed by one more query
+        with self.assertNumQueries(4):
+            self.assertEqual(self.rows(iter_events(self.institution.id, batch_size=1)), self.expected)
+
+        resumed = iter_events(self.institution.id, after_id=events[0]["id"], batch_size=1)
+        self.assertEqual(self.rows(resumed), self.expected[1:])
+
+    def test_ndjson_and_csv_lines(self):
+        lines = list(ndjson_lines(iter_events(self.institution.id)))
+        events = [json.loads(line) for line in lines]
+        self.assertTrue(all(line.endswith("\n") for line in lines))
+        self.assertEqual(self.rows(events), self.expected)
+        self.assertEqual(list(events[0]), list(EXPORT_FIELDS))
+        self.assertEqual(
+            parse_datetime(events[0]["created_at"]),
+            ApprovalTaskEvent.objects.get(pk=events[0]["id"]).created_at,
+        )
+
+        header, *rows = csv.reader(csv_lines(iter_events(self.institution.id)))
+        self.assertEqual(header, list(EXPORT_FIELDS))
+        self.assertEqual(
+            [(int(row[1]), row[3], row[4], int(row[5]), json.loads(row[7])) for row in rows],
+            self.expected,
+        )
+        self.assertEqual([row[0] for row in rows], [str(event["id"]) for event in events])
+
+
+class OutboxDispatchTests(TestCase):
+    """Outbox events are delivered outside the transaction that claimed them."""
+
+    def test_handlers_run_outside_the_claim(self):
+        for n in range(3):
+            outbox.enqueue("tasks_created", user_ids=[], step_name=f"Step {n}", task_count=n)
+        depth = len(connection.atomic_blocks)
+        depths = []
+
+        def handler(payload):
+            depths.append(len(connection.atomic_blocks))
+            if payload["task_count"] == 1:
+                raise DatabaseError("handler failed")
+
+        with mock.patch.dict(outbox.HANDLERS, {"tasks_created": handler}):
+            with self.assertLogs(outbox.logger, "WARNING"):
+                self.assertEqual(outbox.dispatch_pending(), (2, 1))
+            self.assertEqual(depths, [depth] * 3)
+            self.assertEqual(outbox.dispatch_pending(), (0, 0))
+
+        failed = WorkflowNotificationOutbox.objects.get(dispatched_at__isnull=True)
+        self.assertEqual((failed.payload["task_count"], failed.attempts), (1, 1))
+        self.assertGreater(failed.available_at, timezone.now())
+        self.assertEqual(WorkflowNotificationOutbox.objects.filter(dispatched_at__isnull=False).count(), 2)
+
+
+class FinishWorkflowsCommandTests(TestCase):
+    """`finish_workflows` checkpoints progress and failures, and resumes from them."""
+
+    def setUp(self):
+        self.users = [
+            CustomUser.objects.create(email=f"user{i}@example.com", fullname=f"User {i}")
+            for i in range(5)
+        ]
+        self.ids = [user.pk for user in self.users]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, "checkpoint.json")
+
+    def run_command(self, failing=(), interrupt=None):
+        finished = []
+
+        def finish_workflow(obj):
+            if obj.pk == interrupt:
+                raise KeyboardInterrupt
+            if obj.pk in failing:
+                raise ValueError("no approved tasks")
+            finished.append(obj.pk)
+
+        with mock.patch.object(CustomUser, "finish_workflow", finish_workflow, create=True):
+            call_command(
+                "finish_workflows",
+                model="users.CustomUser",
+                workers=1,
+                chunk_size=2,
+                checkpoint=self.checkpoint,
+                stdout=io.StringIO(),
+                stderr=io.StringIO(),
+            )
+        return finished
+
+    def saved_state(self):
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def test_failed_ids_are_retried_on_resume(self):
+        first, second, third, fourth, fifth = self.ids
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_command(failing={second}, interrupt=third)
+        state = self.saved_state()
+        self.assertEqual((state["last_id"], state["succeeded"], state["failed_ids"]), (second, 1, [second]))
+
+        # resumes with the failed id, then carries on after the last chunk
+        self.assertEqual(self.run_command(failing={fourth}), [second, third, fifth])
+        state = self.saved_state()
+        self.assertEqual((state["last_id"], state["succeeded"], state["failed_ids"]), (fifth, 4, [fourth]))
+
+        self.assertEqual(self.run_command(), [fourth])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class PrincipalCacheTests(WorkflowTestMixin, TestCase):
+    """Websocket tokens resolve from the cache and follow role and status changes."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=1)
+
+    def setUp(self):
+        cache.clear()
+        principals._local_principals.clear()
+        self.user = self.approvers[0]
+        self.token = str(AccessToken.for_user(self.user))
+
+    def test_warm_lookup_runs_no_queries(self):
+        principal = principals.resolve_token(self.token)
+        self.assertEqual(principal.institution_id, self.institution.id)
+        principals._local_principals.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(principals.resolve_token(self.token), principal)
+
+    def test_role_change_and_deactivation_invalidate(self):
+        principals.resolve_token(self.token)
+        role = Role.objects.create(name="auditor", description="", institution=self.institution)
+        with self.captureOnCommitCallbacks(execute=True):
+            UserRole.objects.create(user=self.user, role=role)
+        self.assertIn(role.id, principals.resolve_token(self.token).role_ids)
+
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertIsNone(principals.resolve_token(self.token))
+
+    def test_connects_without_the_cache(self):
+        principal = principals.resolve_token(self.token)
+        broken = mock.Mock(**{
+            f"{method}.side_effect": ConnectionError("cache is down")
+            for method in ("get", "add", "set", "incr")
+        })
+        with mock.patch.object(principals, "cache", broken), self.assertLogs(principals.logger):
+            self.assertEqual(principals.resolve_token(self.token), principal)
+            self.user.is_active = False
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.save()
+            # the process-local entry is not trusted without the version
+            self.assertIsNone(principals.resolve_token(self.token))
+
+
+@skipUnless(framing.binary_frames_available(), "msgpack is not installed")
+class BinaryFramingTests(WorkflowTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=2, approvers_per_step=2)
+        start_workflow(cls.action.code, cls.institution, [cls.owner])
+
+    def test_frames_round_trip_smaller_than_json(self):
+        task = approval_task_queryset().get(status="pending")
+        frame = {"type": "notification", "message": "New task", "task": ApprovalTaskSerializer(task).data}
+        text = json.dumps(frame, default=str)
+        data = framing.encode_frame(frame)
+
+        self.assertEqual(framing.decode_frame(data), json.loads(text))
+        self.assertLess(len(data), len(text) / 2)
+
+    def test_non_field_keys_round_trip_as_json_would(self):
+        frame = {"type": "counts", "counts": {1: 3, 70: 1, "other": 2, None: 0}}
+        text = json.dumps(frame)
+        self.assertEqual(framing.decode_frame(framing.encode_frame(frame)), json.loads(text))
+
+
+class WorkflowQueryPlanTests(WorkflowTestMixin, TestCase):
+    """
+    EXPLAIN the hot workflow queries on a seeded dataset and fail if any of
+    them reads a table sequentially. On PostgreSQL sequential scans are
+    disabled for the test, so a "Seq Scan" in the plan means no index can
+    serve the query at all.
+    """
+
+    SEQUENTIAL_SCAN = {
+        "postgresql": re.compile(r"Seq Scan on (\w+)"),
+        "sqlite": re.compile(r"\bSCAN (\w+)"),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_workflow(step_count=3, approvers_per_step=2)
+        cls.objects = [
+            CustomUser.objects.create(email=f"object{i}@example.com", fullname=f"Object {i}")
+            for i in range(50)
+        ]
+        start_workflow(cls.action.code, cls.institution, cls.objects)
+        cls.content_type = ContentType.objects.get_for_model(CustomUser)
+        cls.task = ApprovalTask.objects.filter(object_id=cls.objects[0].pk).order_by("id").first()
+
+    def setUp(self):
+        if connection.vendor not in self.SEQUENTIAL_SCAN:
+            self.skipTest(f"No plan checks for {connection.vendor}")
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertNoSequentialScan(self, queryset):
+        plan = queryset.explain()
+        tables = set(connection.introspection.table_names())
+        scanned = [
+            table
+            for table in self.SEQUENTIAL_SCAN[connection.vendor].findall(plan)
+            if table in tables
+        ]
+        self.assertFalse(scanned, f"Sequential scan of {scanned} in:\n{plan}")
+
+    def workflow_queries(self):
+        task = self.task
+        user_id = self.approvers[0].id
+        cursor_at = timezone.now()
+        object_tasks = ApprovalTask.objects.filter(
+            content_type_id=task.content_type_id, object_id=task.object_id
+        )
+        inbox = ApprovalTaskAssignment.objects.filter(user_id=user_id).order_by(
+            "-task_updated_at", "-task_id"
+        )
+        return {
+            "compare-and-swap transition": ApprovalTask.objects.filter(
+                pk=task.pk, status=task.status, version=task.version
+            ),
+            "terminate open tasks": object_tasks.exclude(id=task.id).filter(
+                status__in=OPEN_STATUSES
+            ),
+            "next level task": ApprovalTask.objects.filter(
+                step_id=task.step_id,
+                content_type_id=task.content_type_id,
+                object_id=task.object_id,
+            ),
+            "workflow participants": object_tasks.values_list("id", flat=True),
+            "pending tasks of a step": ApprovalTask.objects.filter(
+                step_id=task.step_id, status="pending"
+            ).order_by("updated_at"),
+            "escalation window": ApprovalTask.objects.filter(
+                status="pending", escalated_at__isnull=True, due_at__lte=cursor_at
+            ).order_by("due_at"),
+            "approval chain": InstitutionApprovalStep.objects.filter(
+                Institution_id=self.institution.id, action_id=self.action.id
+            ).order_by("level"),
+            "inbox": inbox.select_related("task__step__action"),
+            "inbox by status": inbox.filter(status__in=["pending", "not_started"]),
+            "inbox next page": inbox.filter(
+                Q(task_updated_at__lt=cursor_at)
+                | Q(task_updated_at=cursor_at, task_id__lt=task.id)
+            ),
+            "user tasks": user_tasks_queryset(user_id),
+            "task recipients": ApprovalTaskAssignment.objects.filter(
+                task_id__in=[task.id]
+            ).values_list("user_id", flat=True),
+            "step assignments": ApprovalTaskAssignment.objects.filter(
+                task__step_id=task.step_id
+            ),
+            "turnaround report": ApprovalTurnaroundRollup.objects.filter(
+                institution_id=self.institution.id,
+                granularity="day",
+                bucket_start__gte=cursor_at - timedelta(days=30),
+            ),
+            "event export batch": ApprovalTaskEvent.objects.filter(
+                institution_id=self.institution.id, id__gt=0
+            ).order_by("id")[:5000],
+            "task history": ApprovalTaskEvent.objects.filter(task_id=task.id).order_by("id"),
+            "pending notifications": WorkflowNotificationOutbox.objects.filter(
+                dispatched_at__isnull=True,
+                available_at__lte=cursor_at + timedelta(minutes=1),
+                attempts__lt=10,
+            ).order_by("available_at", "id"),
+        }
+
+    def test_workflow_queries_use_indexes(self):
+        for name, queryset in self.workflow_queries().items():
+            with self.subTest(name):
+                self.assertNoSequentialScan(queryset)
@@ -0,0 +1,286 @@
+"""
+Compare-and-swap state transitions for `ApprovalTask`.
+
+Every status change is a single conditional UPDATE:
+
+    UPDATE ... SET status = <to>, version = version + 1, ...
+    WHERE id = <id> AND status = <from> AND version = <version seen>
+
+so two approvers acting on the same task cannot both succeed: the loser's
+UPDATE matches no row and `TransitionConflict` is raised, without any lock
+being held beyond the row the database touches anyway. Callers run
+transitions inside `transaction.atomic()` so a conflict part way through an
+approval rolls back the steps already taken. Set-based transitions lock the
+rows they are about to change first and then update them by id, so they
+know exactly which tasks moved.
+
+Updates bypass `save()`, so assignments are kept in sync here rather than by
+the `post_save` signal. Transitions also stamp `started_at`/`finished_at`,
+feed decisions into the turnaround rollups and append to the event log
+(`workflows.events`), all in the caller's transaction.
+"""
+from django.db.models import Case, DateTimeField, Exists, F, OuterRef, Q, Value, When
+from django.utils import timezone
+
+from workflows.analytics import record_turnaround
+from workflows.assignments import sync_task_status
+from workflows.events import record_events, task_event
+from workflows.models import ApprovalTask
+
+ALLOWED_TRANSITIONS = {
+    "not_started": {"pending", "terminated"},
+    # back to not_started only when a reorder puts an open step before it
+    "pending": {"not_started", "completed", "rejected", "terminated"},
+    "completed": set(),
+    "rejected": set(),
+    "terminated": set(),
+}
+# statuses a workflow can still move out of
+OPEN_STATUSES = ("not_started", "pending")
+# decisions whose approval time is rolled up by workflows.analytics
+DECIDED_STATUSES = ("completed", "rejected")
+
+
+class TransitionConflict(ValueError):
+    """The task changed since it was read; reload it and try again."""
+
+    def __init__(self, task_id, to_status):
+        self.task_id = task_id
+        self.to_status = to_status
+        super().__init__(
+            f"Task {task_id} was modified by someone else before it could be {to_status}"
+        )
+
+
+def check_transition(from_status, to_status):
+    if to_status not in ALLOWED_TRANSITIONS.get(from_status, ()):
+        raise ValueError(f"Task cannot move from {from_status} to {to_status}")
+
+
+def transition(task, to_status, actor=None, **fields):
+    """
+    Move `task` from the status and version it was read with to `to_status`,
+    writing `fields` alongside, on behalf of the user `actor`. Updates `task`
+    in place on success and raises `TransitionConflict` if another
+    transaction got there first.
+    """
+    from_status = task.status
+    check_transition(from_status, to_status)
+    now = timezone.now()
+    if to_status == "pending":
+        fields["started_at"] = now
+    elif to_status not in OPEN_STATUSES:
+        fields["finished_at"] = now
+    updated = ApprovalTask.objects.filter(
+        pk=task.pk, status=task.status, version=task.version
+    ).update(status=to_status, version=F("version") + 1, updated_at=now, **fields)
+    if not updated:
+        raise TransitionConflict(task.pk, to_status)
+
+    task.status = to_status
+    task.version += 1
+    task.updated_at = now
+    for name, value in fields.items():
+        setattr(task, name, value)
+    sync_task_status([task.pk], to_status, now)
+    record_events(
+        [
+            task_event(
+                task.pk,
+                task.step.Institution_id,
+                from_status,
+                to_status,
+                actor,
+                at=now,
+                comment=fields.get("comment"),
+            )
+        ]
+    )
+    if to_status in DECIDED_STATUSES:
+        record_turnaround(task)
+    return task
+
+
+def activate_stage(queryset, stage, actor=None, cause=None):
+    """
+    Make the `not_started` tasks of `queryset`, one per step of `stage`,
+    pending in a single UPDATE, each with its step's SLA deadline. Tasks
+    already pending or closed are left alone. Raises `TransitionConflict`
+    unless every activated task is still as it was read. `cause` is the id
+    of the task whose approval completed the previous stage. Returns the
+    activated tasks.
+    """
+    tasks = list(queryset.filter(status="not_started").select_related("step"))
+    if not tasks:
+        return []
+
+    now = timezone.now()
+    deadlines = [
+        When(step_id=level.step_id, then=Value(level.due_at(now)))
+        for level in stage
+        if level.sla
+    ]
+    due_at = Case(*deadlines, default=None, output_field=DateTimeField())
+    unchanged = Q()
+    for task in tasks:
+        unchanged |= Q(pk=task.pk, status=task.status, version=task.version)
+    updated = ApprovalTask.objects.filter(unchanged).update(
+        status="pending",
+        version=F("version") + 1,
+        updated_at=now,
+        started_at=now,
+        due_at=due_at,
+    )
+    if updated != len(tasks):
+        raise TransitionConflict(tasks[0].pk, "pending")
+
+    due_at_by_step = {level.step_id: level.due_at(now) for level in stage}
+    for task in tasks:
+        task.status = "pending"
+        task.version += 1
+        task.updated_at = now
+        task.started_at = now
+        task.due_at = due_at_by_step.get(task.step_id)
+    sync_task_status([task.pk for task in tasks], "pending", now)
+    record_events(
+        [
+            task_event(
+                task.pk,
+                task.step.Institution_id,
+                "not_started",
+                "pending",
+                actor,
+                at=now,
+                cause=cause,
+            )
+            for task in tasks
+        ]
+    )
+    return tasks
+
+
+def _lock_ids(queryset, *fields):
+    """
+    `(id, *fields)` rows of `queryset`, locked in id order (only the task
+    rows, not the joined ones) so they can be updated by id afterwards.
+    """
+    return list(
+        queryset.select_for_update(of=("self",)).order_by("id").values_list("id", *fields)
+    )
+
+
+def transition_open_tasks(queryset, to_status, actor=None, cause=None):
+    """
+    Set-based transition of every open task in `queryset` to `to_status`.
+    Tasks that moved on concurrently are left alone. `cause` is the id of
+    the task whose decision closed them. Returns the ids of the tasks that
+    were transitioned.
+    """
+    for from_status in OPEN_STATUSES:
+        check_transition(from_status, to_status)
+    # Locked, so the UPDATE below changes exactly these rows; tasks a
+    # concurrent approval closed first no longer match once their lock is
+    # released.
+    candidates = {
+        task_id: (from_status, institution_id)
+        for task_id, from_status, institution_id in _lock_ids(
+            queryset.filter(status__in=OPEN_STATUSES), "status", "step__Institution_id"
+        )
+    }
+    task_ids = list(candidates)
+    if not task_ids:
+        return []
+
+    now = timezone.now()
+    ApprovalTask.objects.filter(id__in=task_ids).update(
+        status=to_status, version=F("version") + 1, updated_at=now, finished_at=now
+    )
+    sync_task_status(task_ids, to_status, now)
+    record_events(
+        [
+            task_event(
+                task_id,
+                institution_id,
+                from_status,
+                to_status,
+                actor,
+                at=now,
+                cause=cause,
+            )
+            for task_id in task_ids
+            for from_status, institution_id in [candidates[task_id]]
+        ]
+    )
+    return task_ids
+
+
+def relevel_open_tasks(institution_id, action_id, slas=None):
+    """
+    After the steps of an action were reordered, make the open tasks at the
+    lowest open level of every in-flight object the pending ones, in two
+    set-based UPDATEs. Pending tasks that now have an open task before them
+    go back to `not_started` and lose their deadline. Both bump `version`,
+    so approvals racing with the reorder fail with `TransitionConflict`.
+    `slas` maps step ids to their `sla`, for the deadlines of newly pending
+    tasks.
+
+    Returns `(promoted_ids, demoted_ids)`.
+    """
+    open_tasks = ApprovalTask.objects.filter(
+        step__Institution_id=institution_id,
+        step__action_id=action_id,
+        status__in=OPEN_STATUSES,
+    )
+    earlier_open = open_tasks.filter(
+        content_type_id=OuterRef("content_type_id"),
+        object_id=OuterRef("object_id"),
+        step__level__lt=OuterRef("step__level"),
+    )
+    first_open = open_tasks.filter(~Exists(earlier_open)).values("id")
+
+    check_transition("pending", "not_started")
+    check_transition("not_started", "pending")
+    demoted_ids = [
+        task_id
+        for task_id, in _lock_ids(open_tasks.filter(status="pending").exclude(id__in=first_open))
+    ]
+    promoted_ids = [
+        task_id
+        for task_id, in _lock_ids(open_tasks.filter(id__in=first_open, status="not_started"))
+    ]
+
+    now = timezone.now()
+    ApprovalTask.objects.filter(id__in=demoted_ids).update(
+        status="not_started",
+        version=F("version") + 1,
+        updated_at=now,
+        started_at=None,
+        due_at=None,
+        escalated_at=None,
+    )
+    deadlines = [
+        When(step_id=step_id, then=Value(now + sla))
+        for step_id, sla in (slas or {}).items()
+        if sla
+    ]
+    ApprovalTask.objects.filter(id__in=promoted_ids).update(
+        status="pending",
+        version=F("version") + 1,
+        updated_at=now,
+        started_at=now,
+        due_at=Case(*deadlines, default=None, output_field=DateTimeField()),
+    )
+
+    sync_task_status(demoted_ids, "not_started", now)
+    sync_task_status(promoted_ids, "pending", now)
+    record_events(
+        [
+            task_event(task_id, institution_id, "pending", "not_started", at=now, reason="reorder")
+            for task_id in demoted_ids
+        ]
+        + [
+            task_event(task_id, institution_id, "not_started", "pending", at=now, reason="reorder")
+            for task_id in promoted_ids
+        ]
+    )
+    return promoted_ids, demoted_ids
@@ -2,14 +2,19 @@ from django.urls import path
 
 from workflows.views import (
     ApproveTaskAPIView,
+    ApproveTaskBulkStatusAPIView,
     ApproveTaskDetailAPIView,
     InstitutionApprovalStepReorderAPIView,
     WorkflowActionAPIView,
     InstitutionApprovalStepAPIView,
+    TurnaroundReportAPIView,
+    WorkflowEventExportAPIView,
+    WorkflowStartAPIView,
 )
 
 urlpatterns = [
     path("task/", ApproveTaskAPIView.as_view(), name="task"),
+    path("task/status/", ApproveTaskBulkStatusAPIView.as_view(), name="bulk-update-task-status"),
     path("task/<int:task_id>/status/", ApproveTaskDetailAPIView.as_view(), name="update-task-status"),
     path(
         "Institution-approval-step/<int:Institution_id>/",
@@ -22,4 +27,15 @@ urlpatterns = [
         name='Institution-approval-step-reorder'
     ),
     path("workflow-action/", WorkflowActionAPIView.as_view(), name="workflow-action"),
+    path("start/<int:Institution_id>/", WorkflowStartAPIView.as_view(), name="workflow-start"),
+    path(
+        "analytics/turnaround/<int:Institution_id>/",
+        TurnaroundReportAPIView.as_view(),
+        name="workflow-turnaround",
+    ),
+    path(
+        "events/export/<int:Institution_id>/",
+        WorkflowEventExportAPIView.as_view(),
+        name="workflow-event-export",
+    ),
 ]
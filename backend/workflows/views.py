@@ -6,45 +6,129 @@ from users.models import Profile, UserRole
 from users.serializers import CustomUserSerializer
 from workflows.models import (
     ApprovalTask,
+    ApprovalTaskAssignment,
     InstitutionApprovalStep,
     InstitutionApprovalStepApprovorRole,
     WorkflowAction,
     InstitutionApprovalStepApprovorUser,
 )
-from django.shortcuts import get_object_or_404
-from django.db.models import Q
 from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.db.models import prefetch_related_objects
+from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema
-
-from workflows.request_serializers import ApprovalTaskStatusUpdateSerializer
+from utilities.pagination import KeysetPagination
+
+from workflows.analytics import default_report_window, turnaround_report
+from workflows.chain import get_approval_chain, get_chain_for_task
+from workflows.events import csv_lines, iter_events, ndjson_lines
+from workflows.transitions import TransitionConflict
+from workflows.request_serializers import (
+    ApprovalTaskBulkStatusResponseSerializer,
+    ApprovalTaskBulkStatusUpdateSerializer,
+    ApprovalTaskInboxFilterSerializer,
+    ApprovalTaskStatusUpdateSerializer,
+    EventExportFilterSerializer,
+    InstitutionApprovalStepCreateSerializer,
+    TurnaroundReportFilterSerializer,
+    TurnaroundReportRowSerializer,
+    WorkflowStartSerializer,
+)
+from workflows.services import (
+    bulk_update_task_status,
+    institution_field,
+    reorder_steps,
+    start_workflow,
+    unauthorized_task_ids,
+)
 from workflows.serializers import (
+    approval_step_prefetches,
+    approval_step_queryset,
     InstitutionApprovalStepSerializer,
     ApprovalTaskSerializer,
+    ApprovalTaskInboxSerializer,
     WorkflowActionSerializer,
 )
 from channels.layers import get_channel_layer
+from institution.models import Institution
 channel_layer = get_channel_layer()
 
 
+def institution_access_denied(request, Institution_id, members=False):
+    """
+    A 404/403 response unless the user owns the Institution (or, with
+    `members`, works for it), else None.
+    """
+    institution = Institution.objects.filter(id=Institution_id).only("institution_owner_id").first()
+    if institution is None:
+        return Response({"detail": "Institution not found."}, status=status.HTTP_404_NOT_FOUND)
+    if institution.institution_owner_id == request.user.id:
+        return None
+    if members and Profile.objects.filter(user=request.user, institution_id=Institution_id).exists():
+        return None
+    return Response({"detail": "Access denied."}, status=status.HTTP_403_FORBIDDEN)
+
+
+class ApprovalInboxPagination(KeysetPagination):
+    ordering_field = "task_updated_at"
+    pk_field = "task_id"
+
+
 class ApproveTaskAPIView(APIView):
+    pagination_class = ApprovalInboxPagination
+
     @extend_schema(
+        parameters=[ApprovalTaskInboxFilterSerializer],
         responses={200: ApprovalTaskSerializer(many=True)},
-        description="This lets authenticated user view all tasks assigned to his role.",
+        description=(
+            "This lets authenticated user view the tasks assigned to his roles, newest first, "
+            "filtered by status (repeatable), action, institution and updated_after/updated_before. "
+            "By default every matching task is returned as a list of nested tasks. Pass "
+            "detail=row for flat rows, cursor paginated on (updated_at, id) as "
+            "{next, results}; cursor or page_size paginate the nested tasks the same way."
+        ),
         summary="View self tasks",
         tags=["WorkFlows"],
     )
     def get(self, request):
-        user = request.user
-        user_roles = user.user_roles.values_list("role_id", flat=True)
-
-        tasks = ApprovalTask.objects.filter(
-            # 1) any step whose through‐model row’s approver_role is in my user_roles
-            Q(step__roles__approver_role__id__in=user_roles)
-            |
-            # 2) OR tasks where I’m explicitly the approver
-            Q(step__approver__approver_user__user__id=user.id)
-        ).distinct()  # collapse duplicate joins back into unique tasks
-        serializer = ApprovalTaskSerializer(tasks, many=True)
+        filters = ApprovalTaskInboxFilterSerializer(data=request.query_params)
+        if not filters.is_valid():
+            return Response(
+                {"detail": filters.errors}, status=status.HTTP_400_BAD_REQUEST
+            )
+        params = filters.validated_data
+
+        # tasks reachable through my roles or as an explicit approver,
+        # read from the denormalised assignment index
+        assignments = ApprovalTaskAssignment.objects.filter(user_id=request.user.id)
+        if params.get("status"):
+            assignments = assignments.filter(status__in=params["status"])
+        if "institution" in params:
+            assignments = assignments.filter(institution_id=params["institution"])
+        if "action" in params:
+            assignments = assignments.filter(task__step__action_id=params["action"])
+        if "updated_after" in params:
+            assignments = assignments.filter(task_updated_at__gte=params["updated_after"])
+        if "updated_before" in params:
+            assignments = assignments.filter(task_updated_at__lt=params["updated_before"])
+        assignments = assignments.select_related("task__step__action__category")
+
+        # older clients read the whole unpaginated list of nested tasks
+        paginate = params["detail"] == "row" or "cursor" in params or "page_size" in params
+        if paginate:
+            paginator = self.pagination_class()
+            page = paginator.paginate_queryset(assignments, request, view=self)
+        else:
+            page = assignments.order_by("-task_updated_at", "-task_id")
+        tasks = [a.task for a in page]
+        if params["detail"] == "full":
+            prefetch_related_objects(tasks, *approval_step_prefetches("step__"))
+            serializer = ApprovalTaskSerializer(tasks, many=True)
+        else:
+            serializer = ApprovalTaskInboxSerializer(tasks, many=True)
+        if paginate:
+            return paginator.get_paginated_response(serializer.data)
         return Response(serializer.data)
 
 
@@ -52,7 +136,10 @@ class ApproveTaskDetailAPIView(APIView):
     @extend_schema(
         request=ApprovalTaskStatusUpdateSerializer,
         responses={200: MessageResponseSerializer},
-        description="This lets authenticated user to approve a task assigned to his role.",
+        description=(
+            "This lets authenticated user to approve a task assigned to his role. "
+            "Returns 409 if the task was approved or rejected by someone else first."
+        ),
         summary="Approve task",
         tags=["WorkFlows"],
     )
@@ -66,70 +153,103 @@ class ApproveTaskDetailAPIView(APIView):
             )
         serializer = ApprovalTaskStatusUpdateSerializer(data=request.data)
         if serializer.is_valid():
-            task = get_object_or_404(ApprovalTask, pk=task_id)
+            task = get_object_or_404(ApprovalTask.objects.select_related("step"), pk=task_id)
             user = request.user
-            user_roles = user.user_roles.values_list("role_id", flat=True)
-
-            step_role_ids = set(
-                InstitutionApprovalStepApprovorRole.objects.filter(step=task.step).values_list(
-                    "approver_role_id", flat=True
-                )
-            )
-            approver_user_ids = set(
-                InstitutionApprovalStepApprovorUser.objects.filter(step=task.step).values_list(
-                    "approver_user__user__id", flat=True
-                )
-            )
+            user_roles = set(user.user_roles.values_list("role_id", flat=True))
 
-            matching_role = next((x for x in step_role_ids if x in user_roles), None)
-
-            if matching_role is None and not request.user.id in approver_user_ids and request.user.id != task.step.Institution.Institution_owner.id:
+            chain = get_chain_for_task(task)
+            if not chain.can_approve(
+                task.step_id, user.id, user_roles, escalated=task.escalated_at is not None
+            ):
                 return Response(
                     {"detail": "You are not allowed to approve this task."},
                     status=status.HTTP_403_FORBIDDEN,
                 )
             data = serializer.validated_data
 
-            # Import the notification function
-            from workflows.notifications import notify_workflow_participants
-
-            if data["status"] == "completed":
-                if task.status == "completed":
+            # Notifications are recorded in the outbox and delivered by the dispatcher
+            from workflows.outbox import enqueue
+
+            try:
+                if data["status"] == "completed":
+                    if task.status == "completed":
+                        return Response(
+                            {"detail": "Task already completed."},
+                            status=status.HTTP_400_BAD_REQUEST,
+                        )
+                    task.comment = task_comment
+                    # the participants' notification commits with the approval
+                    with transaction.atomic():
+                        task.mark_completed(request.user)
+                        enqueue("workflow_participants", task_id=task.id, status_change="completed", user_id=request.user.id)
+
+                    return Response({"message": "Task approved successfully."}, status=200)
+                elif data["status"] == "rejected":
+                    if task.status == "rejected":
+                        return Response(
+                            {"detail": "Task already cancelled."},
+                            status=status.HTTP_400_BAD_REQUEST,
+                        )
+                    task.comment = task_comment
+                    with transaction.atomic():
+                        terminated_ids = task.mark_rejected(request.user)
+                        enqueue("workflow_participants", task_id=task.id, status_change="rejected", user_id=request.user.id)
+
+                    if terminated_ids is None:
+                        return Response({"message": "Task rejected. The other approvers of this stage can still approve it."}, status=status.HTTP_200_OK)
+                    return Response({"message": "Task rejected. All other pending and not started steps terminated."}, status=status.HTTP_200_OK)
+                else:
                     return Response(
-                        {"detail": "Task already completed."},
-                        status=status.HTTP_400_BAD_REQUEST,
+                        {"detail": "Only completion is implemented."},
+                        status=status.HTTP_406_NOT_ACCEPTABLE,
                     )
-                task.comment = task_comment
-                task.mark_completed(request.user)
+            except TransitionConflict as e:
+                return Response({"detail": str(e)}, status=status.HTTP_409_CONFLICT)
+            except ValueError as e:
+                return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-                notify_workflow_participants(task, "completed", request.user)
+        return Response(
+            {"detail": serializer.errors}, status=status.HTTP_400_BAD_REQUEST
+        )
 
-                return Response({"message": "Task approved successfully."}, status=200)
-            elif data["status"] == "rejected":
-                if task.status == "rejected":
-                    return Response(
-                        {"detail": "Task already cancelled."},
-                        status=status.HTTP_400_BAD_REQUEST,
-                    )
-                task.comment = task_comment
-                task.mark_rejected(request.user)
 
-                notify_workflow_participants(task, "rejected", request.user)
+class ApproveTaskBulkStatusAPIView(APIView):
+    @extend_schema(
+        request=ApprovalTaskBulkStatusUpdateSerializer,
+        responses={200: ApprovalTaskBulkStatusResponseSerializer},
+        description=(
+            "Approve or reject many tasks in one request. All tasks must exist and be "
+            "assigned to the user; transitions are applied in a single transaction and "
+            "tasks that are no longer pending are reported under `failed`."
+        ),
+        summary="Bulk approve/reject tasks",
+        tags=["WorkFlows"],
+    )
+    def patch(self, request):
+        serializer = ApprovalTaskBulkStatusUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                {"detail": serializer.errors}, status=status.HTTP_400_BAD_REQUEST
+            )
+        updates = {
+            item["task_id"]: (item["status"], item["comment"])
+            for item in serializer.validated_data["tasks"]
+        }
 
-                ApprovalTask.objects.filter(
-                    content_type=task.content_type,
-                object_id=task.object_id
-                ).exclude(id=task.id).filter(status__in=["not_started", "pending"]).update(status="terminated")
-                return Response({"message": "Task rejected. All other pending and not started steps terminated."}, status=status.HTTP_200_OK)
-            else:
-                return Response(
-                    {"detail": "Only completion is implemented."},
-                    status=status.HTTP_406_NOT_ACCEPTABLE,
-                )
+        missing, forbidden = unauthorized_task_ids(request.user, updates.keys())
+        if missing:
+            return Response(
+                {"detail": "Tasks not found.", "task_ids": sorted(missing)},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        if forbidden:
+            return Response(
+                {"detail": "You are not allowed to approve these tasks.", "task_ids": sorted(forbidden)},
+                status=status.HTTP_403_FORBIDDEN,
+            )
 
-        return Response(
-            {"detail": serializer.errors}, status=status.HTTP_400_BAD_REQUEST
-        )
+        updated, failed = bulk_update_task_status(request.user, updates)
+        return Response({"updated": updated, "failed": failed}, status=status.HTTP_200_OK)
 
 
 class WorkflowActionAPIView(APIView):
@@ -155,13 +275,13 @@ class InstitutionApprovalStepAPIView(APIView):
     def get(self, request, Institution_id):
         step_id = request.query_params.get("step", None)
         if step_id:
-            single_Institution_approval_step = InstitutionApprovalStep.objects.filter(
+            single_Institution_approval_step = approval_step_queryset().filter(
                 id=step_id, Institution__id=Institution_id
             ).first()
             serializer = InstitutionApprovalStepSerializer(single_Institution_approval_step)
             return Response(serializer.data, status=status.HTTP_200_OK)
 
-        Institution_approval_steps = InstitutionApprovalStep.objects.filter(Institution__id=Institution_id)
+        Institution_approval_steps = approval_step_queryset().filter(Institution__id=Institution_id)
         serializer = InstitutionApprovalStepSerializer(Institution_approval_steps, many=True)
         return Response(serializer.data)
 
@@ -174,23 +294,30 @@ class InstitutionApprovalStepAPIView(APIView):
     )
     def post(self, request, Institution_id):
 
+        params = InstitutionApprovalStepCreateSerializer(data=request.data)
+        if not params.is_valid():
+            return Response({"detail": params.errors}, status=status.HTTP_400_BAD_REQUEST)
+
         mutable_data = request.data.copy()
         mutable_data["Institution"] = Institution_id
-        action_id = request.data.get("action")
-        last_level_step = InstitutionApprovalStep.objects.filter(
-            action__id=action_id, Institution__id=Institution_id
-        ).last()
+        action_id = params.validated_data.get("action")
+        last_level_step = None
+        if action_id:
+            last_level_step = get_approval_chain(Institution_id, action_id).last_level
 
         new_level = 1
         if last_level_step:
             new_level = last_level_step.level + 1
-        mutable_data["level"] = new_level
+        # an explicit level adds the step to that stage, in parallel with
+        # the steps already there
+        if not request.data.get("level"):
+            mutable_data["level"] = new_level
 
         serializer = InstitutionApprovalStepSerializer(
             data=mutable_data, context={"request": request}
         )
         if serializer.is_valid():
-            Institution_approval_step = serializer.save()
+            Institution_approval_step = approval_step_queryset().get(pk=serializer.save().pk)
             return Response(
                 InstitutionApprovalStepSerializer(Institution_approval_step).data,
                 status=status.HTTP_201_CREATED,
@@ -252,6 +379,7 @@ class InstitutionApprovalStepAPIView(APIView):
                     )
 
         # 5. return refreshed representation
+        step = approval_step_queryset().get(pk=step.pk)
         return Response(InstitutionApprovalStepSerializer(step).data)
 
     @extend_schema(
@@ -311,19 +439,24 @@ class InstitutionApprovalStepReorderAPIView(APIView):
 
         ids = list(new_levels.keys())
 
-        qs = InstitutionApprovalStep.objects.filter(Institution_id=Institution_id, id__in=ids)
-        if qs.count() != len(ids):
+        action_ids = dict(
+            InstitutionApprovalStep.objects.filter(
+                Institution_id=Institution_id, id__in=ids
+            ).values_list("id", "action_id")
+        )
+        if len(action_ids) != len(ids):
             return Response(
                 {"detail": "One or more step IDs not found for this Institution."},
                 status=status.HTTP_404_NOT_FOUND,
             )
 
-        action_ids = set(qs.values_list("action_id", flat=True))
+        action_ids = set(action_ids.values())
         if len(action_ids) > 1:
             return Response(
                 {"detail": "All steps must belong to the same action."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
+        action_id = action_ids.pop()
 
         # Validate target levels
         for sid, lvl in new_levels.items():
@@ -333,24 +466,141 @@ class InstitutionApprovalStepReorderAPIView(APIView):
                     status=status.HTTP_400_BAD_REQUEST,
                 )
 
-        # Compute offset = number of steps (so temp-levels = old_level + offset)
-        offset = qs.count()
-
-        with transaction.atomic():
-            # Phase 1: bump up into [offset+1 .. offset+max_level]
-            for step in qs:
-                step.level = step.level + offset
-            InstitutionApprovalStep.objects.bulk_update(qs, ["level"])
-
-            # Phase 2: assign the desired levels [1..n]
-            for step in qs:
-                step.level = new_levels[step.id]
-            InstitutionApprovalStep.objects.bulk_update(qs, ["level"])
+        # One short transaction: steps move in a single statement and in-flight
+        # tasks are re-levelled set-based
+        reorder_steps(Institution_id, action_id, new_levels)
 
         # Return the newly ordered list
-        action_id = action_ids.pop()
-        updated = InstitutionApprovalStep.objects.filter(
+        updated = approval_step_queryset().filter(
             Institution_id=Institution_id, action_id=action_id
         ).order_by("level")
         serializer = InstitutionApprovalStepSerializer(updated, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+class WorkflowStartAPIView(APIView):
+    @extend_schema(
+        request=WorkflowStartSerializer,
+        responses={201: MessageResponseSerializer},
+        description=(
+            "Start the approval workflow of an action for many objects at once. "
+            "One ApprovalTask is created per configured step and object; the first "
+            "level is pending and the rest are not started. Objects that already "
+            "have tasks for the action are skipped and listed in `skipped_object_ids`."
+        ),
+        summary="Start workflow for objects",
+        tags=["WorkFlows"],
+    )
+    def post(self, request, Institution_id):
+        denied = institution_access_denied(request, Institution_id, members=True)
+        if denied:
+            return denied
+        serializer = WorkflowStartSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(
+                {"detail": serializer.errors}, status=status.HTTP_400_BAD_REQUEST
+            )
+        data = serializer.validated_data
+        model_class = data["content_type"].model_class()
+        object_ids = set(data["object_ids"])
+        objects = model_class.objects.filter(
+            pk__in=object_ids, **{institution_field(model_class) + "_id": Institution_id}
+        )
+        missing = object_ids - set(objects.values_list("pk", flat=True))
+        if missing:
+            return Response(
+                {"detail": "Objects not found in this Institution.", "object_ids": sorted(missing)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        # full rows: tasks are labelled with str(obj)
+        objects = objects.iterator(chunk_size=2000)
+
+        try:
+            started, skipped_ids = start_workflow(data["action_code"], Institution_id, objects)
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {
+                "message": f"Workflow started for {started} object(s).",
+                "skipped_object_ids": sorted(skipped_ids),
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class TurnaroundReportAPIView(APIView):
+    @extend_schema(
+        parameters=[TurnaroundReportFilterSerializer],
+        responses={200: TurnaroundReportRowSerializer(many=True)},
+        description=(
+            "Approval turnaround (time from a task becoming pending to its approval or "
+            "rejection) for an Institution: count, average, p95 and max in seconds, "
+            "grouped by step, action or institution. Read from hourly or daily rollups; "
+            "the window defaults to the last 2 days of hours or 30 days."
+        ),
+        summary="Approval turnaround report",
+        tags=["WorkFlows"],
+    )
+    def get(self, request, Institution_id):
+        denied = institution_access_denied(request, Institution_id)
+        if denied:
+            return denied
+        filters = TurnaroundReportFilterSerializer(data=request.query_params)
+        if not filters.is_valid():
+            return Response(
+                {"detail": filters.errors}, status=status.HTTP_400_BAD_REQUEST
+            )
+        params = filters.validated_data
+        granularity = params["granularity"]
+
+        rows = turnaround_report(
+            Institution_id,
+            granularity=granularity,
+            since=params.get("since") or default_report_window(granularity),
+            until=params.get("until"),
+            group_by=params["group_by"],
+            action_id=params.get("action"),
+        )
+        return Response(rows)
+
+
+class WorkflowEventExportAPIView(APIView):
+    @extend_schema(
+        parameters=[EventExportFilterSerializer],
+        responses={200: OpenApiTypes.STR},
+        description=(
+            "Stream the approval task event log of an Institution in id order, as "
+            "newline-delimited JSON (default) or CSV. Events are read in batches, so "
+            "exports of any size use constant memory; pass the last id received as "
+            "`after` to resume an interrupted export."
+        ),
+        summary="Export workflow events",
+        tags=["WorkFlows"],
+    )
+    def get(self, request, Institution_id):
+        denied = institution_access_denied(request, Institution_id)
+        if denied:
+            return denied
+        filters = EventExportFilterSerializer(data=request.query_params)
+        if not filters.is_valid():
+            return Response(
+                {"detail": filters.errors}, status=status.HTTP_400_BAD_REQUEST
+            )
+        params = filters.validated_data
+        events = iter_events(
+            Institution_id,
+            since=params.get("since"),
+            until=params.get("until"),
+            after_id=params.get("after"),
+        )
+        if params["output"] == "csv":
+            response = StreamingHttpResponse(csv_lines(events), content_type="text/csv")
+        else:
+            response = StreamingHttpResponse(
+                ndjson_lines(events), content_type="application/x-ndjson"
+            )
+        response["Content-Disposition"] = (
+            f'attachment; filename="workflow-events-{Institution_id}.{params["output"]}"'
+        )
+        return response
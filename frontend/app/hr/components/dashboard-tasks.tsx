@@ -30,10 +30,8 @@ export function DashboardTasks() {
   const fetchTasks = async () => {
     try {
       setIsLoading(true);
-      const response = await fetchUserTasks();
-      const responseData: ApiTask[] = response.data;
-      // Filter only pending tasks
-      const pendingTasks = responseData.filter((task) => task.status === "not_started");
+      const response = await fetchUserTasks("not_started");
+      const pendingTasks: ApiTask[] = response.data;
 
       // Convert API tasks to display format
       const convertedTasks = pendingTasks.map((task) => {
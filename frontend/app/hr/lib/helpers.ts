@@ -150,9 +150,21 @@ export async function fetchInstitutionRoles() {
   }
 }
 
-export async function fetchUserTasks() {
+// Reads every page of the user's tasks with the given status, so the cost
+// does not grow with their task history.
+export async function fetchUserTasks(status: string) {
   try {
-    return await apiRequest.get("workflow/task/");
+    const tasks: any[] = [];
+    let url: string | null = `workflow/task/?status=${status}&page_size=100`;
+
+    while (url) {
+      const response: any = await apiRequest.get(url);
+
+      tasks.push(...response.data.results);
+      url = response.data.next;
+    }
+
+    return {data: tasks};
   } catch (error) {
     console.log("Error fetching  user tasks ");
     throw error;
@@ -19,9 +19,8 @@ export function TasksCards({branchId}: {branchId: string | null}) {
 
   const fetchTasks = async () => {
     try {
-      const response = await fetchUserTasks();
-      const responseData: ApiTask[] = response.data;
-      const pendingTasks = responseData.filter((task) => task.status === "pending");
+      const response = await fetchUserTasks("pending");
+      const pendingTasks: ApiTask[] = response.data;
 
       setTasks(pendingTasks);
     } catch (error) {